@@ -9,7 +9,10 @@ class StepAudioOptions(BaseModel):
     """Step-Audio specific settings embedded inside the OpenAI style payload."""
 
     mode: Literal["clone", "emotion", "style", "paralinguistic", "speed", "denoise", "vad"] = "clone"
-    model_variant: Literal["base", "awq", "bnb"] = "bnb"
+    model_variant: Literal["base", "awq", "bnb", "base+spec"] = Field(
+        default="bnb",
+        description="Model weights to use. 'base+spec' drafts tokens with a loaded 4-bit variant and verifies them with the base model (base-model quality).",
+    )
     prompt_text: Optional[str] = None
     prompt_audio_base64: Optional[str] = Field(
         default=None,
@@ -40,6 +43,20 @@ class StepAudioOptions(BaseModel):
         le=3.0,
         description="Intensity multiplier (0.1~3.0) describing how subtle or strong the requested edit should be. 0.1=weakest, 1.0=standard, 3.0=strongest.",
     )
+    speculative_decoding: bool = Field(
+        default=False,
+        description="Edit modes only: draft audio tokens by n-gram lookup in the input audio and verify several per forward pass. Output distribution is unchanged.",
+    )
+    flow_solver: Literal["euler", "midpoint", "heun", "multistep", "adaptive"] = Field(
+        default="euler",
+        description="Non-stream only: ODE solver of the flow-matching vocoder. DiT evaluations per request: euler/multistep = flow_steps, midpoint/heun = 2*flow_steps, adaptive <= 2*flow_steps.",
+    )
+    flow_steps: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=32,
+        description="Non-stream only: solver steps of the flow-matching vocoder. Defaults to 10.",
+    )
     n_edit_iter: int = Field(
         default=1,
         ge=1,
@@ -60,7 +77,7 @@ class SpeechRequest(BaseModel):
     response_format: Literal["wav", "flac", "mp3"] = Field(default="wav")
     stream: bool = Field(
         default=False,
-        description="Reserved. Streaming is not yet supported via the REST API.",
+        description="Stream raw 16-bit mono PCM (24 kHz) chunks as they are synthesized. response_format is ignored when streaming.",
     )
     step_audio: StepAudioOptions = Field(
         default_factory=StepAudioOptions,
@@ -91,3 +108,15 @@ class VoiceInfo(BaseModel):
     prompt_text: str
     locale: str
     gender: str
+
+
+class VoiceRegisterRequest(BaseModel):
+    """POST /v1/voices payload registering a reusable custom voice."""
+
+    id: str = Field(..., description="Voice id (1-64 letters, digits, '_' or '-'); used as `voice` in speech requests.")
+    prompt_text: str = Field(..., description="Transcript of the reference audio.")
+    prompt_audio_base64: Optional[str] = Field(default=None, description="Reference audio as base64 encoded string.")
+    prompt_audio_url: Optional[HttpUrl] = Field(default=None, description="HTTP(S) url pointing to reference audio file.")
+    description: str = ""
+    locale: str = ""
+    gender: str = ""
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
 import base64
+import hashlib
 import io
 import os
 import tempfile
 from pathlib import Path
 from typing import Iterable, Optional, Tuple
 
+import numpy as np
 import requests
 import soundfile as sf
 from pydub import AudioSegment
@@ -20,20 +22,25 @@ def _to_str(url: Optional[str]) -> Optional[str]:
     return str(url)
 
 
-def _download_temp_file(url: str) -> str:
+def content_key(raw: bytes) -> str:
+    """blake2b digest of uploaded audio bytes, keys the engine's prompt artifact cache"""
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _download_temp_file(url: str) -> Tuple[str, str]:
     response = requests.get(url, timeout=30)
     response.raise_for_status()
     suffix = Path(url).suffix or ".wav"
     with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as fp:
         fp.write(response.content)
-        return fp.name
+        return fp.name, content_key(response.content)
 
 
-def _write_base64_audio(data: str, suffix: str = ".wav") -> str:
+def _write_base64_audio(data: str, suffix: str = ".wav") -> Tuple[str, str]:
     raw = base64.b64decode(data)
     with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as fp:
         fp.write(raw)
-        return fp.name
+        return fp.name, content_key(raw)
 
 
 def resolve_reference_audio(
@@ -41,22 +48,21 @@ def resolve_reference_audio(
     prompt_audio_url: Optional[str],
     voice_id: Optional[str],
     search_roots: Iterable[str],
-) -> Tuple[str, str, bool]:
+) -> Tuple[str, str, bool, Optional[str]]:
     """
     Determine which reference audio/path to use for cloning.
-    Returns tuple of (audio_path, prompt_text).
+    Returns tuple of (audio_path, prompt_text, is_temp, content_key); the
+    content key is only set for uploaded audio.
     """
 
-    tmp_path = None
-
     if prompt_audio_base64:
-        tmp_path = _write_base64_audio(prompt_audio_base64)
-        return tmp_path, "", True
+        tmp_path, key = _write_base64_audio(prompt_audio_base64)
+        return tmp_path, "", True, key
 
     prompt_audio_url = _to_str(prompt_audio_url)
     if prompt_audio_url:
-        tmp_path = _download_temp_file(prompt_audio_url)
-        return tmp_path, "", True
+        tmp_path, key = _download_temp_file(prompt_audio_url)
+        return tmp_path, "", True, key
 
     preset_id = voice_id or DEFAULT_VOICE_ID
 
@@ -67,7 +73,7 @@ def resolve_reference_audio(
     for root in search_roots:
         preset_path = Path(root) / preset.prompt_audio
         if preset_path.exists():
-            return str(preset_path), preset.prompt_text, False
+            return str(preset_path), preset.prompt_text, False, None
     raise FileNotFoundError(
         f"Preset audio '{preset.prompt_audio}' not found in any of: {', '.join(map(str, search_roots))}"
     )
@@ -76,17 +82,27 @@ def resolve_reference_audio(
 def resolve_input_audio(
     audio_base64: Optional[str],
     audio_url: Optional[str],
-) -> Tuple[str, bool]:
-    """Return local path to audio clip that should be edited."""
+) -> Tuple[str, bool, str]:
+    """Return (local path, is_temp, content_key) of the audio clip that should be edited."""
 
     if audio_base64:
-        return _write_base64_audio(audio_base64), True
+        path, key = _write_base64_audio(audio_base64)
+        return path, True, key
     audio_url = _to_str(audio_url)
     if audio_url:
-        return _download_temp_file(audio_url), True
+        path, key = _download_temp_file(audio_url)
+        return path, True, key
     raise ValueError("An existing audio clip is required for this mode. Provide step_audio.input_audio_base64 or step_audio.input_audio_url.")
 
 
+def audio_tensor_to_pcm16(waveform) -> bytes:
+    """Convert a float waveform chunk to raw little-endian 16-bit PCM bytes."""
+
+    data = waveform.squeeze().cpu().numpy()
+    data = np.clip(data, -1.0, 1.0)
+    return (data * 32767).astype("<i2").tobytes()
+
+
 def audio_tensor_to_bytes(
     waveform,
     sample_rate: int,
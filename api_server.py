@@ -4,6 +4,9 @@ import base64
 import json
 import os
 import logging
+from dataclasses import replace
+from functools import partial
+from http import HTTPStatus
 from pathlib import Path
 from typing import List
 
@@ -11,12 +14,17 @@ import uvicorn
 import torch
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 
+from audio_context import AudioContext, AudioDecodeError
 from config.edit_config import get_supported_edit_types
 from model_loader import ModelSource
+from prefix_cache import PrefixKVCache
+from stepvocoder.cosyvoice2.flow.cache_pool import SessionLimitError
 from tokenizer import StepAudioTokenizer
-from tts import StepAudioTTS
+from tts import HTTPException as EngineHTTPException, StepAudioTTS
+from voice_registry import VoiceRegistry, file_digest
 from whisper_wrapper import WhisperWrapper
 
 from api.schemas import (
@@ -24,13 +32,15 @@ from api.schemas import (
     ModelInfo,
     SpeechRequest,
     VoiceInfo,
+    VoiceRegisterRequest,
 )
 from api.utils import (
     audio_tensor_to_bytes,
+    audio_tensor_to_pcm16,
     resolve_input_audio,
     resolve_reference_audio,
 )
-from api.voices import list_presets
+from api.voices import DEFAULT_VOICE_ID, VOICE_LIBRARY, list_presets
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +54,14 @@ def parse_args():
     parser.add_argument("--quantization", type=str, choices=["int4", "int8", "awq-4bit"], default=None)
     parser.add_argument("--torch-dtype", type=str, choices=["float16", "bfloat16", "float32"], default="bfloat16")
     parser.add_argument("--device-map", type=str, default="cuda")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of requests decoded together by the continuous-batching scheduler; 0 disables it and requests to the same model variant run one at a time.")
+    parser.add_argument("--prefix-cache-mb", type=int, default=2048, help="GPU memory budget in MB for reusing prefilled voice-prompt KV states, one cache shared by all loaded model variants (0 disables). Default: 2048.")
+    parser.add_argument("--constrained-decoding", action="store_true", help="Restrict generation to the vq02/vq06 audio token grammar and slice the lm_head accordingly.")
+    parser.add_argument("--cfg-interval", type=float, nargs=2, default=None, metavar=("T_MIN", "T_MAX"), help="Apply classifier-free guidance in the flow-matching vocoder only for t in [T_MIN, T_MAX] (t=0 noise, t=1 mel); other steps run at half the DiT batch. Default: every step.")
+    parser.add_argument("--max-stream-sessions", type=int, default=4, help="Streaming requests that may run the vocoder concurrently, each holds its own flow cache buffers (about 1.4 GB in float32); further requests wait. Default: 4.")
+    parser.add_argument("--vocoder-batch-size", type=int, default=4, help="Non-stream requests waiting for the vocoder that are decoded together in one flow solve (1 disables). Default: 4.")
+    parser.add_argument("--stream-session-timeout", type=float, default=30.0, help="Seconds a streaming request waits for a free vocoder session before failing with 503. Default: 30.")
+    parser.add_argument("--voice-dir", type=str, default="/app/cache/voices", help="Directory of precomputed voice artifacts (presets and voices registered via POST /v1/voices).")
     parser.add_argument("--enable-auto-transcribe", action="store_true", help="Enable Whisper transcription for edit tasks when no audio_text is provided.")
     parser.add_argument("--awq-model-path", type=str, default=None, help="Path to AWQ quantized model directory (defaults to <model-path>/Step-Audio-EditX-AWQ-4bit if present).")
     parser.add_argument("--bnb-model-path", type=str, default=None, help="Path to BitsAndBytes quantized model directory (defaults to <model-path>/Step-Audio-EditX-bnb-4bit if present).")
@@ -52,11 +70,53 @@ def parse_args():
     return parser.parse_args()
 
 
+def _remove_paths(paths: List[str]):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _voice_info(voice_id: str, voice) -> VoiceInfo:
+    metadata = voice.metadata
+    return VoiceInfo(
+        id=voice_id,
+        description=metadata.get("description", ""),
+        prompt_audio=metadata.get("prompt_audio", ""),
+        prompt_text=voice.prompt_text,
+        locale=metadata.get("locale", ""),
+        gender=metadata.get("gender", ""),
+    )
+
+
+def precompute_voice_presets(voice_registry: VoiceRegistry, engine: StepAudioTTS, asset_roots: list[Path]):
+    """Compute artifacts for every preset in VOICE_LIBRARY whose audio is new or changed."""
+    for preset_id, preset in VOICE_LIBRARY.items():
+        try:
+            prompt_path, prompt_text, _, _ = resolve_reference_audio(None, None, preset_id, asset_roots)
+            digest = file_digest(prompt_path)
+            cached = voice_registry.get(preset_id)
+            if cached is not None and cached.metadata.get("source_digest") == digest and cached.prompt_text == prompt_text:
+                continue
+            voice = engine.compute_voice_artifacts(prompt_path, prompt_text)
+            voice.metadata = {
+                "source_digest": digest,
+                "description": preset.description,
+                "prompt_audio": preset.prompt_audio,
+                "locale": preset.locale,
+                "gender": preset.gender,
+            }
+            voice_registry.register(preset_id, voice)
+            logger.info(f"Precomputed voice preset '{preset_id}'")
+        except Exception as exc:
+            logger.warning(f"Failed to precompute voice preset '{preset_id}': {exc}")
+
+
 def build_fastapi_app(
     model_engines: dict[str, StepAudioTTS],
     model_root: Path,
     asset_roots: list[Path],
     whisper_asr: WhisperWrapper | None,
+    voice_registry: VoiceRegistry | None = None,
 ) -> FastAPI:
     app = FastAPI(
         title="Step-Audio-EditX API",
@@ -75,7 +135,7 @@ def build_fastapi_app(
     app.state.model_root = str(model_root)
     app.state.asset_roots = [str(path) for path in asset_roots]
     app.state.whisper_asr = whisper_asr
-    app.state.generate_lock = asyncio.Lock()
+    app.state.voice_registry = voice_registry
 
     @app.get("/healthz")
     async def healthz():
@@ -87,7 +147,61 @@ def build_fastapi_app(
 
     @app.get("/v1/voices", response_model=List[VoiceInfo])
     async def list_voices():
-        return [VoiceInfo(**preset) for preset in list_presets()]
+        voices = [VoiceInfo(**preset) for preset in list_presets()]
+        if voice_registry is not None:
+            voices += [
+                _voice_info(voice_id, voice)
+                for voice_id, voice in voice_registry.items()
+                if voice_id not in VOICE_LIBRARY
+            ]
+        return voices
+
+    @app.post("/v1/voices", response_model=VoiceInfo)
+    async def register_voice(request: VoiceRegisterRequest):
+        if voice_registry is None:
+            raise HTTPException(status_code=HTTPStatus.NOT_IMPLEMENTED, detail="Voice registry is disabled on this server.")
+        if request.id in VOICE_LIBRARY:
+            raise HTTPException(status_code=HTTPStatus.CONFLICT, detail=f"'{request.id}' is a built-in voice preset.")
+        if not request.prompt_audio_base64 and not request.prompt_audio_url:
+            raise HTTPException(status_code=400, detail="prompt_audio_base64 or prompt_audio_url is required.")
+        try:
+            VoiceRegistry.validate_id(request.id)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+        engine = app.state.model_engines.get("base") or next(iter(app.state.model_engines.values()))
+        try:
+            prompt_path, _, _, content_key = resolve_reference_audio(
+                request.prompt_audio_base64, request.prompt_audio_url, None, app.state.asset_roots
+            )
+        except Exception as exc:
+            # undecodable base64 or an unreachable URL is a bad request, not a server error
+            raise HTTPException(status_code=400, detail=f"Failed to load prompt audio: {exc}") from exc
+        try:
+            voice = await asyncio.get_running_loop().run_in_executor(
+                None, engine.compute_voice_artifacts, prompt_path, request.prompt_text, content_key
+            )
+            voice.metadata = {"description": request.description, "locale": request.locale, "gender": request.gender}
+            voice = voice_registry.register(request.id, voice)
+        except AudioDecodeError as exc:
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=str(exc)) from exc
+        finally:
+            _remove_paths([prompt_path])
+        return _voice_info(request.id, voice)
+
+    @app.get("/v1/stats/speculative")
+    async def speculative_stats():
+        return {name: engine.get_speculative_stats() for name, engine in app.state.model_engines.items()}
+
+    @app.get("/v1/stats/prompt_analysis")
+    async def prompt_analysis_stats():
+        return {name: engine.get_prompt_analysis_stats() for name, engine in app.state.model_engines.items()}
+
+    @app.get("/v1/stats/sessions")
+    async def session_stats():
+        return {name: engine.get_session_stats() for name, engine in app.state.model_engines.items()}
 
     @app.get("/v1/tags")
     async def list_supported_tags():
@@ -97,83 +211,192 @@ def build_fastapi_app(
     async def process_request(request: SpeechRequest):
         options = request.step_audio
         model_variant = options.model_variant if options.model_variant else "base"
+        draft_engine: StepAudioTTS | None = None
+        if model_variant == "base+spec":
+            # a 4-bit variant drafts, the bf16 base model verifies
+            draft_engine = app.state.model_engines.get("bnb") or app.state.model_engines.get("awq")
+            if draft_engine is None:
+                raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Model variant 'base+spec' requires a loaded 4-bit variant (bnb or awq).")
+            model_variant = "base"
         app_engine: StepAudioTTS | None = app.state.model_engines.get(model_variant)
         if app_engine is None:
             raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=f"Model variant '{model_variant}' is not available on this server.")
         whisper_asr: WhisperWrapper | None = app.state.whisper_asr
-        lock: asyncio.Lock = app.state.generate_lock
         model_root = app.state.model_root
         asset_roots = app.state.asset_roots
         tmp_paths: List[str] = []
 
+        headers = {}
+        if request.metadata:
+            headers.update({f"x-metadata-{k}": v for k, v in request.metadata.items()})
+        headers["X-StepAudio-Model"] = request.model
+
         try:
             loop = asyncio.get_running_loop()
-
-            if options.mode == "clone":
-                prompt_path, prompt_text, is_temp = resolve_reference_audio(
-                    options.prompt_audio_base64,
-                    options.prompt_audio_url,
-                    request.voice,
-                    asset_roots,
-                )
+            audio_stream = None
+
+            voice = None
+            if options.mode == "clone" and voice_registry is not None and not (
+                options.prompt_audio_base64 or options.prompt_audio_url
+            ):
+                voice = voice_registry.get(request.voice or DEFAULT_VOICE_ID)
+
+            if voice is not None:
+                # registered voice: prompt artifacts are precomputed, skip preprocessing
+                if options.prompt_text:
+                    voice = replace(voice, prompt_text=options.prompt_text)
+                if request.stream:
+                    # the prompt is encoded before the response starts, its errors get a status code
+                    audio_stream = await loop.run_in_executor(
+                        None,
+                        partial(app_engine.clone_with_voice_stream, voice, request.input, draft_model=draft_engine),
+                    )
+                else:
+                    audio_tensor, sr = await loop.run_in_executor(
+                        None,
+                        partial(
+                            app_engine.clone_with_voice,
+                            voice,
+                            request.input,
+                            draft_model=draft_engine,
+                            flow_solver=options.flow_solver,
+                            flow_steps=options.flow_steps,
+                        ),
+                    )
+            elif options.mode == "clone":
+                try:
+                    prompt_path, prompt_text, is_temp, content_key = resolve_reference_audio(
+                        options.prompt_audio_base64,
+                        options.prompt_audio_url,
+                        request.voice,
+                        asset_roots,
+                    )
+                except FileNotFoundError:
+                    # a preset missing from the server's asset roots is a server error
+                    raise
+                except Exception as exc:
+                    raise HTTPException(status_code=400, detail=f"Failed to load prompt audio: {exc}") from exc
                 if is_temp:
                     tmp_paths.append(prompt_path)
                 prompt_text = options.prompt_text or prompt_text or request.input
 
-                async with lock:
+                if request.stream:
+                    # prompt preprocessing runs before the response starts, its errors get a status code
+                    audio_stream = await loop.run_in_executor(
+                        None,
+                        partial(
+                            app_engine.clone_stream,
+                            prompt_path,
+                            prompt_text,
+                            request.input,
+                            draft_model=draft_engine,
+                            content_key=content_key,
+                        ),
+                    )
+                else:
+                    # generation is batched by the engine's scheduler, no global lock needed
                     audio_tensor, sr = await loop.run_in_executor(
                         None,
-                        app_engine.clone,
-                        prompt_path,
-                        prompt_text,
-                        request.input,
+                        partial(
+                            app_engine.clone,
+                            prompt_path,
+                            prompt_text,
+                            request.input,
+                            draft_model=draft_engine,
+                            content_key=content_key,
+                            flow_solver=options.flow_solver,
+                            flow_steps=options.flow_steps,
+                        ),
                     )
             else:
-                input_path, is_temp = resolve_input_audio(
-                    options.input_audio_base64,
-                    options.input_audio_url,
-                )
+                try:
+                    input_path, is_temp, content_key = resolve_input_audio(
+                        options.input_audio_base64,
+                        options.input_audio_url,
+                    )
+                except Exception as exc:
+                    raise HTTPException(status_code=400, detail=f"Failed to load input audio: {exc}") from exc
                 if is_temp:
                     tmp_paths.append(input_path)
+                # decoded at most once, shared by Whisper and prompt analysis
+                input_audio = AudioContext.from_file(input_path)
                 audio_text = options.audio_text
                 if not audio_text:
                     if whisper_asr is None:
                         raise HTTPException(status_code=400, detail="audio_text is required when Whisper transcription is disabled.")
-                    audio_text = await loop.run_in_executor(None, whisper_asr, input_path)
+                    # Whisper reads the log-mel windows the vq06 tokenizer reuses, one STFT for both
+                    audio_text = await loop.run_in_executor(
+                        None,
+                        lambda: whisper_asr.transcribe_log_mels(app_engine.audio_tokenizer.context_log_mels(input_audio)),
+                    )
 
                 edit_text = request.input if options.mode == "paralinguistic" else None
 
-                async with lock:
+                if request.stream:
+                    # prompt preprocessing runs before the response starts, its errors get a status code
+                    audio_stream = await loop.run_in_executor(
+                        None,
+                        partial(
+                            app_engine.edit_stream,
+                            input_audio,
+                            audio_text,
+                            options.mode,
+                            options.edit_info,
+                            edit_text,
+                            speculative=options.speculative_decoding,
+                            draft_model=draft_engine,
+                            content_key=content_key,
+                        ),
+                    )
+                else:
                     audio_tensor, sr = await loop.run_in_executor(
                         None,
-                        app_engine.edit,
-                        input_path,
-                        audio_text,
-                        options.mode,
-                        options.edit_info,
-                        edit_text,
-                        options.intensity,
+                        partial(
+                            app_engine.edit,
+                            input_audio,
+                            audio_text,
+                            options.mode,
+                            options.edit_info,
+                            edit_text,
+                            speculative=options.speculative_decoding,
+                            draft_model=draft_engine,
+                            content_key=content_key,
+                            flow_solver=options.flow_solver,
+                            flow_steps=options.flow_steps,
+                        ),
                     )
 
-            audio_bytes, mime = audio_tensor_to_bytes(audio_tensor, sr, request.response_format)
+            if audio_stream is not None:
+                # raw 16-bit mono PCM at 24 kHz, one HTTP chunk per vocoder chunk;
+                # temp files are removed once the stream has been consumed
+                stream_paths, tmp_paths = tmp_paths, []
+                return StreamingResponse(
+                    (audio_tensor_to_pcm16(chunk) for chunk in audio_stream),
+                    media_type="audio/pcm",
+                    headers=headers | {"X-Sample-Rate": "24000"},
+                    background=BackgroundTask(_remove_paths, stream_paths),
+                )
 
-            headers = {}
-            if request.metadata:
-                headers.update({f"x-metadata-{k}": v for k, v in request.metadata.items()})
+            audio_bytes, mime = audio_tensor_to_bytes(audio_tensor, sr, request.response_format)
 
             return Response(
                 content=audio_bytes,
                 media_type=mime,
-                headers=headers | {"X-StepAudio-Model": request.model},
+                headers=headers,
             )
         except HTTPException:
             raise
+        except EngineHTTPException as exc:
+            raise HTTPException(status_code=exc.status_code, detail=exc.detail) from exc
+        except SessionLimitError as exc:
+            raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=str(exc)) from exc
+        except AudioDecodeError as exc:
+            # uploads are only decoded inside the engine, on a prompt artifact cache miss
+            raise HTTPException(status_code=400, detail=str(exc)) from exc
         except Exception as exc:
             raise HTTPException(status_code=500, detail=str(exc)) from exc
         finally:
-            for path in tmp_paths:
-                if os.path.exists(path):
-                    os.remove(path)
+            _remove_paths(tmp_paths)
 
     @app.post("/v1/audio/speech")
     async def create_speech(request: SpeechRequest):
@@ -250,6 +473,8 @@ def main():
         funasr_model_id=args.tokenizer_model_id,
     )
     model_engines: dict[str, StepAudioTTS] = {}
+    # one budget for all variants, entries are keyed per model
+    prefix_cache = PrefixKVCache(max_bytes=args.prefix_cache_mb * 1024 * 1024) if args.prefix_cache_mb > 0 else None
 
     model_engines["base"] = StepAudioTTS(
         str(tts_path),
@@ -259,6 +484,13 @@ def main():
         quantization_config=args.quantization,
         torch_dtype=torch_dtype,
         device_map=args.device_map,
+        max_batch_size=args.max_batch_size,
+        prefix_cache=prefix_cache,
+        constrained_decoding=args.constrained_decoding,
+        cfg_interval=args.cfg_interval,
+        max_stream_sessions=args.max_stream_sessions,
+        stream_session_timeout=args.stream_session_timeout,
+        vocoder_batch_size=args.vocoder_batch_size,
     )
 
     awq_path = Path(args.awq_model_path) if args.awq_model_path else base_dir / "Step-Audio-EditX-AWQ-4bit"
@@ -272,6 +504,13 @@ def main():
                 quantization_config="awq-4bit",
                 torch_dtype=torch_dtype,
                 device_map=args.device_map,
+                max_batch_size=args.max_batch_size,
+                prefix_cache=prefix_cache,
+                constrained_decoding=args.constrained_decoding,
+                cfg_interval=args.cfg_interval,
+                max_stream_sessions=args.max_stream_sessions,
+                stream_session_timeout=args.stream_session_timeout,
+                vocoder_batch_size=args.vocoder_batch_size,
             )
             logger.info(f"✓ AWQ quantized model loaded from {awq_path}")
         except Exception as exc:
@@ -290,6 +529,13 @@ def main():
                 quantization_config="int4",  # BitsAndBytes uses int4
                 torch_dtype=torch_dtype,
                 device_map=args.device_map,
+                max_batch_size=args.max_batch_size,
+                prefix_cache=prefix_cache,
+                constrained_decoding=args.constrained_decoding,
+                cfg_interval=args.cfg_interval,
+                max_stream_sessions=args.max_stream_sessions,
+                stream_session_timeout=args.stream_session_timeout,
+                vocoder_batch_size=args.vocoder_batch_size,
             )
             logger.info(f"✓ BitsAndBytes quantized model loaded from {bnb_path}")
         except Exception as exc:
@@ -300,7 +546,9 @@ def main():
     whisper_asr = WhisperWrapper() if args.enable_auto_transcribe else None
 
     asset_roots = [project_root, base_dir]
-    app = build_fastapi_app(model_engines, base_dir, asset_roots, whisper_asr)
+    voice_registry = VoiceRegistry(args.voice_dir)
+    precompute_voice_presets(voice_registry, model_engines["base"], asset_roots)
+    app = build_fastapi_app(model_engines, base_dir, asset_roots, whisper_asr, voice_registry)
     uvicorn.run(app, host=args.api_host, port=args.api_port)
 
 
@@ -426,8 +426,8 @@ class EditxTab:
                 text += f"   • 总请求数：{stats.get('total_requests', 0)} 次\n"
                 text += f"   • 命中率：{stats.get('hit_rate', '0.0%')}\n\n"
                 text += f"💾 缓存使用：\n"
-                text += f"   • 当前大小：{stats.get('cache_size', 0)} 项\n"
-                text += f"   • 最大容量：{stats.get('max_size', 0)} 项\n\n"
+                text += f"   • 当前大小：{stats.get('cache_size', 0)} 项（{stats.get('cache_bytes', 0) / 1024**2:.1f} MB）\n"
+                text += f"   • 最大容量：{stats.get('max_bytes', 0) / 1024**2:.0f} MB\n\n"
                 text += f"⏱️ 性能提升：\n"
                 text += f"   • 预估节省时间：{stats.get('time_saved_estimate', '0s')}\n"
                 text += f"   • 每次命中节省：~1.65s\n\n"
@@ -0,0 +1,150 @@
+"""
+Per-request audio context.
+
+A prompt / input clip is needed in several forms: mono for the speaker id, peak
+normalized for prompt analysis, 16 kHz for the tokenizers, the speaker
+embedding and Whisper, 24 kHz for the vocoder mel features. `AudioContext`
+decodes the clip once (lazily, so a request served from a cache never decodes)
+and memoizes every derived view; resampling goes through a process-wide cache
+of `torchaudio.transforms.Resample` kernels instead of rebuilding the sinc
+kernel on every call.
+"""
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+import torchaudio
+import torchaudio.compliance.kaldi as kaldi
+
+PROMPT_PEAK = 0.6  # prompt clips are scaled down to this peak to avoid clipping
+
+_resamplers: Dict[Tuple[int, int], torchaudio.transforms.Resample] = {}
+_resamplers_lock = threading.Lock()
+
+
+class AudioDecodeError(ValueError):
+    """The clip could not be decoded (corrupt upload, unsupported format)"""
+
+
+def get_resampler(orig_freq: int, new_freq: int) -> torchaudio.transforms.Resample:
+    """Shared resampler whose sinc kernel is computed once per rate pair"""
+    key = (int(orig_freq), int(new_freq))
+    resampler = _resamplers.get(key)
+    if resampler is None:
+        with _resamplers_lock:
+            resampler = _resamplers.get(key)
+            if resampler is None:
+                resampler = torchaudio.transforms.Resample(orig_freq=key[0], new_freq=key[1])
+                _resamplers[key] = resampler
+    return resampler
+
+
+def resample(waveform: torch.Tensor, orig_freq: int, new_freq: int) -> torch.Tensor:
+    """Resample with a cached kernel; matches `torchaudio.functional.resample` up to float rounding"""
+    if orig_freq == new_freq:
+        return waveform
+    return get_resampler(orig_freq, new_freq)(waveform)
+
+
+class AudioContext:
+    """
+    One decoded clip and its memoized derived views
+
+    Views are computed on first use and are safe to request from several
+    threads; each view is computed once.
+    """
+
+    def __init__(self, waveform: Optional[torch.Tensor] = None, sample_rate: Optional[int] = None, path: Optional[str] = None):
+        """
+        Initialize AudioContext
+
+        Args:
+            waveform: (C, N) float waveform, or None to decode `path` on first use
+            sample_rate: Sample rate of `waveform`
+            path: Audio file to decode when `waveform` is not given
+        """
+        if waveform is None and path is None:
+            raise ValueError("AudioContext needs a waveform or a path")
+        self.path = path
+        self._waveform = waveform
+        self._sample_rate = sample_rate
+        self._views = {}
+        self._locks: Dict[object, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str) -> "AudioContext":
+        """Context decoding `path` lazily"""
+        return cls(path=path)
+
+    @classmethod
+    def wrap(cls, audio) -> "AudioContext":
+        """Return `audio` if it already is a context, else a lazy context over the path"""
+        return audio if isinstance(audio, AudioContext) else cls.from_file(audio)
+
+    def derive(self, key, compute: Callable[[], object]):
+        """Memoize `compute()` under `key`; consumers add their own views this way"""
+        view = self._views.get(key)
+        if view is not None:
+            return view
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            view = self._views.get(key)
+            if view is None:
+                view = compute()
+                self._views[key] = view
+            return view
+
+    def _decode(self):
+        if self._waveform is None:
+            try:
+                self._waveform, self._sample_rate = torchaudio.load(self.path)
+            except Exception as exc:
+                raise AudioDecodeError(f"Failed to decode audio: {exc}") from exc
+        return self._waveform, self._sample_rate
+
+    @property
+    def raw(self) -> torch.Tensor:
+        """Decoded (C, N) waveform"""
+        return self.derive("raw", self._decode)[0]
+
+    @property
+    def sample_rate(self) -> int:
+        return self.derive("raw", self._decode)[1]
+
+    def mono(self) -> torch.Tensor:
+        """(1, N) channel average"""
+        def compute():
+            wav = self.raw
+            return wav.mean(dim=0, keepdim=True) if wav.shape[0] > 1 else wav
+        return self.derive("mono", compute)
+
+    def normalized(self) -> torch.Tensor:
+        """Mono clip scaled down to a peak of `PROMPT_PEAK` if louder"""
+        def compute():
+            wav = self.mono()
+            norm = torch.max(torch.abs(wav), dim=1, keepdim=True)[0]
+            return wav / norm * PROMPT_PEAK if norm > PROMPT_PEAK else wav
+        return self.derive("normalized", compute)
+
+    def resampled(self, sample_rate: int, normalized: bool = True) -> torch.Tensor:
+        """(1, N') mono clip at `sample_rate`, peak normalized unless `normalized=False`"""
+        def compute():
+            wav = self.normalized() if normalized else self.mono()
+            return resample(wav, self.sample_rate, sample_rate)
+        return self.derive(("resampled", sample_rate, normalized), compute)
+
+    def fbank(self, num_mel_bins: int = 80) -> torch.Tensor:
+        """Mean-normalized kaldi fbank of the normalized 16 kHz clip (speaker embedding input)"""
+        def compute():
+            feat = kaldi.fbank(self.resampled(16000), num_mel_bins=num_mel_bins, dither=0, sample_frequency=16000)
+            return feat - feat.mean(dim=0, keepdim=True)
+        return self.derive(("fbank", num_mel_bins), compute)
+
+    def log_mel(self, n_mels: int = 128, normalized: bool = False) -> torch.Tensor:
+        """Whisper log-mel spectrogram (n_mels, frames) of the 16 kHz clip"""
+        def compute():
+            import whisper
+            return whisper.log_mel_spectrogram(self.resampled(16000, normalized=normalized)[0], n_mels=n_mels)
+        return self.derive(("log_mel", n_mels, normalized), compute)
@@ -0,0 +1,170 @@
+"""
+Audio-grammar-constrained decoding.
+
+Generated audio is always interleaved as 2 vq02 tokens (ids 65536 + code)
+followed by 3 vq06 tokens (ids 65536 + 1024 + code), the layout produced by
+`StepAudioTokenizer.merge_vq0206_to_token_str` and expected by the vocoder.
+Knowing the position inside the 2+3 group, only one codebook (plus EOS at a
+group boundary) can follow, so the lm_head only needs to be evaluated on
+those rows instead of the full text+audio vocabulary.
+"""
+import logging
+from typing import List
+
+import torch
+from transformers.generation.logits_process import LogitsProcessor
+
+logger = logging.getLogger(__name__)
+
+AUDIO_TOKEN_OFFSET = 65536
+VQ02_CODEBOOK_SIZE = 1024
+VQ06_CODEBOOK_SIZE = 4096
+GROUP_PATTERN = (0, 0, 1, 1, 1)  # 0 -> vq02, 1 -> vq06
+
+
+def allowed_token_ids(
+    phase: int,
+    eos_token_ids: List[int],
+    audio_offset: int = AUDIO_TOKEN_OFFSET,
+    vq02_size: int = VQ02_CODEBOOK_SIZE,
+    vq06_size: int = VQ06_CODEBOOK_SIZE,
+) -> torch.LongTensor:
+    """
+    Token ids allowed at a position of the 2+3 group
+
+    Args:
+        phase: Number of generated tokens modulo 5
+        eos_token_ids: EOS ids, only allowed at a group boundary
+        audio_offset: Id of the first vq02 token
+        vq02_size: Number of vq02 codes
+        vq06_size: Number of vq06 codes
+
+    Returns:
+        torch.LongTensor: Allowed token ids
+    """
+    if GROUP_PATTERN[phase] == 0:
+        ids = torch.arange(audio_offset, audio_offset + vq02_size)
+        if phase == 0:
+            ids = torch.cat([ids, torch.tensor(eos_token_ids, dtype=torch.long)])
+        return ids
+    start = audio_offset + vq02_size
+    return torch.arange(start, start + vq06_size)
+
+
+class AudioGrammar:
+    """
+    Project hidden states onto the codebook rows that are valid next
+
+    The lm_head rows for vq02(+EOS) and vq06 are gathered once; each decode step
+    then costs a (B, H) x (H, ~1k/4k) matmul instead of (B, H) x (H, vocab).
+    Logits are returned scattered into a full-vocabulary tensor filled with -inf,
+    so existing logits processors and the sampling distribution over the allowed
+    tokens are unchanged.
+    """
+
+    def __init__(
+        self,
+        model,
+        eos_token_ids: List[int],
+        audio_offset: int = AUDIO_TOKEN_OFFSET,
+        vq02_size: int = VQ02_CODEBOOK_SIZE,
+        vq06_size: int = VQ06_CODEBOOK_SIZE,
+    ):
+        """
+        Initialize AudioGrammar
+
+        Args:
+            model: HuggingFace causal LM with `get_output_embeddings()`
+            eos_token_ids: EOS token ids
+            audio_offset: Id of the first vq02 token
+            vq02_size: Number of vq02 codes
+            vq06_size: Number of vq06 codes
+        """
+        self.model = model
+        self.body = getattr(model, model.base_model_prefix)
+        self.head = model.get_output_embeddings()
+        self.eos_token_ids = list(eos_token_ids)
+        self.vocab_size = self.head.weight.shape[0]
+        device = self.head.weight.device
+
+        # phase 0 shares the vq02(+EOS) slice with phase 1, EOS is masked for phase 1
+        layout = (audio_offset, vq02_size, vq06_size)
+        self.vq02_ids = allowed_token_ids(0, self.eos_token_ids, *layout).to(device)
+        self.vq06_ids = allowed_token_ids(2, self.eos_token_ids, *layout).to(device)
+        self.num_eos = len(self.eos_token_ids)
+
+        self.sliced = self.head.weight.dtype.is_floating_point
+        if self.sliced:
+            self.vq02_weight, self.vq02_bias = self._gather(self.vq02_ids)
+            self.vq06_weight, self.vq06_bias = self._gather(self.vq06_ids)
+        else:
+            logger.warning("lm_head is quantized, audio grammar falls back to masking full logits")
+
+    def _gather(self, ids: torch.LongTensor):
+        weight = self.head.weight.detach().index_select(0, ids).contiguous()
+        bias = self.head.bias.detach().index_select(0, ids) if self.head.bias is not None else None
+        return weight, bias
+
+    @staticmethod
+    def phase(num_generated: int) -> int:
+        return num_generated % len(GROUP_PATTERN)
+
+    def logits(self, hidden: torch.Tensor, phases: List[int]) -> torch.FloatTensor:
+        """
+        Compute next-token logits restricted to the grammar
+
+        Args:
+            hidden: (B, H) last hidden state of every row
+            phases: Position inside the 2+3 group for every row
+
+        Returns:
+            torch.FloatTensor: (B, vocab) float32 logits, -inf outside allowed tokens
+        """
+        out = torch.full(
+            (hidden.shape[0], self.vocab_size), float("-inf"), dtype=torch.float32, device=hidden.device
+        )
+        for codebook, ids in ((0, self.vq02_ids), (1, self.vq06_ids)):
+            rows = [i for i, p in enumerate(phases) if GROUP_PATTERN[p] == codebook]
+            if not rows:
+                continue
+            index = torch.tensor(rows, dtype=torch.long, device=hidden.device)
+            h = hidden.index_select(0, index)
+            if self.sliced:
+                if codebook == 0:
+                    weight, bias = self.vq02_weight, self.vq02_bias
+                else:
+                    weight, bias = self.vq06_weight, self.vq06_bias
+                sub = torch.nn.functional.linear(h.to(weight.dtype), weight, bias).float()
+            else:
+                sub = self.head(h).float().index_select(1, ids)
+            if codebook == 0 and self.num_eos:
+                # EOS only at a group boundary
+                not_boundary = torch.tensor(
+                    [phases[i] != 0 for i in rows], dtype=torch.bool, device=hidden.device
+                )
+                sub[not_boundary, -self.num_eos:] = float("-inf")
+            out[index.unsqueeze(1), ids.unsqueeze(0)] = sub
+        return out
+
+
+class AudioGrammarLogitsProcessor(LogitsProcessor):
+    """Mask logits outside the 2+3 audio grammar (for plain `generate`)"""
+
+    def __init__(self, prompt_len: int, eos_token_ids: List[int], **layout):
+        self.prompt_len = prompt_len
+        self.eos_token_ids = list(eos_token_ids)
+        self.layout = layout
+        self._masks = {}
+
+    def _mask(self, phase: int, scores: torch.FloatTensor) -> torch.BoolTensor:
+        if phase not in self._masks:
+            mask = torch.ones(scores.shape[-1], dtype=torch.bool, device=scores.device)
+            mask[allowed_token_ids(phase, self.eos_token_ids, **self.layout).to(scores.device)] = False
+            self._masks[phase] = mask
+        return self._masks[phase]
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        phase = AudioGrammar.phase(input_ids.shape[1] - self.prompt_len)
+        return scores.masked_fill(self._mask(phase, scores), float("-inf"))
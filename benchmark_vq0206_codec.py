@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+比较 vq02/vq06 交织编解码的旧列表实现与 `vq0206_codec` 的向量化实现
+
+默认使用 10 分钟音频对应的码流：vq02 约 16.7 Hz、vq06 25 Hz，
+即 10000 个 vq02 码、15000 个 vq06 码，交织后 25000 个 token。
+分别测量 tokenizer 的交织（store_tokens / merge_vq0206_to_token_str）
+和声码器的解交织（_reshape），报告每次调用的最短耗时。
+
+用法:
+    python benchmark_vq0206_codec.py --minutes 10 --repeat 5
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from stepvocoder.cosyvoice2.utils import vq0206_codec
+from test_vq0206_codec import legacy_merge, legacy_reshape, legacy_store_tokens
+
+VQ06_HZ = 25
+
+
+def best_of(fn, repeat: int) -> float:
+    """`repeat` 次调用中的最短耗时（秒）"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=10.0, help="音频时长（分钟）")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数，取最短耗时")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    groups = int(args.minutes * 60 * VQ06_HZ) // 3
+    vq02 = [rng.randrange(1024) for _ in range(groups * 2)]
+    vq06 = [rng.randrange(4096) for _ in range(groups * 3)]
+    mix = vq0206_codec.interleave(vq02, vq06).tolist()
+    print(f"{args.minutes:g} min: {len(vq02)} vq02 + {len(vq06)} vq06 codes, {len(mix)} mixed tokens")
+
+    def codec_merge():
+        return "".join([f"<audio_{x}>" for x in vq0206_codec.interleave(vq02, vq06).tolist()])
+
+    cases = [
+        ("store_tokens", lambda: legacy_store_tokens(vq02, vq06),
+         lambda: vq0206_codec.interleave(vq02, vq06, offset=65536).tolist()),
+        ("merge_vq0206_to_token_str", lambda: legacy_merge(vq02, vq06), codec_merge),
+        # the legacy version pads its input in place, hand it a copy
+        ("_reshape", lambda: legacy_reshape(list(mix)), lambda: vq0206_codec.deinterleave_to_vq0206(mix)),
+    ]
+    print(f"{'call site':<28}{'legacy (ms)':>14}{'codec (ms)':>14}{'speedup':>10}")
+    for name, legacy, codec in cases:
+        want, got = legacy(), codec()
+        assert torch.equal(want, got) if isinstance(got, torch.Tensor) else want == got, name
+        legacy_time, codec_time = best_of(legacy, args.repeat), best_of(codec, args.repeat)
+        print(f"{name:<28}{legacy_time * 1e3:>14.2f}{codec_time * 1e3:>14.2f}{legacy_time / codec_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+离线比较 flow-matching 解码器的 ODE 求解器：mel 距离 vs NFE
+
+每个音色（voice registry 中的 .voice 文件）的音频 token 被切成两半：
+前半作为 prompt，后半作为待合成 token。固定随机种子后，先用
+`--reference` 指定的高步数求解得到参考 mel，再对每个求解器配置
+报告与参考 mel 的平均 L1 距离、DiT 调用次数（NFE）和耗时。
+
+用法:
+    python compare_flow_solvers.py --model-dir /model/Step-Audio-EditX/CosyVoice-300M-25Hz \\
+        --voice-dir voices --configs euler:10 euler:5 heun:5 midpoint:5 multistep:5 adaptive:5
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+
+from stepvocoder.cosyvoice2.cli.cosyvoice import CosyVoice
+from stepvocoder.cosyvoice2.flow.ode_solvers import get_solver
+from voice_registry import load_voice
+
+
+def parse_config(text: str):
+    """'heun:5' -> ('heun', 5)"""
+    name, _, steps = text.partition(":")
+    get_solver(name)
+    return name, int(steps or 10)
+
+
+def split_voice(voice):
+    """按 2+3 分组把音色 token 切成 prompt / target 两半，并截取对应的 prompt mel"""
+    codes = torch.as_tensor(voice.vq0206_codes, dtype=torch.long) - 65536
+    groups = len(codes) // 5
+    half = groups // 2
+    prompt_token, token = codes[: half * 5], codes[half * 5 : groups * 5]
+    # prompt mel covers the whole clip; keep the share of the prompt half
+    feat = torch.as_tensor(voice.speech_feat, dtype=torch.float32)
+    prompt_feat = feat[:, : feat.shape[1] * half // max(groups, 1)]
+    return token.unsqueeze(0), prompt_token.unsqueeze(0), prompt_feat, torch.as_tensor(voice.speech_embedding)
+
+
+def decode_mel(impl, item, solver: str, n_timesteps: int) -> torch.Tensor:
+    token, prompt_token, prompt_feat, embedding = item
+    token, prompt_token, prompt_feat = impl._prepare_nonstream(token, prompt_token, prompt_feat)
+    (mel,) = impl.flow.inference_batch(
+        token.to(impl.device),
+        torch.tensor([token.shape[1]], device=impl.device),
+        prompt_token.to(impl.device),
+        torch.tensor([prompt_token.shape[1]], device=impl.device),
+        prompt_feat.to(impl.device, impl.dtype),
+        torch.tensor([prompt_feat.shape[1]], device=impl.device),
+        embedding.reshape(1, -1).to(impl.device, impl.dtype),
+        n_timesteps,
+        solver,
+    )
+    return mel.float().cpu()
+
+
+def count_nfe(impl, fn):
+    """统计一次求解中 DiT 的实际调用次数（adaptive 求解器的 NFE 依赖输入）"""
+    estimator = impl.flow.decoder.estimator
+    calls = [0]
+    handle = estimator.register_forward_pre_hook(lambda *_: calls.__setitem__(0, calls[0] + 1))
+    try:
+        result = fn()
+    finally:
+        handle.remove()
+    return result, calls[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare flow-matching ODE solvers on fixed seeds")
+    parser.add_argument("--model-dir", required=True, help="CosyVoice-300M-25Hz directory")
+    parser.add_argument("--voice-dir", required=True, help="Voice registry directory with *.voice files")
+    parser.add_argument("--configs", nargs="+", default=[
+        "euler:10", "euler:5", "midpoint:5", "heun:5", "multistep:10", "multistep:5", "adaptive:5",
+    ], help="solver:steps pairs")
+    parser.add_argument("--reference", default="heun:32", help="solver:steps used as ground truth")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--max-voices", type=int, default=8)
+    args = parser.parse_args()
+
+    configs = [parse_config(c) for c in args.configs]
+    reference = parse_config(args.reference)
+    voices = sorted(Path(args.voice_dir).glob("*.voice"))[: args.max_voices]
+    if not voices:
+        raise SystemExit(f"no .voice files in {args.voice_dir}")
+    items = [split_voice(load_voice(path)) for path in voices]
+
+    model = CosyVoice(args.model_dir, enable_cuda_graph=False)
+    impl = model.cosy_impl
+    decoder = impl.flow.decoder
+
+    totals = {config: {"dist": 0.0, "nfe": 0, "time": 0.0} for config in configs}
+    runs = 0
+    for seed in args.seeds:
+        # fixed noise per seed, shared by every solver
+        generator = torch.Generator().manual_seed(seed)
+        decoder.rand_noise.copy_(torch.randn(decoder.rand_noise.shape, generator=generator))
+        for item in items:
+            ref = decode_mel(impl, item, *reference)
+            for config in configs:
+                start = time.perf_counter()
+                mel, nfe = count_nfe(impl, lambda: decode_mel(impl, item, *config))
+                elapsed = time.perf_counter() - start
+                totals[config]["dist"] += (mel - ref).abs().mean().item()
+                totals[config]["nfe"] += nfe
+                totals[config]["time"] += elapsed
+            runs += 1
+
+    print(f"\n参考: {reference[0]}:{reference[1]}, {len(items)} 个音色 x {len(args.seeds)} 个种子")
+    print(f"{'solver':<12}{'steps':>6}{'NFE':>8}{'mel L1':>10}{'ms':>10}")
+    for (name, steps), total in totals.items():
+        print(
+            f"{name:<12}{steps:>6}{total['nfe'] / runs:>8.1f}"
+            f"{total['dist'] / runs:>10.4f}{total['time'] / runs * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -542,13 +542,24 @@ class AutoModel:
     def infer_encoder(
         self, input, input_len=None, model=None, kwargs=None, key=None, **cfg
     ):
-        kwargs = self.kwargs if kwargs is None else kwargs
+        """
+        Run only the encoder.
+
+        `input` may be a path / url / BytesIO, or a list of 1-D float tensors
+        (or ndarrays) of samples at the model rate, which skips decoding.
+        Without a `cache` argument each batch starts from a fresh encoder
+        cache, so a list of whole clips is encoded offline in one call.
+        """
+        # per-call options (data_type, cache, ...) must not leak into later calls
+        kwargs = dict(self.kwargs if kwargs is None else kwargs)
         kwargs.update(cfg)
         model = self.model if model is None else model
         model = model.cuda()
         model.eval()
 
         batch_size = kwargs.get("batch_size", 1)
+        # without a caller-owned streaming `cache` every batch is its own utterance
+        fresh_cache = "cache" not in kwargs
 
         key_list, data_list = prepare_data_iterator(
             input, input_len=input_len, data_type=kwargs.get("data_type", None), key=key
@@ -566,6 +577,8 @@ class AutoModel:
             ) == "fbank":  # fbank
                 batch["data_in"] = data_batch[0]
                 batch["data_lengths"] = input_len
+            if fresh_cache:
+                kwargs["cache"] = {}
 
             with torch.no_grad():
                 results, meta_data, cache = model.infer_encoder(**batch, **kwargs)
@@ -0,0 +1,415 @@
+"""
+Continuous-batching generation scheduler for StepAudioTTS.
+
+Instead of running one `llm.generate` per request behind a global lock, every
+request is submitted to a single background decode loop. New sequences are
+prefilled and admitted into the running batch at token boundaries, finished
+sequences are retired immediately, and each sequence keeps its own logits
+processors, so concurrent clone/edit requests share one forward pass per step.
+"""
+import collections
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from transformers.generation.logits_process import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def to_legacy_cache(past_key_values) -> List[List[torch.Tensor]]:
+    """Convert a model's `past_key_values` into a mutable per-layer [key, value] list."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return [[layer[0], layer[1]] for layer in past_key_values]
+
+
+def from_legacy_cache(layers: List[List[torch.Tensor]]) -> DynamicCache:
+    """Build a `DynamicCache` from a per-layer [key, value] list."""
+    return DynamicCache.from_legacy_cache(tuple((k, v) for k, v in layers))
+
+
+def sampling_warpers(temperature: Optional[float], top_k: Optional[int], top_p: Optional[float]) -> list:
+    """Temperature / top-k / top-p warpers applied after the custom logits processors."""
+    warpers = []
+    if temperature is not None and temperature != 1.0:
+        warpers.append(TemperatureLogitsWarper(temperature))
+    if top_k is not None and top_k != 0:
+        warpers.append(TopKLogitsWarper(top_k=top_k))
+    if top_p is not None and top_p < 1.0:
+        warpers.append(TopPLogitsWarper(top_p=top_p))
+    return warpers
+
+
+@dataclass
+class _Sequence:
+    """Per-request decoding state."""
+
+    request_id: int
+    input_ids: torch.LongTensor  # (1, L) prompt + generated tokens
+    prompt_len: int
+    max_length: int
+    prefix_len: int
+    do_sample: bool
+    logits_processor: LogitsProcessorList
+    on_token: Optional[Callable[[int], bool]]
+    future: Future
+    submit_time: float
+
+
+class GenerationScheduler:
+    """
+    In-process continuous-batching scheduler around a HuggingFace causal LM.
+
+    The running batch keeps one left-padded KV cache plus a 2D attention mask.
+    A newly admitted sequence is prefilled on its own and then concatenated into
+    the batch (left-padding whichever side is shorter); a finished sequence is
+    dropped from the batch with `index_select` and fully padded leading columns
+    are trimmed. Per-row position ids are derived from the attention mask, so
+    padding never shifts a sequence's positions.
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_size: int = 8,
+        eos_token_id=None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        prefix_cache=None,
+        grammar=None,
+    ):
+        """
+        Initialize GenerationScheduler
+
+        Args:
+            model: HuggingFace causal LM (already placed on its device)
+            max_batch_size: Maximum number of sequences decoded together
+            eos_token_id: EOS token id or list of ids (default: model.generation_config)
+            top_k: Top-k used when sampling (default: model.generation_config)
+            top_p: Top-p used when sampling (default: model.generation_config)
+            prefix_cache: Optional PrefixKVCache consulted when prefilling a prompt prefix
+            grammar: Optional AudioGrammar; when set, next-token logits are computed
+                only over the audio codebook rows that are valid at each position
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be >= 1, got {max_batch_size}")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.grammar = grammar
+
+        generation_config = getattr(model, "generation_config", None)
+        if eos_token_id is None and generation_config is not None:
+            eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            raise ValueError("eos_token_id must be provided when the model has no generation_config")
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = set(int(x) for x in eos_token_id)
+        self.top_k = top_k if top_k is not None else getattr(generation_config, "top_k", None)
+        self.top_p = top_p if top_p is not None else getattr(generation_config, "top_p", None)
+
+        self._waiting = collections.deque()
+        self._running: List[_Sequence] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._worker = None
+        self._ids = itertools.count()
+
+        # running batch state, only touched by the worker thread
+        self._layers: Optional[List[List[torch.Tensor]]] = None
+        self._attention_mask: Optional[torch.LongTensor] = None
+        self._next_tokens: Optional[torch.LongTensor] = None
+
+        # statistics
+        self.completed = 0
+        self.decode_steps = 0
+        self.decoded_rows = 0
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def submit(
+        self,
+        input_ids: List[int],
+        max_length: int = 8192,
+        temperature: float = 0.7,
+        do_sample: bool = True,
+        logits_processor_factory: Optional[Callable[[], LogitsProcessorList]] = None,
+        prefix_len: int = 0,
+        on_token: Optional[Callable[[int], bool]] = None,
+    ) -> Future:
+        """
+        Queue a prompt for generation
+
+        Args:
+            input_ids: Prompt token ids
+            max_length: Maximum total length (prompt + generated), as in `generate`
+            temperature: Sampling temperature
+            do_sample: Sample if True, greedy otherwise
+            logits_processor_factory: Builds a fresh processor list for this sequence
+            prefix_len: Number of leading prompt tokens to serve from the prefix cache
+            on_token: Called from the worker with every new token id; returning False
+                stops the sequence early (e.g. when a streaming client disconnects)
+
+        Returns:
+            Future resolving to a (1, L) LongTensor laid out like `generate` output
+        """
+        processors = LogitsProcessorList(logits_processor_factory() if logits_processor_factory else [])
+        if do_sample:
+            processors.extend(sampling_warpers(temperature, self.top_k, self.top_p))
+
+        seq = _Sequence(
+            request_id=next(self._ids),
+            input_ids=torch.tensor([input_ids], dtype=torch.long, device=self.device),
+            prompt_len=len(input_ids),
+            max_length=max_length,
+            prefix_len=prefix_len if prefix_len < len(input_ids) else 0,
+            do_sample=do_sample,
+            logits_processor=processors,
+            on_token=on_token,
+            future=Future(),
+            submit_time=time.time(),
+        )
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("GenerationScheduler has been shut down")
+            self._waiting.append(seq)
+            self._ensure_worker()
+            self._cond.notify()
+        return seq.future
+
+    def generate(self, input_ids: List[int], **kwargs) -> torch.LongTensor:
+        """Blocking wrapper around `submit`."""
+        return self.submit(input_ids, **kwargs).result()
+
+    def shutdown(self):
+        """Stop the worker thread and fail any request that has not finished."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None and worker.is_alive():
+            # the worker fails what is left once its current step returns
+            worker.join(timeout=5)
+            return
+        self._fail_all(RuntimeError("GenerationScheduler has been shut down"))
+
+    def get_stats(self):
+        """Return scheduler statistics"""
+        return {
+            "max_batch_size": self.max_batch_size,
+            "running": len(self._running),
+            "waiting": len(self._waiting),
+            "completed": self.completed,
+            "decode_steps": self.decode_steps,
+            "avg_batch_size": self.decoded_rows / self.decode_steps if self.decode_steps else 0.0,
+        }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(
+                target=self._loop, daemon=True, name="GenerationScheduler"
+            )
+            self._worker.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._waiting and not self._running and not self._stopped:
+                    self._cond.wait()
+                stopped = self._stopped
+                admitted = []
+                while not stopped and self._waiting and len(self._running) + len(admitted) < self.max_batch_size:
+                    seq = self._waiting.popleft()
+                    if seq.future.set_running_or_notify_cancel():
+                        admitted.append(seq)
+            if stopped:
+                self._fail_all(RuntimeError("GenerationScheduler has been shut down"))
+                return
+
+            with torch.inference_mode():
+                for seq in admitted:
+                    try:
+                        self._prefill(seq)
+                    except Exception as exc:
+                        # the batch is only touched once prefill succeeded, the other rows go on
+                        logger.error(f"Prefill of sequence {seq.request_id} failed: {exc}")
+                        self._fail([seq], exc)
+                if self._running:
+                    try:
+                        self._decode_step()
+                    except Exception as exc:
+                        # the batch cache is lost, queued requests start a new one next iteration
+                        logger.error(f"Decode step failed: {exc}")
+                        self._fail_running(exc)
+
+    def _sample(self, seq: _Sequence, logits: torch.Tensor) -> torch.LongTensor:
+        scores = seq.logits_processor(seq.input_ids, logits)
+        if seq.do_sample:
+            probs = torch.softmax(scores, dim=-1)
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        return torch.argmax(scores, dim=-1)
+
+    def _append(self, seq: _Sequence, token: torch.LongTensor) -> bool:
+        """Append a sampled token, returns True when the sequence is finished."""
+        seq.input_ids = torch.cat([seq.input_ids, token[:, None]], dim=1)
+        token = int(token)
+        if seq.on_token is not None and seq.on_token(token) is False:
+            return True
+        return token in self.eos_token_ids or seq.input_ids.shape[1] >= seq.max_length
+
+    def _finish(self, seq: _Sequence):
+        self.completed += 1
+        logger.debug(
+            f"Sequence {seq.request_id} finished: {seq.input_ids.shape[1]} tokens "
+            f"in {time.time() - seq.submit_time:.2f}s"
+        )
+        seq.future.set_result(seq.input_ids.cpu())
+
+    def _forward(self, seqs: List[_Sequence], **kwargs):
+        """
+        Run one forward pass, returns float32 last-position logits and the new cache
+
+        With a grammar only the transformer body runs; the lm_head is applied to
+        the rows of the codebook each sequence is allowed to emit next.
+        """
+        if self.grammar is None:
+            outputs = self.model(**kwargs)
+            logits = outputs.logits[:, -1, :].to(copy=True, dtype=torch.float32)
+            return logits, outputs.past_key_values
+        outputs = self.grammar.body(**kwargs)
+        phases = [self.grammar.phase(seq.input_ids.shape[1] - seq.prompt_len) for seq in seqs]
+        logits = self.grammar.logits(outputs.last_hidden_state[:, -1, :], phases)
+        return logits, outputs.past_key_values
+
+    def _prefill(self, seq: _Sequence):
+        if self.prefix_cache is not None and seq.prefix_len > 0:
+            past_key_values = self.prefix_cache.get_or_build(
+                self.model, seq.input_ids[:, : seq.prefix_len]
+            )
+            logits, past_key_values = self._forward(
+                [seq],
+                input_ids=seq.input_ids[:, seq.prefix_len :],
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        else:
+            logits, past_key_values = self._forward([seq], input_ids=seq.input_ids, use_cache=True)
+        token = self._sample(seq, logits)
+        if self._append(seq, token):
+            self._finish(seq)
+            return
+
+        layers = to_legacy_cache(past_key_values)
+        mask = torch.ones(1, seq.input_ids.shape[1] - 1, dtype=torch.long, device=self.device)
+        if self._layers is not None:
+            # build the merged state first so a failure here leaves the running batch intact
+            length = max(self._attention_mask.shape[1], mask.shape[1])
+            old_layers, old_mask = self._left_pad(self._layers, self._attention_mask, length)
+            new_layers, new_mask = self._left_pad(layers, mask, length)
+            layers = [
+                [torch.cat([ok, nk], dim=0), torch.cat([ov, nv], dim=0)]
+                for (ok, ov), (nk, nv) in zip(old_layers, new_layers)
+            ]
+            mask = torch.cat([old_mask, new_mask], dim=0)
+            token = torch.cat([self._next_tokens, token], dim=0)
+        self._layers, self._attention_mask, self._next_tokens = layers, mask, token
+        self._running.append(seq)
+
+    def _decode_step(self):
+        attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+        logits, past_key_values = self._forward(
+            self._running,
+            input_ids=self._next_tokens[:, None],
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(self._layers),
+            use_cache=True,
+        )
+        self._layers = to_legacy_cache(past_key_values)
+        self._attention_mask = attention_mask
+        self.decode_steps += 1
+        self.decoded_rows += len(self._running)
+
+        next_tokens = []
+        keep = []
+        for idx, seq in enumerate(self._running):
+            try:
+                token = self._sample(seq, logits[idx : idx + 1])
+                finished = self._append(seq, token)
+            except Exception as exc:
+                # e.g. a raising logits processor or on_token callback: retire only this row
+                logger.error(f"Sequence {seq.request_id} failed: {exc}")
+                self._fail([seq], exc)
+                next_tokens.append(self._next_tokens[idx : idx + 1])
+                continue
+            next_tokens.append(token)
+            if finished:
+                self._finish(seq)
+            else:
+                keep.append(idx)
+        self._next_tokens = torch.cat(next_tokens, dim=0)
+
+        if len(keep) < len(self._running):
+            self._retire(keep)
+
+    def _retire(self, keep: List[int]):
+        self._running = [self._running[i] for i in keep]
+        if not keep:
+            self._layers = self._attention_mask = self._next_tokens = None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = self._attention_mask.index_select(0, index)
+        # drop leading columns that are padding for every remaining row
+        lead = int((mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        self._attention_mask = mask[:, lead:]
+        self._layers = [
+            [k.index_select(0, index)[:, :, lead:], v.index_select(0, index)[:, :, lead:]]
+            for k, v in self._layers
+        ]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+
+    @staticmethod
+    def _left_pad(layers, mask, length):
+        pad = length - mask.shape[1]
+        if pad == 0:
+            return layers, mask
+        layers = [[F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))] for k, v in layers]
+        return layers, F.pad(mask, (pad, 0))
+
+    @staticmethod
+    def _fail(seqs: List[_Sequence], exc: Exception):
+        for seq in seqs:
+            if not seq.future.done():
+                seq.future.set_exception(exc)
+
+    def _fail_running(self, exc: Exception):
+        """Fail the running batch and drop its cache, queued requests stay queued."""
+        running, self._running = self._running, []
+        self._layers = self._attention_mask = self._next_tokens = None
+        self._fail(running, exc)
+
+    def _fail_all(self, exc: Exception):
+        """Fail running and queued requests, called from the worker (or once no worker is left)."""
+        with self._cond:
+            pending = list(self._waiting)
+            self._waiting.clear()
+        self._fail_running(exc)
+        self._fail(pending, exc)
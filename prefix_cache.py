@@ -0,0 +1,142 @@
+"""
+Prefix KV-cache for StepAudioTTS prompts.
+
+Clone prompts put the speaker id, prompt text and the full `<audio_N>` prompt
+token string into the system turn, so every request for the same voice
+re-prefills thousands of identical tokens. This cache keys on the token-id
+prefix (the system turn up to its closing `[3]`), keeps the prefilled
+`past_key_values`, and lets generation prefill only the human/assistant suffix.
+One cache (and byte budget) can be shared by several models, entries are keyed
+per model.
+"""
+import hashlib
+import itertools
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from generation_scheduler import from_legacy_cache, to_legacy_cache
+
+logger = logging.getLogger(__name__)
+
+
+def system_prefix_len(token_ids: List[int], end_token_id: int = 3) -> int:
+    """Length of the system turn `[1, 4, ...system..., 3]` at the start of a prompt."""
+    try:
+        return token_ids.index(end_token_id) + 1
+    except ValueError:
+        return 0
+
+
+class PrefixKVCache:
+    """
+    Byte-bounded LRU cache of prefilled key/value states
+
+    Stored tensors are never written to: a `DynamicCache` built from them
+    appends new states with `torch.cat`, so every caller can share the same
+    prefix tensors without copying.
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3):
+        """
+        Initialize PrefixKVCache
+
+        Args:
+            max_bytes: Upper bound on the total size of cached key/value tensors
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # {key: (layers, nbytes)}
+        self._lock = threading.Lock()
+        self._model_tags = weakref.WeakKeyDictionary()  # {model: tag}, tags are never reused
+        self._next_tag = itertools.count()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, model, prefix_ids) -> str:
+        """Hash a token-id prefix, namespaced by the model that prefills it"""
+        if isinstance(prefix_ids, torch.Tensor):
+            prefix_ids = prefix_ids.flatten().tolist()
+        with self._lock:
+            tag = self._model_tags.get(model)
+            if tag is None:
+                tag = self._model_tags[model] = next(self._next_tag)
+        digest = hashlib.blake2b(np.asarray(prefix_ids, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+        return f"{tag}:{digest}"
+
+    @staticmethod
+    def _nbytes(layers) -> int:
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+    def get(self, key: str) -> Optional[List[List[torch.Tensor]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, layers: List[List[torch.Tensor]]):
+        nbytes = self._nbytes(layers)
+        if nbytes > self.max_bytes:
+            logger.debug(f"Prefix of {nbytes} bytes exceeds cache budget, not cached")
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            while self._entries and self.current_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+            self._entries[key] = (layers, nbytes)
+            self.current_bytes += nbytes
+
+    @torch.no_grad()
+    def get_or_build(self, model, prefix_ids: torch.LongTensor):
+        """
+        Return a fresh `DynamicCache` holding the prefilled prefix
+
+        Args:
+            model: Causal LM used for prefill on a miss, states of other models sharing
+                the cache are never returned for it
+            prefix_ids: (1, P) prefix token ids on the model device
+
+        Returns:
+            DynamicCache covering `prefix_ids`, safe for the caller to extend
+        """
+        key = self.make_key(model, prefix_ids)
+        layers = self.get(key)
+        if layers is None:
+            outputs = model(input_ids=prefix_ids, use_cache=True)
+            layers = to_legacy_cache(outputs.past_key_values)
+            self.put(key, layers)
+        return from_legacy_cache(layers)
+
+    def get_stats(self):
+        """获取缓存统计信息"""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": f"{hit_rate:.1%}",
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
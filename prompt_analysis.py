@@ -0,0 +1,145 @@
+"""
+Concurrent prompt audio analysis.
+
+Preparing a reference / input clip needs four independent results: vq02 codes
+(FunASR encoder), vq06 codes (speech tokenizer ONNX), the mel features and the
+campplus speaker embedding of the vocoder frontend. They used to run one after
+another; `PromptAnalyzer` runs them as separate tasks on a bounded thread pool
+(each branch spends its time in torch / onnxruntime kernels that release the
+GIL), so preprocessing latency is the slowest branch instead of the sum. All
+branches read their input from one `AudioContext`, so the clip is decoded and
+resampled once.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import torch
+
+from audio_context import AudioContext
+
+logger = logging.getLogger(__name__)
+
+BRANCHES = ("vq02", "vq06", "mel", "spk")
+
+
+@dataclass
+class PromptAnalysis:
+    """Everything derived from a prompt clip, plus wall time per branch in seconds"""
+
+    vq0206_codes: List[int]
+    vq02_codes: List[int]
+    vq06_codes: List[int]
+    speech_feat: torch.Tensor
+    speech_feat_len: torch.Tensor
+    speech_embedding: torch.Tensor
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class PromptAnalyzer:
+    """
+    Schedule vq02 / vq06 / mel / speaker-embedding extraction in parallel
+
+    Token branches are skipped when the tokenizer cache already holds the clip.
+    Tasks never submit further tasks, so concurrent requests sharing the pool
+    cannot deadlock it.
+    """
+
+    def __init__(self, audio_tokenizer, frontend, max_workers: int = 4):
+        """
+        Initialize PromptAnalyzer
+
+        Args:
+            audio_tokenizer: StepAudioTokenizer producing vq02 / vq06 codes
+            frontend: CosyVoice frontend providing `sample_rate`, `extract_speech_feat`
+                and `extract_spk_embedding_from_fbank`
+            max_workers: Size of the shared thread pool
+        """
+        self.audio_tokenizer = audio_tokenizer
+        self.frontend = frontend
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PromptAnalyzer")
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._totals = {name: 0.0 for name in BRANCHES + ("total",)}
+        self._counts = {name: 0 for name in BRANCHES + ("total",)}
+
+    def _submit(self, name, fn, *args):
+        def timed():
+            start = time.perf_counter()
+            result = fn(*args)
+            return result, time.perf_counter() - start
+        return name, self.executor.submit(timed)
+
+    def analyze(self, audio: AudioContext) -> PromptAnalysis:
+        """
+        Analyze the peak-normalized mono view of a clip
+
+        Args:
+            audio: Context of the prompt clip
+
+        Returns:
+            PromptAnalysis: Codes, features and per-branch timings
+        """
+        start = time.perf_counter()
+        audio_16k = self.audio_tokenizer.context_audio(audio)
+        audio_hash, cached = self.audio_tokenizer.cache_lookup(audio_16k)
+
+        mel_sr = self.frontend.sample_rate
+        tasks = [
+            self._submit("mel", lambda: self.frontend.extract_speech_feat(audio.resampled(mel_sr), mel_sr)),
+            self._submit("spk", lambda: self.frontend.extract_spk_embedding_from_fbank(audio.fbank())),
+        ]
+        if cached is None:
+            tasks += [
+                self._submit("vq02", self.audio_tokenizer.get_vq02_code, audio_16k),
+                # log-mels may already exist if Whisper transcribed this context
+                self._submit("vq06", lambda: self.audio_tokenizer.get_vq06_code(
+                    audio_16k, self.audio_tokenizer.context_log_mels(audio)
+                )),
+            ]
+
+        results, timings = {}, {}
+        for name, future in tasks:
+            results[name], timings[name] = future.result()
+
+        if cached is None:
+            cached = self.audio_tokenizer.store_tokens(
+                audio_hash, results["vq02"], results["vq06"], max(timings["vq02"], timings["vq06"])
+            )
+        vq0206_codes, vq02_codes, vq06_codes = cached
+        speech_feat, speech_feat_len = results["mel"]
+        timings["total"] = time.perf_counter() - start
+        self._record(timings)
+        logger.debug("Prompt analysis: " + ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items()))
+
+        return PromptAnalysis(
+            vq0206_codes=vq0206_codes,
+            vq02_codes=vq02_codes,
+            vq06_codes=vq06_codes,
+            speech_feat=speech_feat,
+            speech_feat_len=speech_feat_len,
+            speech_embedding=results["spk"],
+            timings=timings,
+        )
+
+    def _record(self, timings: Dict[str, float]):
+        with self._lock:
+            self._calls += 1
+            for name, seconds in timings.items():
+                self._totals[name] += seconds
+                self._counts[name] += 1
+
+    def get_stats(self):
+        """Number of analyzed clips and mean wall time per branch in milliseconds"""
+        with self._lock:
+            return {
+                "calls": self._calls,
+                "avg_ms": {
+                    name: self._totals[name] / self._counts[name] * 1000
+                    for name in self._totals
+                    if self._counts[name]
+                },
+            }
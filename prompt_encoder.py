@@ -0,0 +1,168 @@
+"""
+Direct prompt encoding for StepAudioTTS.
+
+`merge_vq0206_to_token_str` renders every audio code as `<audio_N>` and the
+prompt builders push the resulting string (tens of thousands of characters)
+through a full tokenizer pass. Since `<audio_N>` are added tokens, the
+tokenizer splits on them and encodes the text around them independently, so
+the same ids can be produced by encoding only the text segments and splicing
+in the audio token ids with a table lookup. The static pieces (role headers,
+system prompts, template tails) are tokenized once.
+
+The result is checked against the string-based encoding at start-up; if the
+tokenizer behaves differently the encoder disables itself and callers keep
+using the string path.
+"""
+import logging
+from typing import Callable, List
+
+import numpy as np
+
+from config.prompts import AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL, AUDIO_EDIT_SYSTEM_PROMPT
+
+logger = logging.getLogger(__name__)
+
+AUDIO_TOKEN_OFFSET = 65536
+NUM_AUDIO_TOKENS = 1024 + 4096  # vq02 codes followed by vq06 codes
+
+
+class AudioPromptEncoder:
+    """
+    Encode clone / edit prompts from audio token ids without string building
+
+    Audio tokens are passed as the absolute interleaved ids returned by
+    `StepAudioTokenizer.wav2token` (`65536 + N` for `<audio_N>`), which is the
+    exact sequence `merge_vq0206_to_token_str` renders as text.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        clone_sys_prompt_tpl: str = AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL,
+        edit_sys_prompt: str = AUDIO_EDIT_SYSTEM_PROMPT,
+    ):
+        """
+        Initialize AudioPromptEncoder
+
+        Args:
+            tokenizer: HuggingFace tokenizer of the TTS model
+            clone_sys_prompt_tpl: Clone system prompt template with `{prompt_wav_tokens}`
+            edit_sys_prompt: Edit system prompt
+        """
+        self.tokenizer = tokenizer
+        self.enabled = False
+
+        # `<audio_N>` -> token id
+        self.audio_token_table = np.asarray(
+            tokenizer.convert_tokens_to_ids([f"<audio_{i}>" for i in range(NUM_AUDIO_TOKENS)]),
+            dtype=np.int64,
+        )
+        unk_token_id = getattr(tokenizer, "unk_token_id", None)
+        self._has_audio_tokens = unk_token_id not in set(self.audio_token_table.tolist()) and len(
+            np.unique(self.audio_token_table)
+        ) == NUM_AUDIO_TOKENS
+
+        # static pieces
+        self.qrole_tokens = tokenizer.encode("human\n")
+        self.arole_tokens = tokenizer.encode("assistant\n")
+        self.newline_tokens = tokenizer.encode("\n")
+        self.edit_sys_tokens = tokenizer.encode(f"system\n{edit_sys_prompt}")
+        self.clone_sys_head_tpl, clone_sys_tail = clone_sys_prompt_tpl.split("{prompt_wav_tokens}")
+        if self._has_audio_tokens:
+            self.clone_sys_tail_tokens = self._encode_after_audio(clone_sys_tail)
+            self.edit_human_tail_tokens = self._encode_after_audio("\n")
+
+    def _encode_after_audio(self, text: str) -> List[int]:
+        """Tokens of `text` when it directly follows an audio token"""
+        ids = self.tokenizer.encode(f"<audio_0>{text}")
+        return ids[ids.index(int(self.audio_token_table[0])) + 1 :]
+
+    def audio_token_ids(self, audio_codes) -> List[int]:
+        """Map absolute audio ids (`65536 + N`) to the tokenizer's `<audio_N>` ids"""
+        codes = np.asarray(audio_codes, dtype=np.int64) - AUDIO_TOKEN_OFFSET
+        return self.audio_token_table[codes].tolist()
+
+    def encode_clone(self, text: str, prompt_text: str, prompt_speaker: str, audio_codes) -> List[int]:
+        """
+        Encode a clone prompt
+
+        Args:
+            text: Target text to synthesize
+            prompt_text: Transcript of the prompt audio
+            prompt_speaker: Speaker name
+            audio_codes: Interleaved absolute prompt audio ids
+
+        Returns:
+            list[int]: Encoded token sequence
+        """
+        sys_head = self.clone_sys_head_tpl.format(speaker=prompt_speaker, prompt_text=prompt_text)
+        sys_tokens = (
+            self.tokenizer.encode(f"system\n{sys_head}")
+            + self.audio_token_ids(audio_codes)
+            + self.clone_sys_tail_tokens
+        )
+        target_tokens = self.tokenizer.encode("\n" + text)[len(self.newline_tokens) :]
+        return (
+            [1, 4] + sys_tokens + [3]
+            + [4] + self.qrole_tokens + target_tokens + [3]
+            + [4] + self.arole_tokens
+        )
+
+    def encode_edit(self, instruct_prefix: str, audio_codes) -> List[int]:
+        """
+        Encode an edit prompt with the default edit system prompt
+
+        Args:
+            instruct_prefix: Instruction prefix
+            audio_codes: Interleaved absolute input audio ids
+
+        Returns:
+            list[int]: Encoded token sequence
+        """
+        human_turn_tokens = (
+            self.tokenizer.encode(f"{instruct_prefix}\n")
+            + self.audio_token_ids(audio_codes)
+            + self.edit_human_tail_tokens
+        )
+        return (
+            [1, 4] + self.edit_sys_tokens + [3]
+            + [4] + self.qrole_tokens + human_turn_tokens + [3]
+            + [4] + self.arole_tokens
+        )
+
+    def verify(
+        self,
+        reference_clone: Callable[[str, str, str, str], List[int]],
+        reference_edit: Callable[[str, str], List[int]],
+    ) -> bool:
+        """
+        Compare against the string-based encoders and enable the direct path if identical
+
+        Args:
+            reference_clone: (text, prompt_text, prompt_speaker, audio_token_str) -> ids
+            reference_edit: (instruct_prefix, audio_token_str) -> ids
+
+        Returns:
+            bool: Whether the direct path is enabled
+        """
+        if not self._has_audio_tokens:
+            logger.warning("Tokenizer has no <audio_N> tokens, direct prompt encoding disabled")
+            self.enabled = False
+            return False
+
+        codes = [AUDIO_TOKEN_OFFSET + x for x in (0, 1023, 1024, 5119, 2048, 7, 8, 1500, 1501, 1502)]
+        audio_str = "".join(f"<audio_{c - AUDIO_TOKEN_OFFSET}>" for c in codes)
+        cases = [
+            (
+                self.encode_clone("Hello, 你好 world!", "参考 text.", "probe_speaker", codes),
+                reference_clone("Hello, 你好 world!", "参考 text.", "probe_speaker", audio_str),
+            ),
+            (
+                self.encode_edit("Make it happy: 今天天气不错 ", codes),
+                reference_edit("Make it happy: 今天天气不错 ", audio_str),
+            ),
+        ]
+        self.enabled = all(fast == reference for fast, reference in cases)
+        if not self.enabled:
+            logger.warning("Direct prompt encoding differs from tokenizer output, using string encoding")
+        return self.enabled
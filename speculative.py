@@ -0,0 +1,345 @@
+"""
+Speculative decoding for StepAudioTTS.
+
+A drafter proposes a few audio tokens, the target model scores all of them in
+one forward pass, and a rejection-sampling step keeps the longest prefix that
+is consistent with the target distribution (plus one token sampled from the
+target), so the output distribution is unchanged while several tokens can be
+accepted per forward pass.
+
+`PromptLookupDrafter` drafts by n-gram matching against the audio tokens of
+the prompt, which works well for edit modes (denoise, vad, speed, emotion...)
+whose output largely copies spans of the input audio. `ModelDrafter` samples
+drafts from a cheaper variant of the same model (e.g. the 4-bit checkpoint).
+"""
+import logging
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+from transformers.generation.logits_process import LogitsProcessorList
+
+from generation_scheduler import sampling_warpers
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculativeStats:
+    """Thread-safe draft / acceptance counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.generated = 0
+
+    def record(self, drafted: int, accepted: int, generated: int):
+        with self._lock:
+            self.steps += 1
+            self.drafted += drafted
+            self.accepted += accepted
+            self.generated += generated
+
+    def merge(self, other: "SpeculativeStats"):
+        with self._lock:
+            self.steps += other.steps
+            self.drafted += other.drafted
+            self.accepted += other.accepted
+            self.generated += other.generated
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def get_stats(self):
+        """获取统计信息"""
+        with self._lock:
+            return {
+                "steps": self.steps,
+                "drafted": self.drafted,
+                "accepted": self.accepted,
+                "generated": self.generated,
+                "acceptance_rate": f"{self.acceptance_rate:.1%}",
+                "tokens_per_step": self.generated / self.steps if self.steps else 0.0,
+            }
+
+
+class PromptLookupDrafter:
+    """
+    Draft continuations by n-gram matching against a source token sequence
+
+    The most recent `ngram` generated tokens are looked up in the source (the
+    prompt's audio token ids); the tokens following the match are proposed.
+    Matches at or after the previous match are preferred, following the
+    roughly monotonic alignment between input and edited audio.
+    """
+
+    def __init__(
+        self,
+        source_ids: List[int],
+        max_ngram_size: int = 3,
+        min_ngram_size: int = 1,
+        num_draft_tokens: int = 10,
+        device=None,
+    ):
+        """
+        Initialize PromptLookupDrafter
+
+        Args:
+            source_ids: Token ids to copy drafts from
+            max_ngram_size: Longest n-gram tried first
+            min_ngram_size: Shortest n-gram tried before giving up
+            num_draft_tokens: Maximum number of tokens proposed per step
+            device: Device of the target model
+        """
+        self.source = torch.tensor(source_ids, dtype=torch.long, device=device)
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+        self.num_draft_tokens = num_draft_tokens
+        self._cursor = 0
+
+    def propose(self, input_ids: torch.LongTensor, max_tokens: int) -> Tuple[torch.LongTensor, None]:
+        """
+        Propose draft tokens
+
+        Args:
+            input_ids: (1, L) prompt + generated tokens
+            max_tokens: Upper bound on the number of drafted tokens
+
+        Returns:
+            Tuple of (n,) draft token ids and None (drafts are deterministic)
+        """
+        num_tokens = min(self.num_draft_tokens, max_tokens)
+        tail = input_ids[0]
+        for n in range(self.max_ngram_size, self.min_ngram_size - 1, -1):
+            if num_tokens <= 0 or tail.numel() < n or self.source.numel() <= n:
+                continue
+            windows = self.source.unfold(0, n, 1)
+            hits = (windows == tail[-n:]).all(dim=1).nonzero().flatten()
+            ahead = hits[hits >= self._cursor]
+            hits = ahead if ahead.numel() else hits
+            for hit in hits.tolist():
+                draft = self.source[hit + n : hit + n + num_tokens]
+                if draft.numel():
+                    self._cursor = hit
+                    return draft, None
+        return self.source[:0], None
+
+
+class ModelDrafter:
+    """
+    Draft tokens by sampling from a smaller / quantized model sharing the vocabulary
+
+    The drafter keeps its own KV cache across steps and rolls it back to the
+    longest prefix shared with the verified sequence before drafting again.
+    """
+
+    def __init__(
+        self,
+        model,
+        num_draft_tokens: int = 5,
+        temperature: float = 0.7,
+        do_sample: bool = True,
+        logits_processor_factory: Optional[Callable[[], list]] = None,
+        past_key_values=None,
+    ):
+        """
+        Initialize ModelDrafter
+
+        Args:
+            model: Draft causal LM
+            num_draft_tokens: Maximum number of tokens proposed per step
+            temperature: Sampling temperature, should match the target
+            do_sample: Sample if True, greedy otherwise
+            logits_processor_factory: Builds the custom processors applied before the
+                warpers; should match the target's so draft and target distributions align
+            past_key_values: Optional draft-model cache already holding a prompt prefix
+        """
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+        self.do_sample = do_sample
+        generation_config = model.generation_config
+        self.processors = LogitsProcessorList(logits_processor_factory() if logits_processor_factory else [])
+        if do_sample:
+            self.processors.extend(sampling_warpers(temperature, generation_config.top_k, generation_config.top_p))
+        self.device = next(model.parameters()).device
+        self.cache = past_key_values if past_key_values is not None else DynamicCache()
+        self._cached_ids: Optional[torch.LongTensor] = None  # tokens covered by self.cache
+
+    def _sync(self, ids: torch.LongTensor) -> torch.LongTensor:
+        """Roll the cache back to the prefix shared with `ids`, returns the tokens to feed"""
+        cached = self.cache.get_seq_length()
+        if self._cached_ids is not None:
+            length = min(cached, ids.shape[1] - 1)
+            same = (self._cached_ids[0, :length] == ids[0, :length]).int()
+            common = int(same.cumprod(dim=0).sum())
+            if common < cached:
+                self.cache.crop(common)
+            cached = common
+        return ids[:, cached:]
+
+    @torch.inference_mode()
+    def propose(self, input_ids: torch.LongTensor, max_tokens: int):
+        """
+        Propose draft tokens
+
+        Args:
+            input_ids: (1, L) prompt + generated tokens
+            max_tokens: Upper bound on the number of drafted tokens
+
+        Returns:
+            Tuple of (n,) draft token ids and (n, vocab) draft probabilities
+            (None when decoding greedily)
+        """
+        num_tokens = min(self.num_draft_tokens, max_tokens)
+        ids = input_ids.to(self.device)
+        if num_tokens <= 0:
+            return ids[0, :0], None
+
+        feed = self._sync(ids)
+        tokens, probs = [], []
+        for _ in range(num_tokens):
+            outputs = self.model(input_ids=feed, past_key_values=self.cache, use_cache=True)
+            self.cache = outputs.past_key_values
+            scores = self.processors(ids, outputs.logits[:, -1, :].to(copy=True, dtype=torch.float32))
+            if self.do_sample:
+                dist = torch.softmax(scores[0], dim=-1)
+                token = torch.multinomial(dist, num_samples=1)
+                probs.append(dist)
+            else:
+                token = torch.argmax(scores, dim=-1)
+            tokens.append(token)
+            feed = token.view(1, 1)
+            ids = torch.cat([ids, feed], dim=1)
+        # the last drafted token has not been fed to the draft model yet
+        self._cached_ids = ids[:, :-1]
+        return torch.cat(tokens), torch.stack(probs) if probs else None
+
+
+def _sample(scores: torch.FloatTensor, do_sample: bool) -> int:
+    if do_sample:
+        return int(torch.multinomial(torch.softmax(scores[0], dim=-1), num_samples=1))
+    return int(torch.argmax(scores, dim=-1))
+
+
+def _accept_or_resample(
+    scores: torch.FloatTensor,
+    token: int,
+    draft_probs: Optional[torch.FloatTensor],
+    do_sample: bool,
+) -> Tuple[bool, int]:
+    """
+    Verify one draft token against processed target scores
+
+    Sampling uses standard speculative rejection sampling: accept with
+    probability min(1, p(x) / q(x)), otherwise sample from norm(max(p - q, 0)).
+    A deterministic drafter has q = one-hot(x).
+    """
+    if not do_sample:
+        target = int(torch.argmax(scores, dim=-1))
+        return target == token, target
+
+    p = torch.softmax(scores[0], dim=-1)
+    if draft_probs is None:
+        accept_prob = p[token]
+        residual = p.clone()
+        residual[token] = 0
+    else:
+        draft_probs = draft_probs.to(p.device)
+        accept_prob = torch.clamp(p[token] / draft_probs[token], max=1.0)
+        residual = torch.clamp(p - draft_probs, min=0)
+    if torch.rand((), device=p.device) < accept_prob:
+        return True, token
+    if residual.sum() <= 0:
+        residual = p
+    return False, int(torch.multinomial(residual / residual.sum(), num_samples=1))
+
+
+@torch.inference_mode()
+def speculative_generate(
+    model,
+    input_ids: torch.LongTensor,
+    drafter,
+    max_length: int = 8192,
+    temperature: float = 0.7,
+    do_sample: bool = True,
+    logits_processor: Optional[LogitsProcessorList] = None,
+    eos_token_id=None,
+    past_key_values=None,
+    on_token: Optional[Callable[[int], bool]] = None,
+    stats: Optional[SpeculativeStats] = None,
+) -> torch.LongTensor:
+    """
+    Generate with draft-and-verify speculative decoding (batch size 1)
+
+    Args:
+        model: Target causal LM
+        input_ids: (1, L) prompt token ids
+        drafter: Object with `propose(input_ids, max_tokens) -> (tokens, probs)`;
+            probs is an (n, vocab) draft distribution or None for deterministic drafts
+        max_length: Maximum total length (prompt + generated), as in `generate`
+        temperature: Sampling temperature
+        do_sample: Sample if True, greedy otherwise
+        logits_processor: Custom processors applied before the sampling warpers
+        eos_token_id: EOS token id or list of ids (default: model.generation_config)
+        past_key_values: Optional cache already holding a prefix of `input_ids`
+        on_token: Called with every new token id; returning False stops generation
+        stats: Optional SpeculativeStats updated once per verification step
+
+    Returns:
+        torch.LongTensor: (1, L) prompt + generated token ids, laid out like `generate` output
+    """
+    generation_config = model.generation_config
+    if eos_token_id is None:
+        eos_token_id = generation_config.eos_token_id
+    eos_token_ids = {eos_token_id} if isinstance(eos_token_id, int) else set(eos_token_id)
+    processors = LogitsProcessorList(logits_processor or [])
+    if do_sample:
+        processors.extend(sampling_warpers(temperature, generation_config.top_k, generation_config.top_p))
+
+    device = next(model.parameters()).device
+    ids = input_ids.to(device)
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    pending = ids[:, cache.get_seq_length() :]
+
+    finished = False
+    while not finished:
+        draft, draft_probs = drafter.propose(ids, max_length - ids.shape[1] - 1)
+        draft = draft.to(device)
+        outputs = model(
+            input_ids=torch.cat([pending, draft[None]], dim=1),
+            past_key_values=cache,
+            use_cache=True,
+        )
+        cache = outputs.past_key_values
+        # row i scores the token following ids + draft[:i]
+        logits = outputs.logits[0, pending.shape[1] - 1 :, :].float()
+
+        accepted = 0
+        generated = 0
+        for i in range(draft.numel() + 1):
+            scores = processors(ids, logits[i : i + 1].clone())
+            if i < draft.numel():
+                q = draft_probs[i] if draft_probs is not None else None
+                is_accepted, token = _accept_or_resample(scores, int(draft[i]), q, do_sample)
+            else:
+                is_accepted, token = False, _sample(scores, do_sample)
+            ids = torch.cat([ids, ids.new_tensor([[token]])], dim=1)
+            accepted += is_accepted
+            generated += 1
+            stopped = on_token is not None and on_token(token) is False
+            if stopped or token in eos_token_ids or ids.shape[1] >= max_length:
+                finished = True
+                break
+            if not is_accepted:
+                break
+
+        if stats is not None:
+            stats.record(draft.numel(), accepted, generated)
+        # the cache holds every draft token, keep only the accepted ones
+        cache.crop(ids.shape[1] - 1)
+        pending = ids[:, -1:]
+
+    return ids.cpu()
@@ -1,18 +1,23 @@
-from functools import cached_property, reduce
-from typing import List, Optional, Union
+from functools import cached_property
+from typing import List, Optional, Tuple, Union
 from copy import deepcopy
 from collections import defaultdict
 import numpy as np
 import torch
 import torchaudio
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 from hyperpyyaml import load_hyperpyyaml
 from stepvocoder.cosyvoice2.cli.frontend import CosyVoiceFrontEnd
 from stepvocoder.cosyvoice2.flow.flow import CausalMaskedDiffWithXvec
+from stepvocoder.cosyvoice2.flow.cache_pool import ChunkCachePool, ChunkCacheSlab, SessionLimitError
+from stepvocoder.cosyvoice2.utils import vq0206_codec
+from stepvocoder.cosyvoice2.utils.session_store import SessionExpiredError, SessionStore
 from stepvocoder.cosyvoice2.hifigan.generator import HiFTGenerator
 from stepvocoder.cosyvoice2.bigvgan.bigvgan import BigVGAN
 # from stepvocoder.cosyvoice2.utils.common import fade_in_out
 import threading
+import time
 
 """perform fade_in_out in tensor style
 """
@@ -39,7 +44,25 @@ class CosyVoice_stream_impl_(torch.nn.Module):
                  chunk_size_list: List = [15, 24, 48],  # (0.6s, 0.96s, 1.92s) 
                  mel_cache_len: int = 8,
                  n_timesteps: int = 10, # for both stream/non-stream
+                 max_stream_sessions: int = 4,
+                 session_ttl: Optional[float] = 300.0,
+                 session_max_bytes: Optional[int] = None,
+                 estimator_left_context: int = 96,
+                 encoder_left_context: int = 1500,
+                 longform_chunk_size: int = 48,
+                 longform_min_tokens: Optional[int] = 1500,
                  ):
+        """
+        Args:
+            estimator_left_context: mel frames (50 Hz) the flow decoder attends
+                to besides the prompt, 96 is ~2 s
+            encoder_left_context: mel frames the token encoder attends to
+                besides the prompt, 1500 is 30 s
+            longform_chunk_size: tokens (25 Hz) per window of token2wav_longform
+            longform_min_tokens: non-stream requests with at least this many
+                tokens (1500 is 60 s) are decoded with token2wav_longform,
+                None always runs the full-attention solve
+        """
         super().__init__()
         self.flow = flow
         self.hift = hift
@@ -49,6 +72,12 @@ class CosyVoice_stream_impl_(torch.nn.Module):
         self.token_lookahead = flow.pre_lookahead_len
         # stream conf
         self.mel_cache_len = mel_cache_len
+        # attention caches keep the prompt + a sliding window, updated in place
+        self.estimator_left_context = estimator_left_context
+        self.encoder_left_context = encoder_left_context
+        # long-form non-stream conf
+        self.longform_chunk_size = longform_chunk_size
+        self.longform_min_tokens = longform_min_tokens
 
         if isinstance(self.hift, BigVGAN):
             # bigvgan use left 3 frames and right 3 frames as context
@@ -59,18 +88,21 @@ class CosyVoice_stream_impl_(torch.nn.Module):
             raise ValueError(f'unsupported vocoder type {type(self.hift)}')
 
         self.register_buffer('speech_window', torch.from_numpy(np.hamming(2 * self.source_cache_len)), persistent=False)
-        # session management
-        self.speech_token_dict = defaultdict(list)
+        # session management, one state dict per session:
+        #   speech_token: pending mixed tokens, chunk_size: remaining chunk schedule,
+        #   n_timesteps: denoising steps per chunk, b_first_chunk: whether no mel has been vocoded yet,
+        #   chunk_cache: model cnn cache + cache_slab (prompt + window attention rings),
+        #   spk_embedding: speaker embedding, hift_cache: vocoder mel/source/speech cache,
+        #   cache_slab: encoder and estimator cache buffers from cache_pool
         self.chunk_size_list = chunk_size_list
-        self.chunk_size_dict = {}
-        self.b_first_chunk_dict = {}  # indicate if it's the first chunk of this session
-        # hifigan cache
-        self.hift_cache_dict = {}
-        # model att/cnn cache
-        self.chunk_cache_dict = {}
-        self.estimator_prompt_length_dict = {}
-        # speaker embedding cache
-        self.spk_embedding_cache_dict = {}
+        # per-session encoder and estimator cache buffers
+        self.cache_pool = ChunkCachePool(self._allocate_cache_slab, max_stream_sessions)
+        # idle sessions (e.g. disconnected clients) give their buffers back
+        self.sessions = SessionStore(
+            ttl=session_ttl,
+            max_bytes=session_max_bytes,
+            on_evict=lambda session_id, _: self.cache_pool.release(session_id),
+        )
         # setup lock
         self.setup_lock = threading.Lock()
 
@@ -89,23 +121,14 @@ class CosyVoice_stream_impl_(torch.nn.Module):
                             prompt_token: torch.Tensor,
                             prompt_feat: torch.Tensor,
                             embedding: torch.Tensor,
+                            n_timesteps: Optional[int] = None,
+                            solver: str = 'euler',
                             ):
         def _make_len(ts:torch.Tensor):
             return torch.tensor([ts.shape[1]], dtype=torch.long, device=ts.device)
-        # [02, 02, 06, 06, 06] -> [[02, 02, PAD], [06, 06, 06]]
-
-        token = self._reshape(
-            token.squeeze().tolist()
-        ).unsqueeze(0)
-        prompt_token = self._reshape(
-            prompt_token.squeeze().tolist()
-        ).unsqueeze(0)
-        # align prompt mel
-        prompt_feat = F.interpolate(
-            prompt_feat.transpose(1, 2), 
-            size=prompt_token.shape[1]*2, 
-            mode='nearest'
-        ).transpose(1, 2)
+        token, prompt_token, prompt_feat = self._prepare_nonstream(token, prompt_token, prompt_feat)
+        if self._use_longform(token.shape[1], solver):
+            return self._token2wav_longform(token, prompt_token, prompt_feat, embedding, n_timesteps or self.n_timesteps)
         
         token, prompt_token, prompt_feat, embedding = map(
             lambda ts: ts.to(self.device),
@@ -120,20 +143,208 @@ class CosyVoice_stream_impl_(torch.nn.Module):
             prompt_feat.to(self.dtype),
             _make_len(prompt_feat),
             embedding.to(self.dtype),
-            self.n_timesteps,
+            n_timesteps or self.n_timesteps,
+            solver,
         )
         # inference vocoder
+        speech = self._vocode_nonstream(mel)
+        return speech.cpu().to(torch.float32)
+
+    """NOTE Batched non-stream interface.
+    Decode several requests with one flow solve (2N CFG rows) instead of N.
+    Sequences are right-padded and masked, so each item's mel is the same as
+    decoding it alone. The vocoders are not causal, so mels are vocoded in
+    batches of equal length rather than padded. Items long enough for
+    token2wav_longform are decoded alone with it, as token2wav_nonstream would.
+    """
+    def token2wav_batch(self,
+                        tokens: List[torch.Tensor],
+                        prompt_tokens: List[torch.Tensor],
+                        prompt_feats: List[torch.Tensor],
+                        embeddings: List[torch.Tensor],
+                        n_timesteps: Optional[int] = None,
+                        solver: str = 'euler',
+                        )->List[torch.Tensor]:
+        assert len(tokens) == len(prompt_tokens) == len(prompt_feats) == len(embeddings)
+        if not tokens:
+            return []
+        items = [
+            self._prepare_nonstream(token, prompt_token, prompt_feat)
+            for token, prompt_token, prompt_feat in zip(tokens, prompt_tokens, prompt_feats)
+        ]
+        speeches = [None] * len(items)
+        for i, item in enumerate(items):
+            if self._use_longform(item[0].shape[1], solver):
+                speeches[i] = self._token2wav_longform(*item, embeddings[i], n_timesteps or self.n_timesteps)
+        batch = [i for i in range(len(items)) if speeches[i] is None]
+        if not batch:
+            return speeches
+        items = [items[i] for i in batch]
+        embeddings = [embeddings[i] for i in batch]
+
+        def _pad(seqs: List[torch.Tensor]):
+            lens = torch.tensor([ts.shape[1] for ts in seqs], dtype=torch.long, device=self.device)
+            padded = pad_sequence([ts[0] for ts in seqs], batch_first=True)
+            return padded.to(self.device), lens
+
+        token, token_len = _pad([item[0] for item in items])
+        prompt_token, prompt_token_len = _pad([item[1] for item in items])
+        prompt_feat, prompt_feat_len = _pad([item[2] for item in items])
+        embedding = torch.cat([emb.reshape(1, -1) for emb in embeddings], dim=0)
+        # inference flow
+        mels = self.flow.inference_batch(
+            token,
+            token_len,
+            prompt_token,
+            prompt_token_len,
+            prompt_feat.to(self.dtype),
+            prompt_feat_len,
+            embedding.to(self.device, self.dtype),
+            n_timesteps or self.n_timesteps,
+            solver,
+        )
+        # inference vocoder, one batch per distinct mel length
+        groups = defaultdict(list)
+        for i, mel in enumerate(mels):
+            groups[mel.shape[2]].append(i)
+        for indices in groups.values():
+            speech = self._vocode_nonstream(torch.cat([mels[i] for i in indices], dim=0))
+            speech = speech.cpu().to(torch.float32)
+            for row, i in enumerate(indices):
+                speeches[batch[i]] = speech[row:row + 1]
+        return speeches
+
+    """NOTE Long-form non-stream interface.
+    Decode in windows of `longform_chunk_size` tokens through the streaming
+    caches instead of one full-attention solve: the flow attends to the prompt
+    plus a sliding window of left context, and each window is vocoded with
+    the streaming mel/source caches and crossfaded with `fade_in_out`. Time
+    grows linearly and peak memory stays flat with the output length, and
+    outputs are not capped by the 600 s noise buffer. Euler solver only.
+    """
+    def token2wav_longform(self,
+                           token: torch.Tensor,
+                           prompt_token: torch.Tensor,
+                           prompt_feat: torch.Tensor,
+                           embedding: torch.Tensor,
+                           n_timesteps: Optional[int] = None,
+                           )->torch.Tensor:
+        token, prompt_token, prompt_feat = self._prepare_nonstream(token, prompt_token, prompt_feat)
+        return self._token2wav_longform(token, prompt_token, prompt_feat, embedding, n_timesteps or self.n_timesteps)
+
+    def _use_longform(self, token_len: int, solver: str)->bool:
+        return self.longform_min_tokens is not None and token_len >= self.longform_min_tokens and solver == 'euler'
+
+    """NOTE Internal method, do not call this method!
+    token, prompt_token: shape (1, t, 2), prompt_feat aligned to prompt_token
+    """
+    def _token2wav_longform(self,
+                            token: torch.Tensor,
+                            prompt_token: torch.Tensor,
+                            prompt_feat: torch.Tensor,
+                            embedding: torch.Tensor,
+                            n_timesteps: int,
+                            )->torch.Tensor:
+        lookahead, chunk_size = self.token_lookahead, self.longform_chunk_size
+        assert token.shape[1] >= lookahead, f'long-form decoding needs at least {lookahead} tokens'
+        # the caches are sized by the prompt and the windows, not by the output length
+        prompt_len = prompt_feat.shape[1]
+        state = dict(
+            n_timesteps = n_timesteps,
+            cache_slab = self.flow.allocate_chunk_cache(
+                n_timesteps,
+                prompt_len + max(self.estimator_left_context, 2 * (chunk_size + lookahead)),
+                prompt_len + self.encoder_left_context,
+                device=self.device,
+                dtype=self.dtype,
+            ),
+        )
+        state['cache_slab'].reset(self.estimator_left_context, self.encoder_left_context)
+        self._setup_cache(torch.cat([prompt_token, token[:, :lookahead]], dim=1), prompt_feat, embedding, state)
+        # same windows as a stream with a fixed chunk size, each one carries its look ahead tokens
+        speeches = []
+        start = 0
+        while token.shape[1] - start > chunk_size + lookahead:
+            speeches.append(self._token2wav_stream(token[:, start:start + chunk_size + lookahead], state, False))
+            start += chunk_size
+        speeches.append(self._token2wav_stream(token[:, start:], state, True))
+        return torch.cat(speeches, dim=1)
+
+    """NOTE Internal method, do not call this method!
+    [02, 02, 06, 06, 06] -> [[02, 02, PAD], [06, 06, 06]], and align the prompt mel.
+    """
+    def _prepare_nonstream(self,
+                           token: torch.Tensor,
+                           prompt_token: torch.Tensor,
+                           prompt_feat: torch.Tensor,
+                           ):
+        token = self._reshape(token).unsqueeze(0)
+        prompt_token = self._reshape(prompt_token).unsqueeze(0)
+        # align prompt mel
+        prompt_feat = F.interpolate(
+            prompt_feat.transpose(1, 2), 
+            size=prompt_token.shape[1]*2, 
+            mode='nearest'
+        ).transpose(1, 2)
+        return token, prompt_token, prompt_feat
+
+    """NOTE Internal method, do not call this method!
+    Vocode a (b, c, t) mel to (b, T) speech.
+    """
+    def _vocode_nonstream(self, mel: torch.Tensor)->torch.Tensor:
         with torch.no_grad():
             if isinstance(self.hift, BigVGAN):
-                mel = torch.nn.functional.pad(mel, (3,3), mode='reflect')                                                                                                                                                                                                                     
-                speech = self.hift.inference(mel).squeeze(0) # [1,1,T] -> [1,T]
+                mel = torch.nn.functional.pad(mel, (3,3), mode='reflect')
+                speech = self.hift.inference(mel).squeeze(1) # [b,1,T] -> [b,T]
             elif isinstance(self.hift, HiFTGenerator):
                 speech, _ = self.hift.inference(mel)
             else:
                 raise ValueError(f'unsupported vocoder type {type(self.hift)}')
-        speech = speech.cpu().to(torch.float32)
         return speech
     
+    def _allocate_cache_slab(self)->ChunkCacheSlab:
+        # prompts of up to max_len - estimator_left_context frames fit, the encoder keeps the same prompt
+        max_len = 1000
+        return self.flow.allocate_chunk_cache(
+            self.n_timesteps,
+            max_len,
+            max_len - self.estimator_left_context + self.encoder_left_context,
+            device=self.device,
+            dtype=self.dtype,
+        )
+
+    """NOTE Reserve the cache buffers of a stream session before feeding tokens.
+    Blocks up to `timeout` seconds (None: forever) while `max_stream_sessions` other sessions are active,
+    then raises SessionLimitError. Sessions that skip this reserve their buffers on the first chunk
+    and fail at once when none are free. `clean_up` returns the buffers.
+    """
+    def open_session(self, session_id: str, timeout: Optional[float] = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # sessions past their ttl free their slabs here
+            self.sessions.expire()
+            wait = 1.0 if deadline is None else min(1.0, max(0.0, deadline - time.monotonic()))
+            try:
+                self.cache_pool.acquire(session_id, wait)
+                break
+            except SessionLimitError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+        self._session_state(session_id)
+
+    def _session_state(self, session_id: str)->dict:
+        state = self.sessions.get(session_id)
+        if state is None:
+            if self.sessions.evicted(session_id):
+                self.cache_pool.release(session_id)
+                raise SessionExpiredError(f'stream session {session_id} was expired or evicted')
+            state = dict(speech_token=[], chunk_size=deepcopy(self.chunk_size_list), n_timesteps=self.n_timesteps)
+            self.sessions.put(session_id, state)
+        return state
+
+    def get_session_stats(self)->dict:
+        return {**self.sessions.get_stats(), 'cache_pool': self.cache_pool.stats()}
+
     """NOTE Internal method, do not call this method!
     Handle device & dtype transfer.
     """
@@ -141,7 +352,7 @@ class CosyVoice_stream_impl_(torch.nn.Module):
                      token: torch.Tensor,
                      mel: torch.Tensor,
                      spk: torch.Tensor,
-                     session_id: str,
+                     state: dict,
                      ):
         # att/cnn-cache
         with self.setup_lock:
@@ -149,17 +360,16 @@ class CosyVoice_stream_impl_(torch.nn.Module):
                 token.to(self.device), 
                 mel.to(self.device, self.dtype),
                 spk.to(self.device, self.dtype),
-                self.n_timesteps,
+                state['n_timesteps'],
+                state['cache_slab'],
             )
-            # 对 cache dict 里的每个 tensor 做 clone().detach()
-            cache = {k: (v.clone().detach() if isinstance(v, torch.Tensor) else v) for k, v in cache.items()}
-            self.chunk_cache_dict[session_id] = cache
-            self.estimator_prompt_length_dict[session_id] = mel.shape[1]
-            self.b_first_chunk_dict[session_id] = True
+            # attention caches live in this session's slab, no copy needed
+            state['chunk_cache'] = cache
+            state['b_first_chunk'] = True
             # spk embedding
-            self.spk_embedding_cache_dict[session_id] = spk.to(self.device, self.dtype).clone()
+            state['spk_embedding'] = spk.to(self.device, self.dtype).clone()
             # hift cache
-            self.hift_cache_dict[session_id] = dict(
+            state['hift_cache'] = dict(
                 mel = torch.zeros(1, mel.shape[2], 0, device=self.device, dtype=self.dtype), 
                 source = torch.zeros(1, 1, 0, device=self.device, dtype=self.dtype),
                 speech = torch.zeros(1, 0, device=self.device, dtype=self.dtype),
@@ -171,87 +381,65 @@ class CosyVoice_stream_impl_(torch.nn.Module):
     """
     def _token2wav_stream(self,
                           token: torch.Tensor,
-                          session_id: str,
+                          state: dict,
                           last_chunk: bool,
                           ):
         
-        assert session_id in self.chunk_cache_dict, 'call setup_cache first to obtain cache'
+        assert 'chunk_cache' in state, 'call setup_cache first to obtain cache'
         # fetch cache & speaker embedding
-        cache = self.chunk_cache_dict[session_id]
-        embedding = self.spk_embedding_cache_dict[session_id]
+        cache = state['chunk_cache']
+        embedding = state['spk_embedding']
         # inference this chunk
         mel, new_cache = self.flow.inference_chunk(
             token.to(self.device), # int64
             embedding,
             cache,
             last_chunk,
-            self.n_timesteps,
+            state['n_timesteps'],
         )
-        # NOTE(sfy) truncate attention cache (prompt_length + 2s left context)
-        left_context_length = int(2 * 48)
-        estimator_att_cache = new_cache['estimator_att_cache']
-        prompt_length = self.estimator_prompt_length_dict[session_id]
-        if estimator_att_cache.shape[4] > (prompt_length + left_context_length):
-            new_cache['estimator_att_cache'] = torch.cat([
-                estimator_att_cache[:, :, :, :, :left_context_length],
-                estimator_att_cache[:, :, :, :, -prompt_length:],
-            ], dim=4)
-
-        self.chunk_cache_dict[session_id] = {k: v.clone().detach() for k, v in new_cache.items()}
+        # the slab belongs to this session, other sessions can not overwrite it
+        # NOTE the attention caches keep the prompt + a sliding window (estimator_left_context, ~2s) in place
+        state['chunk_cache'] = new_cache
         # vocoder cache
-        hift_cache_mel = self.hift_cache_dict[session_id]['mel']
-        hift_cache_source = self.hift_cache_dict[session_id]['source']
-        hift_cache_speech = self.hift_cache_dict[session_id]['speech']
-        mel = torch.concat([hift_cache_mel, mel], dim=2)
+        hift_cache = state['hift_cache']
+        mel = torch.concat([hift_cache['mel'], mel], dim=2)
         # inference vocoder
         with torch.no_grad():
             if isinstance(self.hift, BigVGAN):
-                if self.b_first_chunk_dict[session_id] and mel.shape[2] > 0:
+                if state['b_first_chunk'] and mel.shape[2] > 0:
                     print(f'[INFO] first chunk mel len: {mel.shape[2]}')
-                    self.b_first_chunk_dict[session_id] = False
+                    state['b_first_chunk'] = False
                     mel = F.pad(mel, (3,0), mode='reflect')
                 if last_chunk:
                     mel = F.pad(mel, (0,3), mode='reflect')
                 speech = self.hift.inference(mel).squeeze(0) # [1,1,T] -> [1,T]
                 source = torch.zeros(1, 1, 0, device=self.device, dtype=self.dtype) # dummy source
             elif isinstance(self.hift, HiFTGenerator):
-                speech, source = self.hift.inference(mel, hift_cache_source)
+                speech, source = self.hift.inference(mel, hift_cache['source'])
         # overlap speech smooth
-        if hift_cache_speech.shape[-1] > 0:
-            speech = fade_in_out(speech, hift_cache_speech, self.speech_window)
-        # update vocoder cache
-        self.hift_cache_dict[session_id] = dict(
-            mel = mel[..., -self.mel_cache_len:].clone().detach(),
-            source = source[:, :, -self.source_cache_len:].clone().detach(),
-            speech = speech[:, -self.source_cache_len:].clone().detach(),
-        )
+        if hift_cache['speech'].shape[-1] > 0:
+            speech = fade_in_out(speech, hift_cache['speech'], self.speech_window)
+        # update vocoder cache in place, its buffers are allocated once per session
+        hift_cache['mel'] = self._keep_tail(hift_cache['mel'], mel, self.mel_cache_len)
+        hift_cache['source'] = self._keep_tail(hift_cache['source'], source, self.source_cache_len)
+        hift_cache['speech'] = self._keep_tail(hift_cache['speech'], speech, self.source_cache_len)
         if not last_chunk:
             speech = speech[:, :-self.source_cache_len]
         return speech.cpu().to(torch.float32)
 
     @staticmethod
-    def _reshape(mix_seq: List[int])->torch.Tensor:
-        # assert len(mix_seq)%5 == 0, len(mix_seq)
-        # NOTE add padding to avoid assert error 
+    def _keep_tail(cache: torch.Tensor, ts: torch.Tensor, length: int)->torch.Tensor:
+        """Last `length` frames of `ts`, copied into `cache` once it has their shape"""
+        tail = ts[..., -length:]
+        if cache.shape == tail.shape:
+            return cache.copy_(tail)
+        return tail.clone()
+
+    @staticmethod
+    def _reshape(mix_seq: Union[List[int], torch.Tensor])->torch.Tensor:
+        # NOTE a trailing partial group is padded to avoid shape errors
         # (don't care the final speech as it's wrong anyway)
-        if len(mix_seq)%5 > 0:
-            pad_len = 5-(len(mix_seq)%5)
-            mix_seq += [0, 0, 0, 1024, 1024, 1024][-pad_len:]
-
-        num_groups = len(mix_seq) // 5
-        vq02 = reduce(
-            lambda x, y: x+y, 
-            [mix_seq[i*5: i*5+2] + [1024] for i in range(num_groups)]
-        )
-        vq06 = reduce(
-            lambda x, y: x+y, 
-            [mix_seq[i*5+2: i*5+5] for i in range(num_groups)]
-        )
-        vq0206 = torch.stack([
-            torch.tensor(vq02, dtype=torch.long),
-            torch.tensor(vq06, dtype=torch.long)-1024+1025,
-        ], dim=1)
-        return vq0206
+        return vq0206_codec.deinterleave_to_vq0206(mix_seq)
 
     """NOTE Stream interface. Called whenever one token is generated.
     NOTE(sfy) not need to transfer device or dtype
@@ -271,58 +459,62 @@ class CosyVoice_stream_impl_(torch.nn.Module):
         def _mixed_len(l:int):
             return (l // 3) * 5
 
-        # init chunk size tracking
-        if session_id not in self.chunk_size_dict:
-            self.chunk_size_dict[session_id] = deepcopy(self.chunk_size_list)
+        # init session (chunk size tracking, pending tokens)
+        state = self._session_state(session_id)
         # add token
-        self.speech_token_dict[session_id].extend(token)
+        state['speech_token'].extend(token)
         # waiting to setup cache
         mix_token_lookahead_len = _mixed_len(self.token_lookahead)
-        if session_id not in self.chunk_cache_dict:
-            if len(self.speech_token_dict[session_id]) >= mix_token_lookahead_len:
+        if 'chunk_cache' not in state:
+            if len(state['speech_token']) >= mix_token_lookahead_len:
                 # [02, 02, 06, 06, 06] -> [[02, 02, PAD], [06, 06, 06]]
                 lookahead_token = self._reshape(
-                    self.speech_token_dict[session_id][:mix_token_lookahead_len]
+                    state['speech_token'][:mix_token_lookahead_len]
                 ).unsqueeze(0)   # (1, t, 2)
-                prompt_token = self._reshape(
-                    prompt_token.squeeze().tolist()
-                ).unsqueeze(0)
+                prompt_token = self._reshape(prompt_token).unsqueeze(0)
                 # align prompt mel
                 prompt_feat = F.interpolate(
                     prompt_feat.transpose(1, 2), 
                     size=prompt_token.shape[1]*2, 
                     mode='nearest'
                 ).transpose(1, 2)
+                # kept in the state so the session's bytes include its slab
+                state['cache_slab'] = self.cache_pool.acquire(session_id)
+                # a reused slab starts over, the prompt becomes the front of every cache
+                state['cache_slab'].reset(self.estimator_left_context, self.encoder_left_context)
                 self._setup_cache(
                     torch.cat([prompt_token, lookahead_token], dim=1),
                     prompt_feat,
                     embedding,
-                    session_id,
+                    state,
                 )
+                self.sessions.put(session_id, state)
             return None
         
         # deal with remaining tokens
         if last_chunk:
-            this_token = self.speech_token_dict[session_id]
+            this_token = state['speech_token']
         else:
         # cut to one chunk
             this_token = None
-            mix_token_chunk_len = _mixed_len(self.chunk_size_dict[session_id][0])
-            if len(self.speech_token_dict[session_id]) >= (mix_token_chunk_len+mix_token_lookahead_len):
-                this_token = self.speech_token_dict[session_id][:(mix_token_chunk_len+mix_token_lookahead_len)]            
-                self.speech_token_dict[session_id] = self.speech_token_dict[session_id][mix_token_chunk_len:]
+            mix_token_chunk_len = _mixed_len(state['chunk_size'][0])
+            if len(state['speech_token']) >= (mix_token_chunk_len+mix_token_lookahead_len):
+                this_token = state['speech_token'][:(mix_token_chunk_len+mix_token_lookahead_len)]            
+                state['speech_token'] = state['speech_token'][mix_token_chunk_len:]
         # go synthesis
         if this_token is not None:
             # [02, 02, 06, 06, 06] -> [[02, 02, PAD], [06, 06, 06]]
             this_token = self._reshape(this_token).unsqueeze(0)
             this_speech = self._token2wav_stream(
                 this_token,
-                session_id,
+                state,
                 last_chunk,
             )
             # update chunk size
-            if len(self.chunk_size_dict[session_id]) > 1:
-                self.chunk_size_dict[session_id].pop(0)
+            if len(state['chunk_size']) > 1:
+                state['chunk_size'].pop(0)
+            # refresh the session's byte count
+            self.sessions.put(session_id, state)
         else:
             this_speech = None
         # clear all caches
@@ -331,12 +523,8 @@ class CosyVoice_stream_impl_(torch.nn.Module):
         return this_speech
 
     def clean_up(self, session_id: str):
-        self.chunk_size_dict.pop(session_id, None)
-        self.hift_cache_dict.pop(session_id, None)
-        self.chunk_cache_dict.pop(session_id, None)
-        self.estimator_prompt_length_dict.pop(session_id, None)
-        self.spk_embedding_cache_dict.pop(session_id, None)
-        self.speech_token_dict.pop(session_id, None)
+        self.sessions.pop(session_id)
+        self.cache_pool.release(session_id)
         torch.cuda.empty_cache()
 
 
@@ -350,6 +538,12 @@ class CosyVoice:
                  n_timesteps: int = 10,
                  enable_cuda_graph: bool = True,
                  dtype=torch.float32,
+                 cfg_interval: Optional[Tuple[float, float]] = None,  # t range with CFG, None: every step
+                 max_stream_sessions: int = 4,  # concurrent token2wav_stream sessions, one cache slab each
+                 session_ttl: Optional[float] = 300.0,  # seconds before an idle stream session is dropped
+                 session_max_bytes: Optional[int] = None,  # evict least recently used stream sessions above this
+                 encoder_left_context: int = 1500,  # mel frames of stream history the token encoder attends to
+                 longform_min_tokens: Optional[int] = 1500,  # non-stream outputs this long are decoded in windows
                  ):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.dtype = dtype
@@ -361,9 +555,16 @@ class CosyVoice:
             mel_conf = configs['mel_conf']
         flow.load_state_dict(torch.load(f"{model_dir}/flow.pt", map_location='cpu'))
         flow = flow.eval()
+        if cfg_interval is not None:
+            flow.decoder.cfg_interval = tuple(cfg_interval)
         hift.load_state_dict(torch.load(f"{model_dir}/hift.pt", map_location='cpu'))
         hift = hift.eval()
-        cosy_impl = CosyVoice_stream_impl_(flow, hift, chunk_size_list, mel_cache_len, n_timesteps)
+        cosy_impl = CosyVoice_stream_impl_(
+            flow, hift, chunk_size_list, mel_cache_len, n_timesteps,
+            max_stream_sessions, session_ttl, session_max_bytes,
+            encoder_left_context=encoder_left_context,
+            longform_min_tokens=longform_min_tokens,
+        )
         self.cosy_impl = cosy_impl.to(self.device, self.dtype)
         if enable_cuda_graph:
             self.cosy_impl.flow.scatter_cuda_graph(enable_cuda_graph)
@@ -381,12 +582,50 @@ class CosyVoice:
                             prompt_token: torch.Tensor,
                             prompt_feat: torch.Tensor,
                             embedding: torch.Tensor,
+                            n_timesteps: Optional[int] = None,  # None: the model default
+                            solver: str = 'euler',  # see flow.ode_solvers
                             )->torch.Tensor:
         return self.cosy_impl.token2wav_nonstream(
             token,
             prompt_token,
             prompt_feat,
             embedding,
+            n_timesteps,
+            solver,
+        )
+    
+    # Just proxy
+    def token2wav_batch(self,
+                        tokens: List[torch.Tensor],    # vq0206 mixed seqs
+                        prompt_tokens: List[torch.Tensor],
+                        prompt_feats: List[torch.Tensor],
+                        embeddings: List[torch.Tensor],
+                        n_timesteps: Optional[int] = None,
+                        solver: str = 'euler',
+                        )->List[torch.Tensor]:
+        return self.cosy_impl.token2wav_batch(
+            tokens,
+            prompt_tokens,
+            prompt_feats,
+            embeddings,
+            n_timesteps,
+            solver,
+        )
+    
+    # Just proxy
+    def token2wav_longform(self,
+                           token: torch.Tensor,    # vq0206 mixed seq
+                           prompt_token: torch.Tensor,
+                           prompt_feat: torch.Tensor,
+                           embedding: torch.Tensor,
+                           n_timesteps: Optional[int] = None,
+                           )->torch.Tensor:
+        return self.cosy_impl.token2wav_longform(
+            token,
+            prompt_token,
+            prompt_feat,
+            embedding,
+            n_timesteps,
         )
     
     # Just proxy
@@ -407,5 +646,13 @@ class CosyVoice:
             last_chunk,
         )
 
+    # Just proxy
+    def open_session(self, session_id: str, timeout: Optional[float] = None):
+        self.cosy_impl.open_session(session_id, timeout)
+
     def clean_up(self, session_id: str):
         self.cosy_impl.clean_up(session_id)
+
+    # Just proxy
+    def get_session_stats(self)->dict:
+        return self.cosy_impl.get_session_stats()
@@ -43,6 +43,10 @@ class CosyVoiceFrontEnd(object):
             audio_sr = 16000
         feat = kaldi.fbank(audio, num_mel_bins=80, dither=0, sample_frequency=16000)
         feat = feat - feat.mean(dim=0, keepdim=True)
+        return self.extract_spk_embedding_from_fbank(feat)
+
+    def extract_spk_embedding_from_fbank(self, feat:torch.Tensor):
+        """campplus embedding from a mean-normalized 80-bin fbank (t, 80) at 16 kHz"""
         onnx_in = {
             self.campplus_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()
         }
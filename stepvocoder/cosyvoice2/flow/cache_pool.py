@@ -0,0 +1,154 @@
+"""
+Per-session cache slabs for the streaming flow decoder.
+
+Every streaming chunk runs `n_timesteps` DiT forwards, and each step writes
+a new conv / attention cache that the same step of the next chunk reads
+back. A `ChunkCacheSlab` holds that state for one session together with the
+DiT scratch buffers the step caches are assembled in and, optionally, the
+conformer encoder's attention caches. Attention caches are `RingCache`s of
+fixed capacity: the prompt plus a sliding window of recent frames, updated
+in place so a chunk costs the same however long the stream is. `ChunkCachePool`
+hands one slab to each session id, takes it back on release and reuses it
+for the next session, so chunks of different sessions can be interleaved
+without overwriting each other and without reallocating per chunk.
+"""
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+from stepvocoder.cosyvoice2.utils.ring_cache import RingCache
+
+
+class SessionLimitError(RuntimeError):
+    """All cache slabs are held by other sessions"""
+
+
+@dataclass
+class ChunkCacheSlab:
+    """
+    Preallocated streaming caches of one session
+
+    Attributes:
+        cnn_cache: shape (n_time, depth, 2, c1+c2, 2), decoder conv caches per step
+        att_cache: shape (n_time, depth, 2, nh, max_len, c * 2), decoder k/v caches per step
+        estimator_cnn_cache: shape (depth, 2, c1+c2, 2), DiT output buffer of one step
+        estimator_att_cache: shape (depth, 2, nh, max_len, c * 2), DiT output buffer of one step
+        conformer_att_cache1: shape (depth1, 1, nh, t1, c * 2), encoder k/v caches at token rate
+        conformer_att_cache2: shape (depth2, 1, nh, t2, c * 2), upsampled encoder k/v caches
+        att_ring, conformer_ring1, conformer_ring2: prompt/window bookkeeping of the buffers above
+    """
+    cnn_cache: torch.Tensor
+    att_cache: torch.Tensor
+    estimator_cnn_cache: torch.Tensor
+    estimator_att_cache: torch.Tensor
+    conformer_att_cache1: Optional[torch.Tensor] = None
+    conformer_att_cache2: Optional[torch.Tensor] = None
+    att_ring: RingCache = field(init=False)
+    conformer_ring1: Optional[RingCache] = field(init=False, default=None)
+    conformer_ring2: Optional[RingCache] = field(init=False, default=None)
+
+    def __post_init__(self):
+        self.att_ring = RingCache(self.att_cache)
+        if self.conformer_att_cache1 is not None:
+            self.conformer_ring1 = RingCache(self.conformer_att_cache1)
+            self.conformer_ring2 = RingCache(self.conformer_att_cache2)
+
+    def reset(self, window: Optional[int] = None, encoder_window: Optional[int] = None):
+        """
+        Start a new stream, its first chunk becomes the prompt of every cache
+
+        Args:
+            window: decoder frames kept besides the prompt, None keeps as many as fit
+            encoder_window: upsampled encoder frames kept besides the prompt,
+                half as many at token rate, None keeps as many as fit
+        """
+        self.att_ring.reset(window)
+        if self.conformer_ring1 is not None:
+            self.conformer_ring1.reset(None if encoder_window is None else encoder_window // 2)
+            self.conformer_ring2.reset(encoder_window)
+
+    @property
+    def n_timesteps(self) -> int:
+        return self.att_cache.shape[0]
+
+    @property
+    def max_len(self) -> int:
+        """Decoder attention cache capacity (frames): prompt + window"""
+        return self.att_cache.shape[4]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            ts.numel() * ts.element_size()
+            for ts in (
+                self.cnn_cache, self.att_cache, self.estimator_cnn_cache, self.estimator_att_cache,
+                self.conformer_att_cache1, self.conformer_att_cache2,
+            )
+            if ts is not None
+        )
+
+
+class ChunkCachePool:
+    """
+    Hand out one `ChunkCacheSlab` per streaming session
+
+    Slabs are allocated on first use and kept for reuse after release, so
+    memory grows to at most `max_sessions` slabs.
+    """
+
+    def __init__(self, allocate: Callable[[], ChunkCacheSlab], max_sessions: int = 4):
+        """
+        Args:
+            allocate: creates an empty slab on the decoder's device and dtype
+            max_sessions: number of sessions that may hold a slab at once
+        """
+        assert max_sessions > 0, max_sessions
+        self.allocate = allocate
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, ChunkCacheSlab] = {}
+        self._free: List[ChunkCacheSlab] = []
+        self._cond = threading.Condition()
+
+    def acquire(self, session_id: str, timeout: Optional[float] = 0) -> ChunkCacheSlab:
+        """
+        Args:
+            session_id: owner of the slab, a session that already holds one gets it back
+            timeout: seconds to wait for another session to release its slab,
+                0 fails at once, None waits forever
+        Returns:
+            ChunkCacheSlab: the session's slab
+        """
+        with self._cond:
+            if session_id in self._sessions:
+                return self._sessions[session_id]
+            has_slot = lambda: len(self._sessions) < self.max_sessions
+            if not self._cond.wait_for(has_slot, timeout=timeout):
+                raise SessionLimitError(
+                    f"{len(self._sessions)} streaming sessions are active (max {self.max_sessions})"
+                )
+            slab = self._free.pop() if self._free else self.allocate()
+            self._sessions[session_id] = slab
+            return slab
+
+    def get(self, session_id: str) -> Optional[ChunkCacheSlab]:
+        with self._cond:
+            return self._sessions.get(session_id)
+
+    def release(self, session_id: str):
+        with self._cond:
+            slab = self._sessions.pop(session_id, None)
+            if slab is not None:
+                self._free.append(slab)
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            slabs = list(self._sessions.values()) + self._free
+            return {
+                "active": len(self._sessions),
+                "idle": len(self._free),
+                "max_sessions": self.max_sessions,
+                "bytes": sum(slab.nbytes for slab in slabs),
+            }
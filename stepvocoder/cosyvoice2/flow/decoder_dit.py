@@ -403,9 +403,6 @@ class DiT(nn.Module):
         self.inference_buffers_chunk = {}
         self.max_size_chunk = {}
 
-        self.register_buffer('att_cache_buffer', torch.zeros((16, 2, 8, 1000, 128)), persistent=False)
-        self.register_buffer('cnn_cache_buffer', torch.zeros((16, 2, 1024, 2)), persistent=False)
-
     def initialize_weights(self):
         # Initialize transformer layers:
         def _basic_init(module):
@@ -430,23 +427,28 @@ class DiT(nn.Module):
         nn.init.constant_(self.final_layer.linear.weight, 0)
         nn.init.constant_(self.final_layer.linear.bias, 0)
 
-    def _init_cuda_graph_chunk(self):
-        # get dtype, device from registered buffer
-        dtype, device = self.cnn_cache_buffer.dtype, self.cnn_cache_buffer.device
+    def _init_cuda_graph_chunk(self, batch_sizes=(2,)):
+        """
+        Args:
+            batch_sizes: 2 for CFG steps (conditional + unconditional rows),
+                1 for steps that run the conditional row alone
+        """
+        # get dtype, device from the weights
+        dtype, device = self.in_proj.weight.dtype, self.in_proj.weight.device
         # init cuda graph for streaming forward
         with torch.no_grad():
-            for chunk_size in [30, 48, 96]:
+            for batch_size, chunk_size in ((b, c) for b in batch_sizes for c in [30, 48, 96]):
                 if chunk_size == 30 or chunk_size == 48:
                     max_size = 500
                     self.max_size_chunk[chunk_size] = max_size
                 else:
                     max_size = 1000
                     self.max_size_chunk[chunk_size] = max_size
-                static_x1 = torch.zeros((2, 320, chunk_size), dtype=dtype, device=device)
-                static_t1 = torch.zeros((2, 1, 512), dtype=dtype, device=device)
-                static_mask1 = torch.ones((2, chunk_size, max_size+chunk_size), dtype=torch.bool, device=device)
-                static_att_cache = torch.zeros((16, 2, 8, max_size, 128), dtype=dtype, device=device)
-                static_cnn_cache = torch.zeros((16, 2, 1024, 2), dtype=dtype, device=device)
+                static_x1 = torch.zeros((batch_size, 320, chunk_size), dtype=dtype, device=device)
+                static_t1 = torch.zeros((batch_size, 1, 512), dtype=dtype, device=device)
+                static_mask1 = torch.ones((batch_size, chunk_size, max_size+chunk_size), dtype=torch.bool, device=device)
+                static_att_cache = torch.zeros((16, batch_size, 8, max_size, 128), dtype=dtype, device=device)
+                static_cnn_cache = torch.zeros((16, batch_size, 1024, 2), dtype=dtype, device=device)
                 static_inputs1 = [
                     static_x1, 
                     static_t1, 
@@ -454,8 +456,8 @@ class DiT(nn.Module):
                     static_cnn_cache, 
                     static_att_cache, 
                 ]
-                static_new_cnn_cache = torch.zeros((16, 2, 1024, 2), dtype=dtype, device=device)
-                static_new_att_cache = torch.zeros((16, 2, 8, max_size+chunk_size, 128), dtype=dtype, device=device)
+                static_new_cnn_cache = torch.zeros((16, batch_size, 1024, 2), dtype=dtype, device=device)
+                static_new_att_cache = torch.zeros((16, batch_size, 8, max_size+chunk_size, 128), dtype=dtype, device=device)
                 self.blocks_forward_chunk(
                     static_inputs1[0], 
                     static_inputs1[1], 
@@ -468,14 +470,14 @@ class DiT(nn.Module):
                 with torch.cuda.graph(graph_chunk):
                     static_out1 = self.blocks_forward_chunk(static_x1, static_t1, static_mask1, static_cnn_cache, static_att_cache, static_new_cnn_cache, static_new_att_cache)
                 static_outputs1 = [static_out1, static_new_cnn_cache, static_new_att_cache]
-                self.inference_buffers_chunk[chunk_size] = {
+                self.inference_buffers_chunk[(batch_size, chunk_size)] = {
                     'static_inputs': static_inputs1,
                     'static_outputs': static_outputs1
                 }
-                self.graph_chunk[chunk_size] = graph_chunk
+                self.graph_chunk[(batch_size, chunk_size)] = graph_chunk
 
-    def _init_cuda_graph_all(self):
-        self._init_cuda_graph_chunk()
+    def _init_cuda_graph_all(self, batch_sizes=(2,)):
+        self._init_cuda_graph_chunk(batch_sizes)
         self.use_cuda_graph = True
         print(f"CUDA Graph initialized successfully for chunk decoder")
 
@@ -518,6 +520,8 @@ class DiT(nn.Module):
                       cond: torch.Tensor, 
                       cnn_cache: torch.Tensor = None,
                       att_cache: torch.Tensor = None,
+                      cnn_cache_buffer: torch.Tensor = None,
+                      att_cache_buffer: torch.Tensor = None,
                       ):
         """
         Args:
@@ -528,6 +532,15 @@ class DiT(nn.Module):
             cond: shape (b, dt, c)
             cnn_cache: shape (depth, b, c1+c2, 2)
             att_cache: shape (depth, b, nh, t, c * 2)
+            cnn_cache_buffer: shape (depth, b, c1+c2, 2), receives the new conv caches
+            att_cache_buffer: shape (depth, b, nh, max_len, c * 2), receives the new k/v caches
+                None allocates both for this call. With CUDA graphs the new
+                caches are the graph's static outputs instead.
+        Returns:
+            x, new_cnn_cache, new_att_cache. new_att_cache holds this chunk's
+            frames first, then the cache's. A buffer shorter than that keeps
+            the first `max_len` frames, e.g. a buffer of `dt` frames gets
+            exactly the chunk's k/v.
         """
 
         # time
@@ -548,27 +561,32 @@ class DiT(nn.Module):
             last_att_len = att_cache.shape[3]
         else:
             last_att_len = 0
-        chunk_size = x.shape[2]
-        mask = torch.ones(x.shape[0], chunk_size, last_att_len+chunk_size, dtype=torch.bool, device=x.device)
-        if self.use_cuda_graph and att_cache[0] is not None and chunk_size in self.graph_chunk and last_att_len <= self.max_size_chunk[chunk_size]:
-            padded_mask = torch.zeros((2, chunk_size, self.max_size_chunk[chunk_size]+chunk_size), dtype=mask.dtype, device=mask.device)
+        batch_size, chunk_size = x.shape[0], x.shape[2]
+        graph_key = (batch_size, chunk_size)
+        mask = torch.ones(batch_size, chunk_size, last_att_len+chunk_size, dtype=torch.bool, device=x.device)
+        if self.use_cuda_graph and att_cache[0] is not None and graph_key in self.graph_chunk and last_att_len <= self.max_size_chunk[chunk_size]:
+            padded_mask = torch.zeros((batch_size, chunk_size, self.max_size_chunk[chunk_size]+chunk_size), dtype=mask.dtype, device=mask.device)
             padded_mask[:, :, :mask.shape[-1]] = mask
-            padded_att_cache = torch.zeros((16, 2, 8, self.max_size_chunk[chunk_size], 128), dtype=att_cache.dtype, device=att_cache.device)
+            padded_att_cache = torch.zeros((16, batch_size, 8, self.max_size_chunk[chunk_size], 128), dtype=att_cache.dtype, device=att_cache.device)
             padded_att_cache[:, :, :, :last_att_len, :] = att_cache
-            self.inference_buffers_chunk[chunk_size]['static_inputs'][0].copy_(x)
-            self.inference_buffers_chunk[chunk_size]['static_inputs'][1].copy_(t)
-            self.inference_buffers_chunk[chunk_size]['static_inputs'][2].copy_(padded_mask)
-            self.inference_buffers_chunk[chunk_size]['static_inputs'][3].copy_(cnn_cache)
-            self.inference_buffers_chunk[chunk_size]['static_inputs'][4].copy_(padded_att_cache)
-            self.graph_chunk[chunk_size].replay()
-            x = self.inference_buffers_chunk[chunk_size]['static_outputs'][0][:, :, :chunk_size]
-            new_cnn_cache = self.inference_buffers_chunk[chunk_size]['static_outputs'][1]
-            new_att_cache = self.inference_buffers_chunk[chunk_size]['static_outputs'][2][:, :, :, :chunk_size+last_att_len, :]          
+            self.inference_buffers_chunk[graph_key]['static_inputs'][0].copy_(x)
+            self.inference_buffers_chunk[graph_key]['static_inputs'][1].copy_(t)
+            self.inference_buffers_chunk[graph_key]['static_inputs'][2].copy_(padded_mask)
+            self.inference_buffers_chunk[graph_key]['static_inputs'][3].copy_(cnn_cache)
+            self.inference_buffers_chunk[graph_key]['static_inputs'][4].copy_(padded_att_cache)
+            self.graph_chunk[graph_key].replay()
+            x = self.inference_buffers_chunk[graph_key]['static_outputs'][0][:, :, :chunk_size]
+            new_cnn_cache = self.inference_buffers_chunk[graph_key]['static_outputs'][1]
+            new_att_cache = self.inference_buffers_chunk[graph_key]['static_outputs'][2][:, :, :, :chunk_size+last_att_len, :]          
         else:
             mask = None
-            x = self.blocks_forward_chunk(x, t, mask, cnn_cache, att_cache, self.cnn_cache_buffer, self.att_cache_buffer)
-            new_cnn_cache = self.cnn_cache_buffer
-            new_att_cache = self.att_cache_buffer[:, :, :, :last_att_len+chunk_size, :]
+            if cnn_cache_buffer is None:
+                attn = self.blocks[0].attn
+                cnn_cache_buffer = x.new_zeros((len(self.blocks), batch_size, 2 * self.in_proj.out_features, 2))
+                att_cache_buffer = x.new_zeros((len(self.blocks), batch_size, attn.num_heads, last_att_len+chunk_size, 2 * attn.head_dim))
+            x = self.blocks_forward_chunk(x, t, mask, cnn_cache, att_cache, cnn_cache_buffer, att_cache_buffer)
+            new_cnn_cache = cnn_cache_buffer
+            new_att_cache = att_cache_buffer[:, :, :, :min(last_att_len+chunk_size, att_cache_buffer.shape[3]), :]
 
         return x, new_cnn_cache, new_att_cache
     
@@ -579,7 +597,9 @@ class DiT(nn.Module):
             x, this_new_cnn_cache, this_new_att_cache \
                 = block.forward_chunk(x, t, cnn_cache[b_idx], att_cache[b_idx], mask)
             cnn_cache_buffer[b_idx] = this_new_cnn_cache
-            att_cache_buffer[b_idx][:, :, :this_new_att_cache.shape[2], :] = this_new_att_cache
+            # new frames come first, a short buffer keeps the chunk's own k/v
+            new_att_len = min(this_new_att_cache.shape[2], att_cache_buffer.shape[3])
+            att_cache_buffer[b_idx][:, :, :new_att_len, :] = this_new_att_cache[:, :, :new_att_len, :]
         x = self.final_layer(x, t)
         x = x.transpose(1, 2)
         return x
@@ -11,11 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import dataclasses
+from typing import Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
 from stepvocoder.cosyvoice2.utils.mask import make_pad_mask
+from stepvocoder.cosyvoice2.flow.cache_pool import ChunkCacheSlab
 from stepvocoder.cosyvoice2.flow.flow_matching import CausalConditionalCFM
 from stepvocoder.cosyvoice2.transformer.upsample_encoder_v2 import UpsampleConformerEncoderV2
 
@@ -71,6 +74,7 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   n_timesteps: int = 10,
+                  solver: str = 'euler',
                   ):
         assert token.shape[0] == 1
 
@@ -105,32 +109,152 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             spks=embedding,
             cond=conds,
             n_timesteps=n_timesteps,
+            solver=solver,
         )
 
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat
 
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        n_timesteps: int = 10,
+                        solver: str = 'euler',
+                        ):
+        """
+        Batched `inference` for right-padded requests.
+
+        Each row is packed as [prompt_i, token_i] from position 0 and padded on
+        the right, so every item keeps the positions and initial noise it gets
+        when decoded alone. Attention in the encoder and the DiT is masked to
+        valid frames and all other convolutions are causal, hence padding does
+        not change any item's mel.
+
+        Args:
+            token: shape (b, t, 2), padded target tokens
+            token_len: shape (b,)
+            prompt_token: shape (b, t_p, 2), padded prompt tokens
+            prompt_token_len: shape (b,)
+            prompt_feat: shape (b, t_m, c), padded prompt mel, t_m = t_p * up_rate
+            prompt_feat_len: shape (b,), equal to prompt_token_len * up_rate
+            embedding: shape (b, 192), speaker embedding
+            solver: ODE solver name, see `ode_solvers.ODE_SOLVERS`
+        Returns:
+            feats: list of b mels, each of shape (1, c, token_len_i * up_rate)
+        """
+        batch_size = token.shape[0]
+        assert torch.equal(prompt_feat_len, prompt_token_len * self.up_rate), (prompt_feat_len, prompt_token_len)
+
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat text and prompt_text per item, padding moves to the right end
+        total_len = prompt_token_len + token_len
+        packed = token.new_zeros((batch_size, int(total_len.max()), *token.shape[2:]))
+        for i in range(batch_size):
+            p_len, t_len = int(prompt_token_len[i]), int(token_len[i])
+            packed[i, :p_len] = prompt_token[i, :p_len]
+            packed[i, p_len:p_len + t_len] = token[i, :t_len]
+
+        mask = (~make_pad_mask(total_len)).unsqueeze(-1).to(embedding)
+        packed = self.input_embedding(torch.clamp(packed, min=0)) * mask
+
+        # token encode
+        h, _ = self.encoder.forward(packed, total_len)
+        h = self.encoder_proj(h)
+
+        # condition
+        conds = torch.zeros_like(h)
+        for i in range(batch_size):
+            conds[i, :prompt_feat_len[i]] = prompt_feat[i, :prompt_feat_len[i]]
+        conds = conds.transpose(1, 2).contiguous()
+
+        mel_len = total_len * self.up_rate
+        mask = (~make_pad_mask(mel_len, h.shape[1])).to(h)
+
+        feat = self.decoder.forward(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            solver=solver,
+        )
+
+        return [
+            feat[i:i + 1, :, int(prompt_feat_len[i]):int(mel_len[i])]
+            for i in range(batch_size)
+        ]
+
+    def allocate_chunk_cache(self,
+                             n_timesteps: int,
+                             max_len: int = 1000,
+                             encoder_max_len: int = 2000,
+                             device=None,
+                             dtype=None,
+                             ) -> ChunkCacheSlab:
+        """
+        Args:
+            n_timesteps: denoising steps per chunk
+            max_len: decoder attention cache capacity (mel frames), prompt + window
+            encoder_max_len: encoder attention cache capacity (mel frames), prompt + window
+            device, dtype: default to the decoder's
+        Returns:
+            ChunkCacheSlab: zeroed encoder and decoder caches for one streaming session
+        """
+        slab = self.decoder.allocate_chunk_cache(n_timesteps, max_len, device, dtype)
+        conformer_att_cache1, conformer_att_cache2 = self.encoder.allocate_att_cache(
+            encoder_max_len, slab.att_cache.device, slab.att_cache.dtype,
+        )
+        return dataclasses.replace(
+            slab, conformer_att_cache1=conformer_att_cache1, conformer_att_cache2=conformer_att_cache2,
+        )
+
+    @staticmethod
+    def _append_conformer_cache(cache_slab: ChunkCacheSlab, new_att_cache1: torch.Tensor, new_att_cache2: torch.Tensor):
+        """Write a chunk's encoder k/v over the oldest frames of the session's rings"""
+        for ring, new_att_cache in (
+            (cache_slab.conformer_ring1, new_att_cache1),
+            (cache_slab.conformer_ring2, new_att_cache2),
+        ):
+            ring.write(new_att_cache)
+            ring.advance(new_att_cache.shape[-2])
+
     @torch.inference_mode()
     def setup_cache(self, 
                     token: torch.Tensor, 
                     mel: torch.Tensor, 
                     spk: torch.Tensor, 
                     n_timesteps: int = 10,
+                    cache_slab: Optional[ChunkCacheSlab] = None,
                     ):
         """
         Args:
             token: shape (b, t), with look ahead tokens
             mel: shape (b, t, c), groundtruth mel
             spk: shape (b, 192), speaker embedding
+            cache_slab: the session's cache buffers from `allocate_chunk_cache`,
+                `reset` with the windows to keep. None allocates them.
         Returns:
             cache: dict {
-                'conformer': {'cnn_cache': xxx, 'att_cache': xxx}, 
-                'estimator': {'cnn_cache': xxx, 'att_cache': xxx}
+                'conformer_cnn_cache': xxx,
+                'cache_slab': encoder and estimator attention caches,
             }
         """
         # check if look ahead token included
         assert (token.shape[1] - self.pre_lookahead_len) * self.up_rate == mel.shape[1], (token.shape, mel.shape)
+        if cache_slab is None:
+            cache_slab = self.allocate_chunk_cache(n_timesteps)
+            cache_slab.reset()
+        assert cache_slab.conformer_ring1 is not None, 'allocate the slab with CausalMaskedDiffWithXvec.allocate_chunk_cache'
 
         # xvec projection
         spk = F.normalize(spk, dim=1)
@@ -138,29 +262,29 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
 
         token = self.input_embedding(token)
         # NOTE encoder.forward_chunk will strip the look ahead part
-        h, conformer_cnn_cache, conformer_att_cache = self.encoder.forward_chunk(
+        h, conformer_cnn_cache, conformer_att_cache1, conformer_att_cache2 = self.encoder.forward_chunk(
             xs = token,
             last_chunk = False,
             cnn_cache = None,
-            att_cache = None,
+            att_cache1 = None,
+            att_cache2 = None,
         )
+        # the prompt's k/v stay at the front of the rings
+        self._append_conformer_cache(cache_slab, conformer_att_cache1, conformer_att_cache2)
         h = self.encoder_proj(h)
 
-        feat, estimator_cnn_cache, estimator_att_cache = self.decoder.forward_chunk(
+        self.decoder.forward_chunk(
             mu = h.transpose(1, 2).contiguous(),
             spks = spk,
             cond = mel.transpose(1, 2).contiguous(),
             n_timesteps = n_timesteps,
             temperature = 1.0,
-            cnn_cache = None,
-            att_cache = None,
+            cache_slab = cache_slab,
         )
 
         cache = {
             'conformer_cnn_cache': conformer_cnn_cache,
-            'conformer_att_cache': conformer_att_cache,
-            'estimator_cnn_cache': estimator_cnn_cache,
-            'estimator_att_cache': estimator_att_cache,
+            'cache_slab': cache_slab,
         }
         return cache
 
@@ -178,14 +302,13 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             spk: shape (b, 192), speaker embedding
             cache: dict {
                 'conformer_cnn_cache': xxx,
-                ...
-            }
+                'cache_slab': xxx,
+            }, from `setup_cache`. The slab's attention caches are updated
+                in place, their size does not depend on the stream length.
         """
         # unpack cache
         conformer_cnn_cache = cache['conformer_cnn_cache']
-        conformer_att_cache = cache['conformer_att_cache']
-        estimator_cnn_cache = cache['estimator_cnn_cache']
-        estimator_att_cache = cache['estimator_att_cache']
+        cache_slab = cache['cache_slab']
 
         # xvec projection
         spk = F.normalize(spk, dim=1)
@@ -193,32 +316,32 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
 
         token = self.input_embedding(token)
         # if not the last chunk, h is shorter than xs for a length of lookahead_length * stride (6)
-        h, conformer_cnn_cache, conformer_att_cache = self.encoder.forward_chunk(
+        # the encoder has relative positions, it reads the rings in time order
+        h, conformer_cnn_cache, conformer_att_cache1, conformer_att_cache2 = self.encoder.forward_chunk(
             xs = token,
             last_chunk = last_chunk,
             cnn_cache = conformer_cnn_cache,
-            att_cache = conformer_att_cache,
+            att_cache1 = cache_slab.conformer_ring1.segments(),
+            att_cache2 = cache_slab.conformer_ring2.segments(),
         )
+        self._append_conformer_cache(cache_slab, conformer_att_cache1, conformer_att_cache2)
         h = self.encoder_proj(h)
 
         cond = torch.zeros_like(h)
         # forward estimator
-        feat, estimator_cnn_cache, estimator_att_cache = self.decoder.forward_chunk(
+        feat, _, _ = self.decoder.forward_chunk(
             mu = h.transpose(1, 2).contiguous(),
             spks = spk,
             cond = cond.transpose(1, 2).contiguous(),
             n_timesteps = n_timesteps,
             temperature = 1.0,
-            cnn_cache = estimator_cnn_cache,
-            att_cache = estimator_att_cache,
+            cache_slab = cache_slab,
         )
 
 
         new_cache = {
             'conformer_cnn_cache': conformer_cnn_cache,
-            'conformer_att_cache': conformer_att_cache,
-            'estimator_cnn_cache': estimator_cnn_cache,
-            'estimator_att_cache': estimator_att_cache,
+            'cache_slab': cache_slab,
         }
 
         return feat, new_cache
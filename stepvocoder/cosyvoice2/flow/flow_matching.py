@@ -11,12 +11,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import List
+from typing import List, Optional, Tuple
 import onnxruntime
 import torch
 import torch.nn.functional as F
 
+from stepvocoder.cosyvoice2.flow.cache_pool import ChunkCacheSlab
 from stepvocoder.cosyvoice2.flow.decoder_dit import DiT
+from stepvocoder.cosyvoice2.flow.ode_solvers import ODE_SOLVERS, get_solver
 from stepvocoder.cosyvoice2.utils.mask import make_pad_mask
 
 
@@ -24,28 +26,65 @@ from stepvocoder.cosyvoice2.utils.mask import make_pad_mask
 Inference wrapper
 """
 class CausalConditionalCFM(torch.nn.Module):
-    def __init__(self, estimator: DiT, inference_cfg_rate:float=0.7):
+    def __init__(self, 
+                 estimator: DiT, 
+                 inference_cfg_rate:float=0.7, 
+                 cfg_interval:Tuple[float, float]=(0.0, 1.0),
+                 ):
+        """
+        Args:
+            cfg_interval: classifier-free guidance is applied for t in this
+                closed interval only; other steps run the conditional branch
+                alone at half the batch. (0, 1) guides every step.
+        """
         super().__init__()
         self.estimator = estimator
         self.inference_cfg_rate = inference_cfg_rate
+        self.cfg_interval = tuple(cfg_interval)
         self.out_channels = estimator.out_channels
          # a maximum of 600s
         self.register_buffer('rand_noise', torch.randn([1, self.out_channels, 50 * 600]), persistent=False)
 
-        self.register_buffer('cnn_cache_buffer', torch.zeros(16, 16, 2, 1024, 2), persistent=False)
-        self.register_buffer('att_cache_buffer', torch.zeros(16, 16, 2, 8, 1000, 128), persistent=False)
-
     def scatter_cuda_graph(self, enable_cuda_graph: bool):
         if enable_cuda_graph:
-            self.estimator._init_cuda_graph_all()
+            # unguided steps run the conditional row alone, capture those shapes too
+            batch_sizes = (2,) if self.cfg_interval == (0.0, 1.0) else (2, 1)
+            self.estimator._init_cuda_graph_all(batch_sizes)
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+    def allocate_chunk_cache(self, n_timesteps:int, max_len:int=1000, device=None, dtype=None) -> ChunkCacheSlab:
         """
-        Fixed euler solver for ODEs.
         Args:
-            x (torch.Tensor): random noise
-            t_span (torch.Tensor): n_timesteps interpolated
-                shape: (n_timesteps + 1,)
+            n_timesteps: denoising steps per chunk
+            max_len: attention cache capacity (frames), prompt + window, and
+                longest chunk
+            device, dtype: default to the estimator's
+        Returns:
+            ChunkCacheSlab: zeroed caches for one streaming session
+        """
+        param = self.estimator.in_proj.weight
+        device = device or param.device
+        dtype = dtype or param.dtype
+        depth = len(self.estimator.blocks)
+        attn = self.estimator.blocks[0].attn
+        # the conv block caches 2 frames of its input and of its hidden layer
+        cnn_shape = (depth, 2, 2 * self.estimator.in_proj.out_features, 2)
+        att_shape = (depth, 2, attn.num_heads, max_len, 2 * attn.head_dim)
+        return ChunkCacheSlab(
+            cnn_cache = torch.zeros((n_timesteps, *cnn_shape), device=device, dtype=dtype),
+            att_cache = torch.zeros((n_timesteps, *att_shape), device=device, dtype=dtype),
+            estimator_cnn_cache = torch.zeros(cnn_shape, device=device, dtype=dtype),
+            estimator_att_cache = torch.zeros(att_shape, device=device, dtype=dtype),
+        )
+
+    def use_cfg(self, t: torch.Tensor, cfg_interval: Optional[Tuple[float, float]] = None) -> bool:
+        """Whether the step at time `t` evaluates the unconditional branch"""
+        low, high = cfg_interval or self.cfg_interval
+        return low <= float(t) <= high
+
+    def guided_velocity(self, mu, mask, spks, cond, cfg_interval=None):
+        """
+        Classifier-free guided velocity field for the ODE solvers.
+        Args:
             mu (torch.Tensor): output of encoder
                 shape: (batch_size, n_feats, mel_timesteps)
             mask (torch.Tensor): output_mask
@@ -53,9 +92,12 @@ class CausalConditionalCFM(torch.nn.Module):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_interval: overrides `self.cfg_interval`
+        Returns:
+            velocity(x, t): one DiT forward over the conditional and
+                unconditional rows (2 * batch_size) inside the guidance
+                interval, over the conditional rows only outside it
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
         assert self.inference_cfg_rate > 0, 'inference_cfg_rate better > 0'
 
         # constant during denoising
@@ -63,11 +105,12 @@ class CausalConditionalCFM(torch.nn.Module):
         mu_in = torch.cat([mu, torch.zeros_like(mu)], dim=0)
         spks_in = torch.cat([spks, torch.zeros_like(spks)], dim=0)
         cond_in = torch.cat([cond, torch.zeros_like(cond)], dim=0)
-        
-        for step in range(1, len(t_span)):
 
+        def velocity(x, t):
+            if not self.use_cfg(t, cfg_interval):
+                return self.estimator.forward(x, mask, mu, t.reshape(1).expand(x.size(0)), spks, cond)
             x_in = torch.cat([x, x], dim=0)
-            t_in = torch.cat([t, t], dim=0)
+            t_in = t.reshape(1).expand(2 * x.size(0))
 
             dphi_dt = self.estimator.forward(
                 x_in,
@@ -78,21 +121,41 @@ class CausalConditionalCFM(torch.nn.Module):
                 cond_in,
             )
             dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+            return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
 
-        return x
+        return velocity
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+        """
+        Fixed euler solver for ODEs.
+        Args:
+            x (torch.Tensor): random noise
+            t_span (torch.Tensor): n_timesteps interpolated
+                shape: (n_timesteps + 1,)
+            mu (torch.Tensor): output of encoder
+                shape: (batch_size, n_feats, mel_timesteps)
+            mask (torch.Tensor): output_mask
+                shape: (batch_size, 1, mel_timesteps)
+            spks (torch.Tensor, optional): speaker ids. Defaults to None.
+                shape: (batch_size, spk_emb_dim)
+            cond: Not used but kept for future purposes
+        """
+        return ODE_SOLVERS['euler'].solve(self.guided_velocity(mu, mask, spks, cond), x, t_span, mask)
 
     @torch.inference_mode()
-    def forward(self, mu, mask, spks, cond, n_timesteps=10, temperature=1.0):
-        z = self.rand_noise[:, :, :mu.size(2)] * temperature
+    def forward(self, mu, mask, spks, cond, n_timesteps=10, temperature=1.0, solver: str = 'euler', cfg_interval=None):
+        """
+        Args:
+            solver: name in `ODE_SOLVERS`; NFE per solve is `get_solver(solver).nfe(n_timesteps)`
+            cfg_interval: overrides `self.cfg_interval` for this call
+        """
+        # every item starts from the same noise prefix, so a right-padded batch
+        # row sees exactly the noise it would see when decoded alone
+        z = self.rand_noise[:, :, :mu.size(2)].expand(mu.size(0), -1, -1) * temperature
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         # cosine scheduling
         t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span, mu, mask, spks, cond)
+        return get_solver(solver).solve(self.guided_velocity(mu, mask, spks, cond, cfg_interval), z, t_span, mask)
 
     def solve_euler_chunk(self, 
                           x:torch.Tensor, 
@@ -102,6 +165,7 @@ class CausalConditionalCFM(torch.nn.Module):
                           cond:torch.Tensor, 
                           cnn_cache:torch.Tensor=None,
                           att_cache:torch.Tensor=None,
+                          cache_slab:Optional[ChunkCacheSlab]=None,
                           ):
         """
         Fixed euler solver for ODEs.
@@ -118,23 +182,46 @@ class CausalConditionalCFM(torch.nn.Module):
             cond: Not used but kept for future purposes
             cnn_cache: shape (n_time, depth, b, c1+c2, 2)
             att_cache: shape (n_time, depth, b, nh, t, c * 2)
+            cache_slab: the session's buffers holding the caches of the
+                previous chunks, this chunk's are written into it in place
+                and returned as views. None allocates buffers sized for this
+                chunk, with `cnn_cache` / `att_cache` as the previous caches.
+
+        Steps outside `cfg_interval` run the conditional row alone and feed it
+        the conditional half of their caches. Whether a step is guided depends
+        only on its t, which is the same for every chunk, so the unconditional
+        cache row of an unguided step is never read.
+
+        The attention caches are a prompt plus a ring of recent frames (see
+        `ChunkCacheSlab.reset`). The DiT attention has no positional encoding,
+        so the order of the cached frames does not matter and the ring is
+        read as is, without unrolling it.
         """
         assert self.inference_cfg_rate > 0, 'cfg rate should be > 0'
         
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)  # (b,)
+        n_timesteps, chunk_len = len(t_span) - 1, x.shape[2]
 
-        # setup initial cache
-        if cnn_cache is None:
-            cnn_cache = [None for _ in range(len(t_span)-1)]
-        if att_cache is None:
-            att_cache = [None for _ in range(len(t_span)-1)]
-        # next chunk's cache at each timestep
-
-        if att_cache[0] is not None:
-            last_att_len = att_cache.shape[4]
+        if cache_slab is None:
+            # one-off buffers: the given caches are the prompt, nothing is dropped
+            last_att_len = att_cache.shape[4] if att_cache is not None else 0
+            cache_slab = self.allocate_chunk_cache(n_timesteps, last_att_len + chunk_len, x.device, x.dtype)
+            cache_slab.reset()
+            if att_cache is not None:
+                cache_slab.cnn_cache.copy_(cnn_cache)
+                cache_slab.att_ring.write(att_cache)
+                cache_slab.att_ring.advance(last_att_len)
         else:
-            last_att_len = 0
+            assert cnn_cache is None and att_cache is None, 'the caches are kept in cache_slab'
+        ring = cache_slab.att_ring
+        assert cache_slab.n_timesteps >= n_timesteps, (cache_slab.n_timesteps, n_timesteps)
+        assert cache_slab.estimator_att_cache.shape[3] >= chunk_len, \
+            f'chunk of {chunk_len} frames exceeds the cache buffers of {cache_slab.estimator_att_cache.shape[3]}'
+        # the first chunk has no caches yet, its k/v become the prompt
+        first_chunk = ring.prompt_len is None
+        # the DiT writes only the chunk's own k/v (they come first) into the scratch buffer
+        att_cache_buffer = cache_slab.estimator_att_cache[:, :, :, :chunk_len, :]
 
         # constant during denoising
         mu_in = torch.cat([mu, torch.zeros_like(mu)], dim=0)
@@ -143,30 +230,49 @@ class CausalConditionalCFM(torch.nn.Module):
         for step in range(1, len(t_span)):
             # torch.cuda.memory._record_memory_history(max_entries=100000)
             # torch.cuda.memory._record_memory_history(max_entries=100000)
-            this_att_cache = att_cache[step-1]
-            this_cnn_cache = cnn_cache[step-1]
-
-            dphi_dt, this_new_cnn_cache, this_new_att_cache = self.estimator.forward_chunk(
-                x = x.repeat(2, 1, 1),
-                mu = mu_in,
-                t = t.repeat(2),
-                spks = spks_in,
-                cond = cond_in,
-                cnn_cache = this_cnn_cache,
-                att_cache = this_att_cache,
-            )
-            dphi_dt, cfg_dphi_dt = dphi_dt.chunk(2, dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            this_att_cache = None if first_chunk else ring.view(cache_slab.att_cache[step-1])
+            this_cnn_cache = None if first_chunk else cache_slab.cnn_cache[step-1]
+
+            if self.use_cfg(t):
+                dphi_dt, this_new_cnn_cache, this_new_att_cache = self.estimator.forward_chunk(
+                    x = x.repeat(2, 1, 1),
+                    mu = mu_in,
+                    t = t.repeat(2),
+                    spks = spks_in,
+                    cond = cond_in,
+                    cnn_cache = this_cnn_cache,
+                    att_cache = this_att_cache,
+                    cnn_cache_buffer = cache_slab.estimator_cnn_cache,
+                    att_cache_buffer = att_cache_buffer,
+                )
+                dphi_dt, cfg_dphi_dt = dphi_dt.chunk(2, dim=0)
+                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
+            else:
+                # new caches broadcast into both rows of the buffers below
+                dphi_dt, this_new_cnn_cache, this_new_att_cache = self.estimator.forward_chunk(
+                    x = x,
+                    mu = mu,
+                    t = t,
+                    spks = spks,
+                    cond = cond,
+                    cnn_cache = this_cnn_cache[:, :1] if this_cnn_cache is not None else None,
+                    att_cache = this_att_cache[:, :1] if this_att_cache is not None else None,
+                    cnn_cache_buffer = cache_slab.estimator_cnn_cache,
+                    att_cache_buffer = att_cache_buffer,
+                )
             x = x + dt * dphi_dt
             t = t + dt
             if step < len(t_span) - 1:
                 dt = t_span[step + 1] - t
 
-            self.cnn_cache_buffer[step-1] = this_new_cnn_cache
-            self.att_cache_buffer[step-1][:, :, :, :x.shape[2]+last_att_len, :] = this_new_att_cache
+            # the step's input cache is consumed, overwrite it in place
+            cache_slab.cnn_cache[step-1] = this_new_cnn_cache
+            ring.write(this_new_att_cache[:, :, :, :chunk_len, :], out=cache_slab.att_cache[step-1])
+        # every step wrote the same slots
+        ring.advance(chunk_len)
         
-        cnn_cache = self.cnn_cache_buffer
-        att_cache = self.att_cache_buffer[:, :, :, :, :x.shape[2]+last_att_len, :]
+        cnn_cache = cache_slab.cnn_cache[:n_timesteps]
+        att_cache = ring.view(cache_slab.att_cache[:n_timesteps])
         return x, cnn_cache, att_cache
     
     @torch.inference_mode()
@@ -178,6 +284,7 @@ class CausalConditionalCFM(torch.nn.Module):
                       temperature:float=1.0, 
                       cnn_cache:torch.Tensor=None,
                       att_cache:torch.Tensor=None,
+                      cache_slab:Optional[ChunkCacheSlab]=None,
                       ):
         """
         Args:
@@ -186,9 +293,14 @@ class CausalConditionalCFM(torch.nn.Module):
             cond(torch.Tensor): shape (b, c, t)
             cnn_cache: shape (n_time, depth, b, c1+c2, 2)
             att_cache: shape (n_time, depth, b, nh, t, c * 2)
+            cache_slab: per-session buffers from `allocate_chunk_cache`,
+                replaces `cnn_cache` / `att_cache`
         """
         # get offset from att_cache
-        offset = att_cache.shape[4] if att_cache is not None else 0
+        if cache_slab is not None:
+            offset = cache_slab.att_ring.length
+        else:
+            offset = att_cache.shape[4] if att_cache is not None else 0
         z = self.rand_noise[:, :, offset:offset+mu.size(2)] * temperature
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         # cosine scheduling
@@ -201,5 +313,6 @@ class CausalConditionalCFM(torch.nn.Module):
             cond=cond,
             att_cache=att_cache,
             cnn_cache=cnn_cache,
+            cache_slab=cache_slab,
         )
         return x, new_cnn_cache, new_att_cache
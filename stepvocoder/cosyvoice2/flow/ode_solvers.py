@@ -0,0 +1,174 @@
+"""
+ODE solvers for the flow-matching decoder.
+
+The decoder integrates dx/dt = v(x, t) from noise at t=0 to a mel at t=1,
+where every evaluation of v is one DiT forward over the doubled CFG batch.
+The cost of a solve is its number of function evaluations (NFE):
+
+    solver      NFE for n steps   order
+    euler       n                 1
+    midpoint    2n                2
+    heun        2n                2
+    multistep   n                 2 (after the first step)
+    adaptive    <= 2n             2, step count chosen per input
+
+Fixed-step solvers walk the given `t_span` (the cosine schedule of
+`CausalConditionalCFM`). At equal NFE a second-order solver with n/2 steps
+is usually closer to the converged solution than Euler with n steps. Use
+`compare_flow_solvers.py` to measure this on real voices.
+"""
+from typing import Callable, Dict, Optional
+
+import torch
+
+# velocity(x, t) -> dx/dt, t is a 0-d tensor
+Velocity = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+
+
+class ODESolver:
+    """Integrate a velocity field over `t_span`"""
+
+    def nfe(self, n_timesteps: int) -> int:
+        """Velocity evaluations (DiT forwards) for `n_timesteps` steps; an upper bound for adaptive solvers"""
+        raise NotImplementedError
+
+    def solve(self, velocity: Velocity, x: torch.Tensor, t_span: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Args:
+            velocity: dx/dt as a function of (x, t)
+            x: shape (b, c, t), state at t_span[0]
+            t_span: shape (n_timesteps + 1,), increasing times
+            mask: shape (b, 1, t), valid frames, used by error control only
+        Returns:
+            x at t_span[-1]
+        """
+        raise NotImplementedError
+
+
+class EulerSolver(ODESolver):
+    def nfe(self, n_timesteps: int) -> int:
+        return n_timesteps
+
+    def solve(self, velocity, x, t_span, mask=None):
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step], t_span[step + 1] - t_span[step]
+            x = x + dt * velocity(x, t)
+        return x
+
+
+class MidpointSolver(ODESolver):
+    def nfe(self, n_timesteps: int) -> int:
+        return 2 * n_timesteps
+
+    def solve(self, velocity, x, t_span, mask=None):
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step], t_span[step + 1] - t_span[step]
+            x_mid = x + 0.5 * dt * velocity(x, t)
+            x = x + dt * velocity(x_mid, t + 0.5 * dt)
+        return x
+
+
+class HeunSolver(ODESolver):
+    def nfe(self, n_timesteps: int) -> int:
+        return 2 * n_timesteps
+
+    def solve(self, velocity, x, t_span, mask=None):
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step], t_span[step + 1] - t_span[step]
+            v1 = velocity(x, t)
+            v2 = velocity(x + dt * v1, t + dt)
+            x = x + 0.5 * dt * (v1 + v2)
+        return x
+
+
+class MultistepSolver(ODESolver):
+    """
+    Two-step Adams-Bashforth on a non-uniform grid
+
+    This is the DPM-Solver-2M update for a velocity-parameterized flow. It
+    reuses the previous velocity, so second order comes at Euler's cost.
+    """
+
+    def nfe(self, n_timesteps: int) -> int:
+        return n_timesteps
+
+    def solve(self, velocity, x, t_span, mask=None):
+        v_prev, dt_prev = None, None
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step], t_span[step + 1] - t_span[step]
+            v = velocity(x, t)
+            if v_prev is None:
+                x = x + dt * v
+            else:
+                r = dt / (2 * dt_prev)
+                x = x + dt * ((1 + r) * v - r * v_prev)
+            v_prev, dt_prev = v, dt
+        return x
+
+
+class AdaptiveSolver(ODESolver):
+    """
+    Heun with an embedded Euler error estimate and step size control
+
+    The first step is the first step of `t_span`. Later steps grow or
+    shrink so that the Heun-Euler difference stays within `rtol`/`atol`
+    over the valid frames. At most `2 * n_timesteps` evaluations are used;
+    once the budget runs low the solver finishes in one step. A batch
+    shares one step sequence, so batched results can differ slightly from
+    decoding each item alone.
+    """
+
+    def __init__(self, rtol: float = 0.05, atol: float = 0.05):
+        self.rtol = rtol
+        self.atol = atol
+
+    def nfe(self, n_timesteps: int) -> int:
+        return 2 * n_timesteps
+
+    def _error(self, err: torch.Tensor, x: torch.Tensor, x_new: torch.Tensor, mask: Optional[torch.Tensor]) -> float:
+        scale = self.atol + self.rtol * torch.maximum(x.abs(), x_new.abs())
+        ratio = (err / scale) ** 2
+        if mask is None:
+            return ratio.mean().sqrt().item()
+        mask = mask.to(ratio).expand_as(ratio)
+        return ((ratio * mask).sum() / mask.sum().clamp(min=1)).sqrt().item()
+
+    def solve(self, velocity, x, t_span, mask=None):
+        max_nfe = self.nfe(len(t_span) - 1)
+        t, t_end = t_span[0], t_span[-1]
+        h = t_span[1] - t_span[0]
+        v1, nfe = None, 0
+        while t < t_end:
+            if v1 is None:
+                v1 = velocity(x, t)
+                nfe += 1
+            # one evaluation left: finish in a single step
+            final = nfe + 1 >= max_nfe
+            last = final or bool(t + h >= t_end)
+            if last:
+                h = t_end - t
+            x_euler = x + h * v1
+            v2 = velocity(x_euler, t + h)
+            nfe += 1
+            x_heun = x + 0.5 * h * (v1 + v2)
+            err = self._error(0.5 * h * (v2 - v1), x, x_heun, mask)
+            if err <= 1.0 or final:
+                x, t, v1 = x_heun, (t_end if last else t + h), None
+            factor = 5.0 if err == 0 else min(5.0, max(0.2, 0.9 * err ** -0.5))
+            h = h * factor
+        return x
+
+
+ODE_SOLVERS: Dict[str, ODESolver] = {
+    "euler": EulerSolver(),
+    "midpoint": MidpointSolver(),
+    "heun": HeunSolver(),
+    "multistep": MultistepSolver(),
+    "adaptive": AdaptiveSolver(),
+}
+
+
+def get_solver(name: str) -> ODESolver:
+    if name not in ODE_SOLVERS:
+        raise ValueError(f"unknown ODE solver '{name}', choose from {sorted(ODE_SOLVERS)}")
+    return ODE_SOLVERS[name]
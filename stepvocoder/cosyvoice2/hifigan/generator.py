@@ -524,7 +524,7 @@ class HiFTGenerator(nn.Module):
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1).to(s.dtype)
-        if self.use_cuda_graph and x.shape[-1] in self.graph:
+        if self.use_cuda_graph and x.shape[0] == 1 and x.shape[-1] in self.graph:
             self.inference_buffers[x.shape[-1]]['static_inputs']['static_x'].copy_(x)
             self.inference_buffers[x.shape[-1]]['static_inputs']['static_s_stft'].copy_(s_stft)
             self.graph[x.shape[-1]].replay()
@@ -17,7 +17,7 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
 from torch import nn
@@ -126,6 +126,31 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    @staticmethod
+    def cat_cache_segments(
+        cache: List[torch.Tensor],
+        k: torch.Tensor,
+        v: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Prepend a cache given as chronological segments to k and v.
+
+        Args:
+            cache (List[torch.Tensor]): Cache segments (#batch, head, cache_t_i,
+                d_k * 2) in time order, e.g. a prompt and the two halves of a
+                wrapped ring buffer.
+            k (torch.Tensor): Key tensor (#batch, head, time1, d_k).
+            v (torch.Tensor): Value tensor (#batch, head, time1, d_k).
+
+        Returns:
+            torch.Tensor: Key tensor (#batch, head, sum(cache_t_i) + time1, d_k).
+            torch.Tensor: Value tensor (#batch, head, sum(cache_t_i) + time1, d_k).
+
+        """
+        d_k = k.size(-1)
+        k = torch.cat([seg[..., :d_k] for seg in cache] + [k], dim=2)
+        v = torch.cat([seg[..., d_k:] for seg in cache] + [v], dim=2)
+        return k, v
+
     def forward(
         self,
         query: torch.Tensor,
@@ -155,7 +180,8 @@ class MultiHeadedAttention(nn.Module):
                 CosyVoice.
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
-                and `head * d_k == size`
+                and `head * d_k == size`, or a list of chronological
+                segments, see `cat_cache_segments`
 
 
         Returns:
@@ -183,7 +209,9 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
+        if isinstance(cache, (list, tuple)):
+            k, v = self.cat_cache_segments(cache, k, v)
+        elif cache.size(0) > 0:
             key_cache, value_cache = torch.split(cache,
                                                  cache.size(-1) // 2,
                                                  dim=-1)
@@ -266,7 +294,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
                 (#batch, time2, size).
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
-                and `head * d_k == size`
+                and `head * d_k == size`, or a list of chronological
+                segments, see `cat_cache_segments`
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -292,7 +321,9 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache is not None and cache.size(0) > 0:
+        if isinstance(cache, (list, tuple)):
+            k, v = self.cat_cache_segments(cache, k, v)
+        elif cache is not None and cache.size(0) > 0:
             key_cache, value_cache = torch.split(cache, cache.size(-1) // 2, dim=-1)
             k = torch.cat([key_cache, k], dim=2)
             v = torch.cat([value_cache, v], dim=2)
@@ -371,11 +371,14 @@ class UpsampleConformerEncoderV2(torch.nn.Module):
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
         xs, pos_emb, masks = self.embed(xs, masks)
+        # zero padded frames so the lookahead conv sees the same zeros a
+        # shorter, unpadded sequence gets from F.pad
+        xs = xs * masks.transpose(1, 2)
 
         # lookahead
         xs = self.pre_lookahead_layer(xs)
-        # conformer block
-        if self.enable_cuda_graph and xs.shape[1] in self.graph_encoder:
+        # conformer block (graphs are captured for batch size 1)
+        if self.enable_cuda_graph and xs.shape[0] == 1 and xs.shape[1] in self.graph_encoder:
             self.inference_buffers_encoder[xs.shape[1]]['static_inputs'][0].copy_(xs)
             self.inference_buffers_encoder[xs.shape[1]]['static_inputs'][1].copy_(masks)
             self.inference_buffers_encoder[xs.shape[1]]['static_inputs'][2].copy_(pos_emb)
@@ -392,7 +395,7 @@ class UpsampleConformerEncoderV2(torch.nn.Module):
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
         xs, pos_emb, masks = self.up_embed(xs, masks)
-        if self.enable_cuda_graph and xs.shape[1] in self.graph_up_encoder:
+        if self.enable_cuda_graph and xs.shape[0] == 1 and xs.shape[1] in self.graph_up_encoder:
             self.inference_buffers_up_encoder[xs.shape[1]]['static_inputs'][0].copy_(xs)
             self.inference_buffers_up_encoder[xs.shape[1]]['static_inputs'][1].copy_(masks)
             self.inference_buffers_up_encoder[xs.shape[1]]['static_inputs'][2].copy_(pos_emb)
@@ -410,24 +413,29 @@ class UpsampleConformerEncoderV2(torch.nn.Module):
                       xs: torch.Tensor,
                       last_chunk: bool = False,
                       cnn_cache: torch.Tensor = None,
-                      att_cache: torch.Tensor = None,
+                      att_cache1: List[torch.Tensor] = None,
+                      att_cache2: List[torch.Tensor] = None,
                       ):
         """
         Args:
             xs: shape (b, dt, c)
             last_chunk: bool. If last chunk, will pad input with lookaheads
-            att_cache: shape (depth1+depth2, b, nh, 2*t1, c).
             cnn_cache: shape (b, c, t1+t2). Where t1=2 (pre_lookahead_layer), t2=4 (up_layer)
+            att_cache1: k/v caches of `encoders` as chronological segments,
+                each of shape (depth1, b, nh, t_i, c * 2), e.g. `RingCache.segments`
+            att_cache2: same for `up_encoders`, at twice the frame rate
+        Returns:
+            xs, new_cnn_cache, new_att_cache1 of shape (depth1, b, nh, dt, c * 2)
+            and new_att_cache2 of shape (depth2, b, nh, 2 * dt, c * 2). The
+            attention caches hold this chunk's frames only, the caller
+            appends them to its caches.
         """ 
-        if att_cache is not None:
-            assert att_cache.shape[3] % 2 == 0, att_cache.shape
         if cnn_cache is not None:
             assert cnn_cache.shape[2] == 2+self.up_layer.stride*2, cnn_cache.shape
 
         # unpack caches
-        offset1 = att_cache.shape[3] // 2 if att_cache is not None else 0
-        att_cache1 = att_cache[:len(self.encoders), :, :, :offset1] if att_cache is not None else [None] * len(self.encoders)
-        att_cache2 = att_cache[len(self.encoders):] if att_cache is not None else [None] * len(self.encoders)
+        offset1 = sum(seg.shape[3] for seg in att_cache1) if att_cache1 is not None else 0
+        offset2 = sum(seg.shape[3] for seg in att_cache2) if att_cache2 is not None else 0
         cnn_cache1 = cnn_cache[:, :, :2] if cnn_cache is not None else None
         cnn_cache2 = cnn_cache[:, :, 2:] if cnn_cache is not None else None
         xs, _, _ = self.embed(xs, None)
@@ -445,9 +453,10 @@ class UpsampleConformerEncoderV2(torch.nn.Module):
         new_att_cache1 = []
 
         for idx, layer in enumerate(self.encoders):
-            # this_att_cache: shape (b, nh, t, c * 2)
-            xs, _, this_new_att_cache1, _ = layer(xs, chunk_masks, pos_emb, att_cache=att_cache1[idx])
-            new_att_cache1.append(this_new_att_cache1)
+            # this_att_cache: segments of shape (b, nh, t_i, c * 2)
+            this_att_cache1 = [seg[idx] for seg in att_cache1] if att_cache1 is not None else None
+            xs, _, this_new_att_cache1, _ = layer(xs, chunk_masks, pos_emb, att_cache=this_att_cache1)
+            new_att_cache1.append(this_new_att_cache1[:, :, -xs.shape[1]:])
         new_att_cache1 = torch.stack(new_att_cache1, dim=0)
 
         # upsample + conformer encoder, xs: (b, t, c) -> (b, c, t)
@@ -460,24 +469,42 @@ class UpsampleConformerEncoderV2(torch.nn.Module):
         xs, _, _ = self.up_embed(xs, None)
 
         # remake pos_emb
-        pos_emb = self.embed.position_encoding(offset=None, size=offset1 * self.up_layer.stride + xs.shape[1])
+        pos_emb = self.embed.position_encoding(offset=None, size=offset2 + xs.shape[1])
 
         # second conformer
         chunk_masks = torch.zeros((0, 0, 0),dtype=torch.bfloat16)
         new_att_cache2 = []
 
         for idx, layer in enumerate(self.up_encoders):
-            xs, _, this_new_att_cache2, _ = layer(xs, chunk_masks, pos_emb, att_cache=att_cache2[idx])
-            new_att_cache2.append(this_new_att_cache2)
+            this_att_cache2 = [seg[idx] for seg in att_cache2] if att_cache2 is not None else None
+            xs, _, this_new_att_cache2, _ = layer(xs, chunk_masks, pos_emb, att_cache=this_att_cache2)
+            new_att_cache2.append(this_new_att_cache2[:, :, -xs.shape[1]:])
         new_att_cache2 = torch.stack(new_att_cache2, dim=0)
 
         if self.normalize_before:
             xs = self.after_norm(xs)
         
-        # pack new cache
-        new_att_cache = torch.cat([new_att_cache1.repeat(1, 1, 1, 2, 1), new_att_cache2], dim=0)
         new_cnn_cache = torch.cat([new_cnn_cache1, new_cnn_cache2], dim=2)
 
-        return xs, new_cnn_cache, new_att_cache
+        return xs, new_cnn_cache, new_att_cache1, new_att_cache2
+
+    def allocate_att_cache(self, max_len: int, device=None, dtype=None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            max_len: cache capacity (frames) of `up_encoders`, `encoders` get half
+            device, dtype: default to the encoder's
+        Returns:
+            zeroed streaming k/v caches of batch 1 for `encoders` and `up_encoders`
+        """
+        param = self.after_norm.weight
+        device = device or param.device
+        dtype = dtype or param.dtype
+        attn = self.encoders[0].self_attn
+        shape = (1, attn.h, max_len // self.up_layer.stride, 2 * attn.d_k)
+        up_shape = (1, attn.h, max_len, 2 * attn.d_k)
+        return (
+            torch.zeros((len(self.encoders), *shape), device=device, dtype=dtype),
+            torch.zeros((len(self.up_encoders), *up_shape), device=device, dtype=dtype),
+        )
 
 
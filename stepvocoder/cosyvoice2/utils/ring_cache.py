@@ -0,0 +1,127 @@
+"""
+Fixed-capacity attention caches for streaming: a prompt plus a ring of recent frames.
+
+Streaming attention caches used to grow by `torch.cat` every chunk and get
+truncated by another `torch.cat`, so per-chunk allocation and copying grew
+with the stream. `RingCache` keeps the caches in one preallocated buffer
+instead: the first write after `reset` is the prompt and stays at the front,
+later frames go into a ring of `window` slots behind it and overwrite the
+oldest ones in place. Time is the second to last dimension of every tensor.
+"""
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+
+@dataclass
+class RingCache:
+    """
+    Prompt + sliding window of the latest `window` frames in `buffer`
+
+    The ring fills up behind the prompt before it wraps, so `view` is always
+    one contiguous slice. Its frames are in chronological order until the
+    ring wraps; `segments` gives the chronological order at any time.
+
+    Attributes:
+        buffer: shape (..., capacity, c)
+        window: ring slots, None until the prompt is written if `reset` left
+            it to whatever capacity the prompt leaves
+        prompt_len: frames of the prompt, None before the first `advance`
+        pos: ring slot the next frame goes to
+        filled: ring slots holding frames
+    """
+    buffer: torch.Tensor
+    window: Optional[int] = None
+    prompt_len: Optional[int] = None
+    pos: int = 0
+    filled: int = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.buffer.shape[-2]
+
+    @property
+    def length(self) -> int:
+        """Valid frames: prompt + filled ring slots"""
+        return (self.prompt_len or 0) + self.filled
+
+    def reset(self, window: Optional[int] = None):
+        """
+        Start a new stream, the next written frames become its prompt
+
+        Args:
+            window: recent frames kept besides the prompt, None keeps as many as fit
+        """
+        self.window = window
+        self.prompt_len = None
+        self.pos = 0
+        self.filled = 0
+
+    def view(self, buffer: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Args:
+            buffer: a tensor laid out like `self.buffer` (e.g. one row of it), default `self.buffer`
+        Returns:
+            torch.Tensor: the valid frames of `buffer`, shape (..., length, c), no copy
+        """
+        buffer = self.buffer if buffer is None else buffer
+        return buffer.narrow(-2, 0, self.length)
+
+    def segments(self, buffer: Optional[torch.Tensor] = None) -> List[torch.Tensor]:
+        """
+        Returns:
+            List[torch.Tensor]: prompt, older and newer part of the ring,
+                concatenated they are the valid frames in chronological order
+        """
+        buffer = self.buffer if buffer is None else buffer
+        prompt_len = self.prompt_len or 0
+        return [
+            buffer[..., :prompt_len, :],
+            # empty until the ring wraps
+            buffer[..., prompt_len + self.pos:prompt_len + self.filled, :],
+            buffer[..., prompt_len:prompt_len + self.pos, :],
+        ]
+
+    def write(self, frames: torch.Tensor, out: Optional[torch.Tensor] = None):
+        """
+        Copy `frames` into the slots the next `advance` will commit
+
+        Several rows of the buffer (e.g. one per denoising step or layer) can
+        be written for the same chunk before a single `advance`.
+
+        Args:
+            frames: shape (..., n, c), the chunk's frames in order, broadcast into `out`
+            out: a tensor laid out like `self.buffer`, default `self.buffer`
+        """
+        out = self.buffer if out is None else out
+        n = frames.shape[-2]
+        if self.prompt_len is None:
+            assert n <= self.capacity, f'prompt of {n} frames exceeds the cache capacity {self.capacity}'
+            out[..., :n, :] = frames
+            return
+        if self.window == 0:
+            return
+        # only the latest `window` frames survive
+        frames = frames[..., max(n - self.window, 0):, :]
+        n = frames.shape[-2]
+        start = self.prompt_len + self.pos
+        head = min(n, self.window - self.pos)
+        out[..., start:start + head, :] = frames[..., :head, :]
+        if head < n:
+            out[..., self.prompt_len:self.prompt_len + n - head, :] = frames[..., head:, :]
+
+    def advance(self, n: int):
+        """Commit the `n` frames written last"""
+        if self.prompt_len is None:
+            self.prompt_len = n
+            if self.window is None:
+                self.window = self.capacity - n
+            assert self.prompt_len + self.window <= self.capacity, \
+                f'prompt of {n} frames + window of {self.window} exceeds the cache capacity {self.capacity}'
+            return
+        if self.window == 0:
+            return
+        n = min(n, self.window)
+        self.pos = (self.pos + n) % self.window
+        self.filled = min(self.filled + n, self.window)
@@ -0,0 +1,181 @@
+"""
+Per-session state of streaming front ends, with idle expiry and a memory budget.
+
+Streaming callers keep tensors (vocoder caches, encoder states) between
+calls keyed by a session id and drop them when the stream ends. A client
+that disconnects without finishing its stream would otherwise pin those
+tensors forever. `SessionStore` measures the tensor bytes of each session,
+expires sessions idle for longer than `ttl` seconds and evicts the least
+recently used ones when the total exceeds `max_bytes`.
+"""
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+
+class SessionExpiredError(KeyError):
+    """The session was expired or evicted, its state is gone"""
+
+
+def state_nbytes(state: Any) -> int:
+    """
+    Bytes of the tensors reachable from `state` through dicts, lists, tuples and dataclasses
+
+    Views count the full storage they point into, once per storage, so a
+    cache that is a view of a preallocated buffer accounts for that buffer.
+    """
+    storages = {}
+    stack = [state]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, torch.Tensor):
+            storage = obj.untyped_storage()
+            storages[(obj.device, storage.data_ptr())] = storage.nbytes()
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+            stack.extend(vars(obj).values())
+    return sum(storages.values())
+
+
+class SessionStore:
+    """
+    Thread-safe `{session_id: state}` map with TTL and byte-budget eviction
+
+    `get` returns the stored object itself, callers mutate it in place and
+    call `put` again to refresh its byte count. Every access refreshes the
+    session's idle timer and expires sessions past their TTL.
+    """
+
+    def __init__(
+        self,
+        ttl: Optional[float] = 600.0,
+        max_bytes: Optional[int] = None,
+        on_evict: Optional[Callable[[str, Any], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        max_tombstones: int = 1024,
+    ):
+        """
+        Args:
+            ttl: seconds a session may stay idle, None keeps sessions until popped
+            max_bytes: budget over all sessions' tensor bytes, None for no budget
+            on_evict: called as on_evict(session_id, state) for expired and
+                evicted sessions (not for `pop`), outside the store's lock
+            clock: time source in seconds
+            max_tombstones: number of expired/evicted ids remembered by `evicted`
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.clock = clock
+        self.max_tombstones = max_tombstones
+        self._sessions = OrderedDict()  # {session_id: [state, nbytes, last_access]}, oldest access first
+        self._tombstones = OrderedDict()
+        self._bytes = 0
+        self._expired = 0
+        self._evicted = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, session_id: str, default: Any = None) -> Any:
+        with self._lock:
+            dropped = self._expire_locked()
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry[2] = self.clock()
+                self._sessions.move_to_end(session_id)
+        self._notify(dropped)
+        return default if entry is None else entry[0]
+
+    def put(self, session_id: str, state: Any):
+        """Store or refresh a session, then enforce the TTL and the byte budget"""
+        nbytes = state_nbytes(state)
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._sessions[session_id] = [state, nbytes, self.clock()]
+            self._bytes += nbytes
+            self._tombstones.pop(session_id, None)
+            dropped = self._expire_locked()
+            # the session just written is never evicted for its own size
+            while self.max_bytes is not None and self._bytes > self.max_bytes and len(self._sessions) > 1:
+                victim = next(iter(self._sessions))
+                dropped.append((victim, self._drop_locked(victim)))
+                self._evicted += 1
+        self._notify(dropped)
+
+    def pop(self, session_id: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                return default
+            self._bytes -= entry[1]
+            return entry[0]
+
+    def expire(self) -> List[str]:
+        """Drop sessions idle for longer than `ttl`, returns their ids"""
+        with self._lock:
+            dropped = self._expire_locked()
+        self._notify(dropped)
+        return [session_id for session_id, _ in dropped]
+
+    def evicted(self, session_id: str) -> bool:
+        """Whether `session_id` was recently expired or evicted"""
+        with self._lock:
+            return session_id in self._tombstones
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return list(self._sessions)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "expired": self._expired,
+                "evicted": self._evicted,
+            }
+
+    def _expire_locked(self) -> list:
+        dropped = []
+        if self.ttl is None:
+            return dropped
+        deadline = self.clock() - self.ttl
+        # ordered by last access, stop at the first live session
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if entry[2] > deadline:
+                break
+            dropped.append((session_id, self._drop_locked(session_id)))
+            self._expired += 1
+        return dropped
+
+    def _drop_locked(self, session_id: str) -> Any:
+        state, nbytes, _ = self._sessions.pop(session_id)
+        self._bytes -= nbytes
+        self._tombstones[session_id] = None
+        while len(self._tombstones) > self.max_tombstones:
+            self._tombstones.popitem(last=False)
+        return state
+
+    def _notify(self, dropped: list):
+        if self.on_evict is not None:
+            for session_id, state in dropped:
+                self.on_evict(session_id, state)
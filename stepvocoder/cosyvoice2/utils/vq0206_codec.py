@@ -0,0 +1,115 @@
+"""
+The vq02 / vq06 interleave layout shared by the audio tokenizer and the vocoder.
+
+Audio tokens come in groups of 2 vq02 codes followed by 3 vq06 codes, vq06
+ids shifted by the vq02 codebook size:
+
+    [a0, a1, 1024 + b0, 1024 + b1, 1024 + b2]
+
+The tokenizer builds this mixed sequence from the two code streams
+(`interleave`), the vocoder maps it back to time-aligned rows
+(`deinterleave_to_vq0206`): [[a0, 1025 + b0], [a1, 1025 + b1], [PAD, 1025 + b2]],
+vq06 codes placed behind the vq02 codes and their PAD. Both work on whole
+arrays, so their cost stays linear in the sequence length.
+"""
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+VQ02_CODEBOOK_SIZE = 1024
+GROUP_VQ02 = 2
+GROUP_VQ06 = 3
+GROUP_LEN = GROUP_VQ02 + GROUP_VQ06
+
+# vocoder input: the vq02 column pads every group's third row with PAD,
+# the vq06 column starts right after it
+VQ02_PAD = VQ02_CODEBOOK_SIZE
+VQ06_BASE = VQ02_PAD + 1
+
+# padding policy for a trailing partial group in `deinterleave_to_vq0206`:
+# the missing vq02 slots take code 0 and the missing vq06 slots code 0 (id 1024)
+PARTIAL_PAD = "pad"
+PARTIAL_DROP = "drop"
+_GROUP_FILL = (0, 0, VQ02_CODEBOOK_SIZE, VQ02_CODEBOOK_SIZE, VQ02_CODEBOOK_SIZE)
+
+Codes = Union[Sequence[int], np.ndarray, torch.Tensor]
+
+
+def _as_array(codes: Codes) -> np.ndarray:
+    if isinstance(codes, torch.Tensor):
+        codes = codes.detach().cpu().numpy()
+    return np.asarray(codes, dtype=np.int64).reshape(-1)
+
+
+def interleave(vq02: Codes, vq06: Codes, offset: int = 0) -> np.ndarray:
+    """
+    Merge vq02 / vq06 codes into the mixed 2 + 3 sequence
+
+    Only complete groups are kept: codes left over once either stream runs
+    out are dropped.
+
+    Args:
+        vq02: vq02 codes in [0, 1024)
+        vq06: vq06 codes in [0, 4096)
+        offset: added to every id, e.g. 65536 for the LLM's absolute audio ids
+
+    Returns:
+        np.ndarray: int64 ids, shape (5 * groups,)
+    """
+    vq02, vq06 = _as_array(vq02), _as_array(vq06)
+    groups = min(len(vq02) // GROUP_VQ02, len(vq06) // GROUP_VQ06)
+    mix = np.empty((groups, GROUP_LEN), dtype=np.int64)
+    mix[:, :GROUP_VQ02] = vq02[: groups * GROUP_VQ02].reshape(groups, GROUP_VQ02)
+    mix[:, GROUP_VQ02:] = vq06[: groups * GROUP_VQ06].reshape(groups, GROUP_VQ06) + VQ02_CODEBOOK_SIZE
+    if offset:
+        mix += offset
+    return mix.reshape(-1)
+
+
+def deinterleave(mix_seq: Codes, offset: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split a mixed sequence back into its vq02 / vq06 codes, the inverse of `interleave`
+
+    Args:
+        mix_seq: mixed ids, a trailing partial group is dropped
+        offset: the `offset` the ids were interleaved with
+
+    Returns:
+        tuple: (vq02, vq06) int64 codes
+    """
+    mix = _as_array(mix_seq)
+    groups = len(mix) // GROUP_LEN
+    mix = mix[: groups * GROUP_LEN].reshape(groups, GROUP_LEN) - offset
+    return mix[:, :GROUP_VQ02].reshape(-1), (mix[:, GROUP_VQ02:] - VQ02_CODEBOOK_SIZE).reshape(-1)
+
+
+def deinterleave_to_vq0206(mix_seq: Codes, partial: str = PARTIAL_PAD) -> torch.Tensor:
+    """
+    [02, 02, 06, 06, 06] -> [[02, 06], [02, 06], [PAD, 06]], the vocoder's token layout
+
+    `mix_seq` is not modified.
+
+    Args:
+        mix_seq: mixed ids without the LLM offset, vq06 ids shifted by 1024
+        partial: PARTIAL_PAD fills a trailing partial group (the speech it
+            decodes to is wrong anyway, this only keeps the shapes valid),
+            PARTIAL_DROP discards it
+
+    Returns:
+        torch.Tensor: long, shape (3 * groups, 2)
+    """
+    if partial not in (PARTIAL_PAD, PARTIAL_DROP):
+        raise ValueError(f"unknown partial group policy {partial!r}")
+    mix = _as_array(mix_seq)
+    remainder = len(mix) % GROUP_LEN
+    if remainder and partial == PARTIAL_PAD:
+        mix = np.concatenate([mix, np.asarray(_GROUP_FILL[remainder:], dtype=np.int64)])
+    groups = len(mix) // GROUP_LEN
+    mix = mix[: groups * GROUP_LEN].reshape(groups, GROUP_LEN)
+
+    vq0206 = np.empty((groups, GROUP_VQ06, 2), dtype=np.int64)
+    vq0206[:, :GROUP_VQ02, 0] = mix[:, :GROUP_VQ02]
+    vq0206[:, GROUP_VQ02:, 0] = VQ02_PAD
+    vq0206[:, :, 1] = mix[:, GROUP_VQ02:] - VQ02_CODEBOOK_SIZE + VQ06_BASE
+    return torch.from_numpy(vq0206.reshape(groups * GROUP_VQ06, 2))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+测试 AudioContext：只解码一次、派生视图缓存、重采样核复用、无法解码时抛出 AudioDecodeError
+"""
+import threading
+
+import pytest
+import torch
+import torchaudio
+
+import audio_context
+from audio_context import AudioContext, AudioDecodeError, get_resampler
+
+
+def test_views_match_direct_computation():
+    generator = torch.Generator().manual_seed(0)
+    stereo = torch.rand(2, 48000, generator=generator) * 1.6 - 0.8
+    context = AudioContext(stereo, 48000)
+
+    mono = stereo.mean(dim=0, keepdim=True)
+    assert torch.equal(context.mono(), mono)
+    assert torch.equal(context.normalized(), mono / mono.abs().max() * 0.6)
+    expected_16k = torchaudio.transforms.Resample(48000, 16000)(context.normalized())
+    assert torch.equal(context.resampled(16000), expected_16k)
+    assert context.resampled(16000) is context.resampled(16000)
+    assert context.fbank().shape[1] == 80
+
+
+def test_decodes_once_and_shares_kernels(monkeypatch):
+    """路径输入延迟解码；多线程并发请求同一视图也只解码、计算一次"""
+    calls = []
+
+    def fake_load(path):
+        calls.append(path)
+        return torch.zeros(1, 44100), 44100
+
+    monkeypatch.setattr(audio_context.torchaudio, "load", fake_load)
+    context = AudioContext.from_file("clip.wav")
+    assert not calls  # nothing decoded until a view is requested
+
+    threads = [threading.Thread(target=context.resampled, args=(16000,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    context.resampled(24000, normalized=False)
+    assert calls == ["clip.wav"]
+    assert context.resampled(16000).shape == (1, 16000)
+    assert get_resampler(44100, 16000) is get_resampler(44100, 16000)
+
+
+def test_undecodable_file_raises_audio_decode_error(tmp_path):
+    """损坏的上传文件报 AudioDecodeError（API 映射为 400），而不是任意的解码异常"""
+    path = tmp_path / "broken.wav"
+    path.write_bytes(b"not a wav file")
+    context = AudioContext.from_file(str(path))
+    with pytest.raises(AudioDecodeError):
+        context.mono()
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    test_views_match_direct_computation()
+    with pytest.MonkeyPatch.context() as mp:
+        test_decodes_once_and_shares_kernels(mp)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_undecodable_file_raises_audio_decode_error(Path(tmp_dir))
+    print("测试完成！")
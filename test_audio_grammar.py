@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+测试音频语法约束解码（缩小码本布局的小模型）
+"""
+import torch
+
+from audio_grammar import AudioGrammar, AudioGrammarLogitsProcessor, allowed_token_ids
+from generation_scheduler import GenerationScheduler
+from test_generation_scheduler import build_tiny_llm
+
+# tiny vocab 64: vq02 codes 40..47, vq06 codes 48..63, eos 3
+LAYOUT = dict(audio_offset=40, vq02_size=8, vq06_size=16)
+
+
+def test_sliced_logits_match_masked_full_logits():
+    """切片 lm_head 计算的 logits 应与完整 logits 掩码后一致"""
+    model = build_tiny_llm()
+    grammar = AudioGrammar(model, [3], **LAYOUT)
+    hidden = torch.randn(5, model.config.hidden_size)
+    phases = [0, 1, 2, 3, 4]
+    with torch.no_grad():
+        sliced = grammar.logits(hidden, phases)
+        full = model.lm_head(hidden).float()
+    for row, phase in enumerate(phases):
+        allowed = allowed_token_ids(phase, [3], **LAYOUT)
+        expected = torch.full_like(full[row], float("-inf"))
+        expected[allowed] = full[row, allowed]
+        assert torch.allclose(sliced[row], expected, atol=1e-5)
+
+
+def test_scheduler_follows_grammar():
+    """调度器输出严格遵循 2 个 vq02 + 3 个 vq06 的交错模式"""
+    model = build_tiny_llm()
+    grammar = AudioGrammar(model, [3], **LAYOUT)
+    scheduler = GenerationScheduler(model, max_batch_size=2, eos_token_id=3, grammar=grammar)
+    prompts = [[1, 4, 5, 6], [1, 9, 10]]
+    outputs = [f.result(timeout=60) for f in [scheduler.submit(p, max_length=40, temperature=1.0) for p in prompts]]
+    for prompt, output in zip(prompts, outputs):
+        generated = output[0, len(prompt):].tolist()
+        for i, token in enumerate(generated):
+            assert token in allowed_token_ids(i % 5, [3], **LAYOUT).tolist()
+
+        # greedy decoding matches plain generate with the masking processor
+        expected = model.generate(
+            torch.tensor([prompt]),
+            max_length=40,
+            do_sample=False,
+            eos_token_id=3,
+            pad_token_id=0,
+            logits_processor=[AudioGrammarLogitsProcessor(len(prompt), [3], **LAYOUT)],
+        )
+        assert torch.equal(scheduler.generate(prompt, max_length=40, do_sample=False), expected)
+    scheduler.shutdown()
+
+
+if __name__ == "__main__":
+    test_sliced_logits_match_masked_full_logits()
+    test_scheduler_follows_grammar()
+    print("测试完成！")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+测试 CFG 区间调度：区间外的步只跑条件分支（batch 减半），非流式与流式路径一致
+"""
+import math
+
+import torch
+
+from stepvocoder.cosyvoice2.flow.decoder_dit import DiT
+from stepvocoder.cosyvoice2.flow.flow_matching import CausalConditionalCFM
+
+
+def build_cfm(hidden_size=32, num_heads=2, head_dim=16):
+    torch.manual_seed(0)
+    estimator = DiT(in_channels=320, out_channels=80, depth=1, num_heads=num_heads, head_dim=head_dim, hidden_size=hidden_size)
+    for param in estimator.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    return CausalConditionalCFM(estimator).eval()
+
+
+def record_batch_sizes(module, method):
+    sizes = []
+    original = getattr(module, method)
+
+    def wrapper(x, *args, **kwargs):
+        sizes.append(x.shape[0])
+        return original(x, *args, **kwargs)
+
+    setattr(module, method, wrapper)
+    return sizes
+
+
+def guided_steps(n_timesteps, high):
+    t_span = 1 - torch.cos(torch.linspace(0, 1, n_timesteps + 1) * 0.5 * math.pi)
+    return sum(1 for t in t_span[:-1] if float(t) <= high)
+
+
+def test_nonstream_interval_halves_late_steps():
+    cfm = build_cfm()
+    mu, cond = torch.randn(2, 80, 10), torch.randn(2, 80, 10)
+    spks, mask = torch.randn(2, 80), torch.ones(2, 1, 10)
+    full = cfm.forward(mu, mask, spks, cond, n_timesteps=10)
+
+    sizes = record_batch_sizes(cfm.estimator, "forward")
+    same = cfm.forward(mu, mask, spks, cond, n_timesteps=10, cfg_interval=(0.0, 1.0))
+    assert sizes == [4] * 10
+    assert torch.equal(full, same)
+
+    sizes.clear()
+    cfm.forward(mu, mask, spks, cond, n_timesteps=10, cfg_interval=(0.0, 0.5))
+    n_guided = guided_steps(10, 0.5)
+    assert 0 < n_guided < 10
+    assert sizes == [4] * n_guided + [2] * (10 - n_guided)
+
+
+def test_nonstream_without_guidance_is_conditional_flow():
+    """空区间等价于只用条件分支做 Euler 积分"""
+    cfm = build_cfm()
+    mu, cond = torch.randn(1, 80, 6), torch.randn(1, 80, 6)
+    spks, mask = torch.randn(1, 80), torch.ones(1, 1, 6)
+    out = cfm.forward(mu, mask, spks, cond, n_timesteps=4, cfg_interval=(2.0, 2.0))
+
+    t_span = 1 - torch.cos(torch.linspace(0, 1, 5) * 0.5 * torch.pi)
+    x = cfm.rand_noise[:, :, :6].clone()
+    for step in range(4):
+        t, dt = t_span[step], t_span[step + 1] - t_span[step]
+        x = x + dt * cfm.estimator.forward(x, mask, mu, t.reshape(1), spks, cond)
+    assert torch.allclose(out, x, atol=1e-6)
+
+
+def test_stream_unguided_steps_never_read_unconditional_cache():
+    """流式：区间外步的无条件 cache 行被破坏也不影响下一块输出"""
+    cfm = build_cfm()
+    cfm.cfg_interval = (0.0, 0.5)
+    n_timesteps = 6
+    n_guided = guided_steps(n_timesteps, 0.5)
+    chunk = lambda: (torch.randn(1, 80, 8), torch.randn(1, 80), torch.randn(1, 80, 8))
+
+    sizes = record_batch_sizes(cfm.estimator, "forward_chunk")
+    mu, spks, cond = chunk()
+    _, cnn_cache, att_cache = cfm.forward_chunk(mu, spks, cond, n_timesteps=n_timesteps)
+    assert sizes == [2] * n_guided + [1] * (n_timesteps - n_guided)
+    cnn_cache, att_cache = cnn_cache.clone(), att_cache.clone()
+
+    mu, spks, cond = chunk()
+    clean, _, _ = cfm.forward_chunk(mu, spks, cond, n_timesteps=n_timesteps, cnn_cache=cnn_cache.clone(), att_cache=att_cache.clone())
+    cnn_cache[n_guided:, :, 1] = float("nan")
+    att_cache[n_guided:, :, 1] = float("nan")
+    corrupted, _, _ = cfm.forward_chunk(mu, spks, cond, n_timesteps=n_timesteps, cnn_cache=cnn_cache, att_cache=att_cache)
+    assert torch.isfinite(corrupted).all()
+    assert torch.equal(clean, corrupted)
+
+
+if __name__ == "__main__":
+    test_nonstream_interval_halves_late_steps()
+    test_nonstream_without_guidance_is_conditional_flow()
+    test_stream_unguided_steps_never_read_unconditional_cache()
+    print("测试完成！")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+测试连续批处理生成调度器（CPU + 随机权重小模型）
+"""
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from generation_scheduler import GenerationScheduler
+
+
+def build_tiny_llm(seed=0):
+    """构造一个随机权重的小型因果语言模型"""
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        eos_token_id=3,
+        attn_implementation="eager",
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def test_greedy_matches_generate():
+    """批内贪心解码结果应与逐条 generate 完全一致"""
+    model = build_tiny_llm()
+    scheduler = GenerationScheduler(model, max_batch_size=3, eos_token_id=3)
+    prompts = [
+        [1, 5, 6, 7],
+        [1, 9, 10, 11, 12, 13, 14, 15, 16],
+        [1, 20],
+        [1, 30, 31, 32, 33, 34],
+        [1, 40, 41, 42],
+    ]
+    max_lengths = [24, 30, 18, 40, 12]
+
+    futures = [
+        scheduler.submit(p, max_length=m, do_sample=False)
+        for p, m in zip(prompts, max_lengths)
+    ]
+    outputs = [f.result(timeout=60) for f in futures]
+
+    for prompt, max_length, output in zip(prompts, max_lengths, outputs):
+        expected = model.generate(
+            torch.tensor([prompt]),
+            max_length=max_length,
+            do_sample=False,
+            eos_token_id=3,
+            pad_token_id=0,
+        )
+        assert torch.equal(output, expected), (output, expected)
+
+    stats = scheduler.get_stats()
+    assert stats["completed"] == len(prompts)
+    assert stats["avg_batch_size"] > 1.0
+    scheduler.shutdown()
+
+
+def test_per_sequence_processors():
+    """每条序列拥有独立的 logits processor 实例"""
+    model = build_tiny_llm()
+    scheduler = GenerationScheduler(model, max_batch_size=2, eos_token_id=3)
+    created = []
+
+    class BanToken:
+        def __init__(self):
+            self.calls = 0
+            created.append(self)
+
+        def __call__(self, input_ids, scores):
+            self.calls += 1
+            scores[:, 7] = float("-inf")
+            return scores
+
+    futures = [
+        scheduler.submit([1, 2, 4], max_length=16, temperature=0.7, logits_processor_factory=lambda: [BanToken()])
+        for _ in range(2)
+    ]
+    for f in futures:
+        out = f.result(timeout=60)
+        assert 7 not in out[0, 3:].tolist()
+    assert len(created) == 2
+    assert all(p.calls > 0 for p in created)
+    scheduler.shutdown()
+
+
+@pytest.mark.parametrize("fail_at", [1, 4])
+def test_failing_sequence_does_not_fail_batch(fail_at):
+    """某条序列的 logits processor 抛异常（prefill 或解码阶段）只让这条请求失败，同批其余请求照常完成"""
+    model = build_tiny_llm()
+    scheduler = GenerationScheduler(model, max_batch_size=3, eos_token_id=3)
+
+    class FailAt:
+        def __init__(self):
+            self.calls = 0
+
+        def __call__(self, input_ids, scores):
+            self.calls += 1
+            if self.calls == fail_at:
+                raise RuntimeError("processor failed")
+            return scores
+
+    prompts = [[1, 5, 6, 7], [1, 9, 10, 11, 12], [1, 20, 21]]
+    futures = [
+        scheduler.submit(prompts[0], max_length=20, do_sample=False),
+        scheduler.submit(prompts[1], max_length=20, do_sample=False, logits_processor_factory=lambda: [FailAt()]),
+        scheduler.submit(prompts[2], max_length=24, do_sample=False),
+    ]
+    with pytest.raises(RuntimeError, match="processor failed"):
+        futures[1].result(timeout=60)
+    for prompt, max_length, future in [(prompts[0], 20, futures[0]), (prompts[2], 24, futures[2])]:
+        expected = model.generate(
+            torch.tensor([prompt]), max_length=max_length, do_sample=False, eos_token_id=3, pad_token_id=0
+        )
+        assert torch.equal(future.result(timeout=60), expected)
+
+    # the scheduler keeps serving after the failure
+    assert scheduler.submit([1, 40, 41], max_length=10, do_sample=False).result(timeout=60).shape[1] <= 10
+    scheduler.shutdown()
+    with pytest.raises(RuntimeError):
+        scheduler.submit([1, 2], max_length=4)
+
+
+if __name__ == "__main__":
+    test_greedy_matches_generate()
+    test_per_sequence_processors()
+    for fail_at in (1, 4):
+        test_failing_sequence_does_not_fail_batch(fail_at)
+    print("测试完成！")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+测试前缀 KV 缓存
+"""
+import torch
+
+from generation_scheduler import GenerationScheduler
+from prefix_cache import PrefixKVCache, system_prefix_len
+from test_generation_scheduler import build_tiny_llm
+
+
+def test_generate_with_prefix_matches_full_prefill():
+    """使用前缀缓存的 generate 结果应与完整 prefill 一致"""
+    model = build_tiny_llm()
+    cache = PrefixKVCache(max_bytes=1 << 20)
+    system_turn = [1, 4, 10, 11, 12, 13, 14, 15, 3]
+    for suffix in ([4, 20, 21, 3, 4, 22], [4, 30, 3, 4, 31, 32]):
+        token_ids = system_turn + suffix
+        prefix_len = system_prefix_len(token_ids)
+        assert prefix_len == len(system_turn)
+        input_ids = torch.tensor([token_ids])
+        expected = model.generate(input_ids, max_length=40, do_sample=False, eos_token_id=3, pad_token_id=0)
+        past_key_values = cache.get_or_build(model, input_ids[:, :prefix_len])
+        output = model.generate(
+            input_ids, past_key_values=past_key_values, max_length=40, do_sample=False, eos_token_id=3, pad_token_id=0
+        )
+        assert torch.equal(output, expected)
+
+    stats = cache.get_stats()
+    assert stats["misses"] == 1 and stats["hits"] == 1 and stats["entries"] == 1
+
+
+def test_scheduler_uses_prefix_cache():
+    model = build_tiny_llm()
+    cache = PrefixKVCache(max_bytes=1 << 20)
+    scheduler = GenerationScheduler(model, max_batch_size=2, eos_token_id=3, prefix_cache=cache)
+    token_ids = [1, 4, 10, 11, 12, 3, 4, 20, 21, 3, 4, 22]
+    expected = model.generate(torch.tensor([token_ids]), max_length=30, do_sample=False, eos_token_id=3, pad_token_id=0)
+    for _ in range(2):
+        output = scheduler.generate(token_ids, max_length=30, do_sample=False, prefix_len=system_prefix_len(token_ids))
+        assert torch.equal(output, expected)
+    assert cache.hits == 1
+    scheduler.shutdown()
+
+
+def test_byte_bounded_eviction():
+    model = build_tiny_llm()
+    probe = PrefixKVCache()
+    probe.get_or_build(model, torch.tensor([[1, 4, 5, 3]]))
+    entry_bytes = probe.current_bytes
+
+    cache = PrefixKVCache(max_bytes=entry_bytes * 2)
+    for token in (5, 6, 7):
+        cache.get_or_build(model, torch.tensor([[1, 4, token, 3]]))
+    assert cache.evictions == 1
+    assert cache.current_bytes <= cache.max_bytes
+    # oldest prefix was evicted, newest is still served from cache
+    assert cache.get(cache.make_key(model, [1, 4, 5, 3])) is None
+    assert cache.get(cache.make_key(model, [1, 4, 7, 3])) is not None
+
+
+def test_shared_between_models():
+    """多个模型共用一个缓存与字节预算，相同前缀按模型分别缓存"""
+    models = [build_tiny_llm(seed=0), build_tiny_llm(seed=1)]
+    cache = PrefixKVCache(max_bytes=1 << 20)
+    token_ids = [1, 4, 10, 11, 12, 3, 4, 20, 21]
+    input_ids = torch.tensor([token_ids])
+    prefix_len = system_prefix_len(token_ids)
+    for _ in range(2):
+        for model in models:
+            expected = model.generate(input_ids, max_length=30, do_sample=False, eos_token_id=3, pad_token_id=0)
+            past_key_values = cache.get_or_build(model, input_ids[:, :prefix_len])
+            output = model.generate(
+                input_ids, past_key_values=past_key_values, max_length=30, do_sample=False, eos_token_id=3, pad_token_id=0
+            )
+            assert torch.equal(output, expected)
+    stats = cache.get_stats()
+    assert stats["entries"] == 2 and stats["misses"] == 2 and stats["hits"] == 2
+
+
+if __name__ == "__main__":
+    test_generate_with_prefix_matches_full_prefill()
+    test_scheduler_uses_prefix_cache()
+    test_byte_bounded_eviction()
+    test_shared_between_models()
+    print("测试完成！")
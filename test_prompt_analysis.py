@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+测试 prompt 音频分析：vq02 / vq06 / mel / 说话人向量并行提取
+"""
+import time
+
+import torch
+
+from audio_context import AudioContext
+from prompt_analysis import PromptAnalyzer
+
+BRANCH_SECONDS = 0.2
+
+
+class FakeTokenizer:
+    """模拟 StepAudioTokenizer 的缓存查找与两个编码分支"""
+
+    def __init__(self):
+        self.cache = {}
+        self.log_mel_calls = 0
+
+    def context_audio(self, context):
+        return context.derive("tokenizer_audio", lambda: context.resampled(16000))
+
+    def context_log_mels(self, context):
+        def compute():
+            self.log_mel_calls += 1
+            return [torch.zeros(128, 10)]
+        return context.derive("vq06_log_mels", compute)
+
+    def cache_lookup(self, audio):
+        key = audio.numpy().tobytes()
+        return key, self.cache.get(key)
+
+    def get_vq02_code(self, audio):
+        time.sleep(BRANCH_SECONDS)
+        return [1, 2, 3, 4]
+
+    def get_vq06_code(self, audio, log_mels=None):
+        assert log_mels is not None
+        time.sleep(BRANCH_SECONDS)
+        return [5, 6, 7, 8, 9, 10]
+
+    def store_tokens(self, audio_hash, vq02, vq06, encoding_time=None):
+        tokens = [65536 + 1, 65536 + 2, 65536 + 1024 + 5, 65536 + 1024 + 6, 65536 + 1024 + 7]
+        self.cache[audio_hash] = (tokens, vq02, vq06)
+        return self.cache[audio_hash]
+
+
+class FakeFrontend:
+    sample_rate = 24000
+
+    def extract_speech_feat(self, audio, sr):
+        assert sr == 24000 and audio.shape == (1, 2400)
+        time.sleep(BRANCH_SECONDS)
+        return torch.ones(1, 10, 80), torch.tensor([10])
+
+    def extract_spk_embedding_from_fbank(self, feat):
+        assert feat.shape[1] == 80
+        time.sleep(BRANCH_SECONDS)
+        return torch.zeros(1, 192)
+
+
+def test_branches_run_concurrently():
+    """耗时应接近单个分支而非四个分支之和，且输出完整"""
+    analyzer = PromptAnalyzer(FakeTokenizer(), FakeFrontend())
+    analysis = analyzer.analyze(AudioContext(torch.zeros(1, 1600), 16000))
+
+    assert analysis.vq02_codes == [1, 2, 3, 4] and analysis.vq06_codes == [5, 6, 7, 8, 9, 10]
+    assert len(analysis.vq0206_codes) == 5
+    assert analysis.speech_feat.shape == (1, 10, 80) and analysis.speech_embedding.shape == (1, 192)
+    assert set(analysis.timings) == {"vq02", "vq06", "mel", "spk", "total"}
+    assert analysis.timings["total"] < 2.5 * BRANCH_SECONDS
+
+
+def test_cached_tokens_skip_encoders():
+    """分词缓存命中时只运行 mel 与说话人向量分支"""
+    analyzer = PromptAnalyzer(FakeTokenizer(), FakeFrontend())
+    first = analyzer.analyze(AudioContext(torch.zeros(1, 1600), 16000))
+    second = analyzer.analyze(AudioContext(torch.zeros(1, 1600), 16000))
+
+    assert set(second.timings) == {"mel", "spk", "total"}
+    assert second.vq0206_codes == first.vq0206_codes
+    stats = analyzer.get_stats()
+    assert stats["calls"] == 2 and set(stats["avg_ms"]) == {"vq02", "vq06", "mel", "spk", "total"}
+
+
+def test_log_mels_shared_with_asr():
+    """ASR 已为同一 AudioContext 计算的 log-mel 被 vq06 分支直接复用"""
+    tokenizer = FakeTokenizer()
+    analyzer = PromptAnalyzer(tokenizer, FakeFrontend())
+    context = AudioContext(torch.zeros(1, 1600), 16000)
+    asr_log_mels = tokenizer.context_log_mels(context)  # what the edit path hands to Whisper
+    analyzer.analyze(context)
+    assert tokenizer.log_mel_calls == 1
+    assert tokenizer.context_log_mels(context) is asr_log_mels
+
+
+if __name__ == "__main__":
+    test_branches_run_concurrently()
+    test_cached_tokens_skip_encoders()
+    test_log_mels_shared_with_asr()
+    print("测试完成！")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+测试直接 prompt 编码与字符串 + 分词编码逐位一致
+"""
+import random
+
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from config.prompts import AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL, AUDIO_EDIT_SYSTEM_PROMPT
+from prompt_encoder import AUDIO_TOKEN_OFFSET, AudioPromptEncoder
+
+
+def build_tokenizer(pre_tokenizer, with_audio_tokens=True):
+    """训练一个带 `<audio_N>` 附加 token 的小型 BPE 分词器"""
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizer
+    trainer = trainers.BpeTrainer(vocab_size=500, special_tokens=["<unk>", "<s>", "</s>"])
+    corpus = [AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL, AUDIO_EDIT_SYSTEM_PROMPT, "human assistant 你好 今天天气不错"]
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>")
+    if with_audio_tokens:
+        tokenizer.add_tokens([f"<audio_{i}>" for i in range(1024 + 4096)])
+    return tokenizer
+
+
+def reference_clone(tokenizer, text, prompt_text, prompt_speaker, prompt_wav_tokens):
+    """StepAudioTTS._encode_audio_edit_clone_prompt"""
+    prompt = AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL.format(
+        speaker=prompt_speaker, prompt_text=prompt_text, prompt_wav_tokens=prompt_wav_tokens
+    )
+    history = [1, 4] + tokenizer.encode(f"system\n{prompt}") + [3]
+    target_tokens = tokenizer.encode("\n" + text)[len(tokenizer.encode("\n")) :]
+    return history + [4] + tokenizer.encode("human\n") + target_tokens + [3, 4] + tokenizer.encode("assistant\n")
+
+
+def reference_edit(tokenizer, instruct_prefix, audio_token_str):
+    """StepAudioTTS._encode_audio_edit_prompt"""
+    history = [1, 4] + tokenizer.encode(f"system\n{AUDIO_EDIT_SYSTEM_PROMPT}") + [3]
+    human_turn_toks = tokenizer.encode(f"{instruct_prefix}\n{audio_token_str.strip()}\n")
+    return history + [4] + tokenizer.encode("human\n") + human_turn_toks + [3, 4] + tokenizer.encode("assistant\n")
+
+
+def random_audio_codes(num_groups, seed=0):
+    """与 wav2token 相同的 2 个 vq02 + 3 个 vq06 交错绝对 id"""
+    rng = random.Random(seed)
+    codes = []
+    for _ in range(num_groups):
+        codes += [AUDIO_TOKEN_OFFSET + rng.randrange(1024) for _ in range(2)]
+        codes += [AUDIO_TOKEN_OFFSET + 1024 + rng.randrange(4096) for _ in range(3)]
+    return codes
+
+
+def test_bit_identical_encoding():
+    for pre_tokenizer in (pre_tokenizers.Metaspace(prepend_scheme="always"), pre_tokenizers.ByteLevel()):
+        tokenizer = build_tokenizer(pre_tokenizer)
+        encoder = AudioPromptEncoder(tokenizer)
+        assert encoder.verify(
+            lambda *args: reference_clone(tokenizer, *args),
+            lambda *args: reference_edit(tokenizer, *args),
+        )
+        for seed in range(3):
+            codes = random_audio_codes(50, seed)
+            audio_str = "".join(f"<audio_{c - AUDIO_TOKEN_OFFSET}>" for c in codes)
+            assert encoder.encode_clone("目标 text", "prompt 文本", "spk", codes) == reference_clone(
+                tokenizer, "目标 text", "prompt 文本", "spk", audio_str
+            )
+            assert encoder.encode_edit("Denoise the audio:", codes) == reference_edit(
+                tokenizer, "Denoise the audio:", audio_str
+            )
+
+
+def test_disabled_without_audio_tokens():
+    tokenizer = build_tokenizer(pre_tokenizers.ByteLevel(), with_audio_tokens=False)
+    encoder = AudioPromptEncoder(tokenizer)
+    assert not encoder.verify(
+        lambda *args: reference_clone(tokenizer, *args),
+        lambda *args: reference_edit(tokenizer, *args),
+    )
+
+
+if __name__ == "__main__":
+    test_bit_identical_encoding()
+    test_disabled_without_audio_tokens()
+    print("测试完成！")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+测试流式注意力环形缓存：prompt + 滑动窗口原地更新，结果与按旧方式截断的缓存一致
+"""
+import pytest
+import torch
+
+from stepvocoder.cosyvoice2.utils.ring_cache import RingCache
+from test_stream_cache_pool import N_TIMESTEPS, build_cfm, make_chunks
+from test_token2wav_batch import build_flow
+
+
+def frames(start, n):
+    """帧号作为取值，形状 (1, n, 1)"""
+    return torch.arange(start, start + n, dtype=torch.float32).reshape(1, n, 1)
+
+
+def test_ring_keeps_prompt_and_latest_frames():
+    ring = RingCache(torch.zeros(1, 10, 1))
+    ring.reset(window=4)
+    ring.write(frames(0, 3))
+    ring.advance(3)
+    history = list(range(3))
+    for n in (2, 3, 1, 5, 4):
+        start = history[-1] + 1
+        ring.write(frames(start, n))
+        ring.advance(n)
+        history += list(range(start, start + n))
+        expected = history[:3] + history[3:][-4:]
+        assert torch.cat(ring.segments(), dim=1).flatten().tolist() == expected
+        # the contiguous view holds the same frames, ring slots in storage order
+        assert sorted(ring.view().flatten().tolist()) == sorted(expected)
+        assert ring.length == len(expected)
+
+
+def test_ring_without_window_keeps_what_fits():
+    ring = RingCache(torch.zeros(2, 6, 1))
+    ring.reset()
+    ring.write(frames(0, 2))
+    ring.advance(2)
+    assert ring.window == 4
+    with pytest.raises(AssertionError):
+        ring.reset(window=5)
+        ring.write(frames(0, 2))
+        ring.advance(2)
+
+
+def test_decoder_window_matches_truncated_cache():
+    """slab 的环形缓存与“prompt + 最近 W 帧”显式截断的缓存输出一致，且不随流长度增长"""
+    cfm = build_cfm()
+    window = 16
+    spks, chunks = make_chunks(3, n_chunks=8)
+    prompt_len = chunks[0][0].shape[2]
+
+    slab = cfm.allocate_chunk_cache(N_TIMESTEPS, max_len=prompt_len + window)
+    slab.reset(window)
+    cnn_cache = att_cache = None
+    for mu, cond in chunks:
+        want, cnn_cache, att_cache = cfm.forward_chunk(
+            mu, spks, cond, n_timesteps=N_TIMESTEPS, cnn_cache=cnn_cache, att_cache=att_cache
+        )
+        # caches returned without a slab are in time order, truncate them like the old streaming code
+        if att_cache.shape[4] > prompt_len + window:
+            att_cache = torch.cat([att_cache[..., :prompt_len, :], att_cache[..., -window:, :]], dim=4)
+        got, _, ring_cache = cfm.forward_chunk(mu, spks, cond, n_timesteps=N_TIMESTEPS, cache_slab=slab)
+        assert torch.allclose(got, want, atol=1e-6)
+        assert ring_cache.data_ptr() == slab.att_cache.data_ptr()
+        assert ring_cache.shape[4] == att_cache.shape[4] <= prompt_len + window
+
+
+@pytest.fixture
+def flow():
+    # the encoder's torch.compile tracing takes far longer than the tiny model itself
+    with torch._dynamo.config.patch(disable=True):
+        yield build_flow()
+
+
+@pytest.mark.parametrize("window", [8, 1000])
+def test_encoder_window_matches_explicit_history(flow, window):
+    """编码器按时间顺序读取环形缓存，与手工拼接的 prompt + 最近窗口一致"""
+    encoder = flow.encoder
+    generator = torch.Generator().manual_seed(0)
+    chunks = [torch.randn(1, 6 + encoder.pre_lookahead_layer.pre_lookahead_len, 64, generator=generator) for _ in range(7)]
+
+    slab = flow.allocate_chunk_cache(N_TIMESTEPS, max_len=64, encoder_max_len=24 + 2 * window)
+    slab.reset(encoder_window=window)
+    history1 = history2 = None
+    cnn_cache = ring_cnn_cache = None
+    for i, xs in enumerate(chunks):
+        with torch.inference_mode():
+            if history1 is None:
+                want, cnn_cache, history1, history2 = encoder.forward_chunk(xs)
+                prompt1, prompt2 = history1.shape[3], history2.shape[3]
+            else:
+                want, cnn_cache, new1, new2 = encoder.forward_chunk(
+                    xs, cnn_cache=cnn_cache, att_cache1=[history1], att_cache2=[history2],
+                )
+                history1 = torch.cat([history1, new1], dim=3)
+                history2 = torch.cat([history2, new2], dim=3)
+                history1 = torch.cat([history1[..., :prompt1, :], history1[..., prompt1:, :][..., -(window // 2):, :]], dim=3)
+                history2 = torch.cat([history2[..., :prompt2, :], history2[..., prompt2:, :][..., -window:, :]], dim=3)
+
+            segments = None if i == 0 else (slab.conformer_ring1.segments(), slab.conformer_ring2.segments())
+            got, ring_cnn_cache, new1, new2 = encoder.forward_chunk(
+                xs, cnn_cache=ring_cnn_cache,
+                att_cache1=segments and segments[0], att_cache2=segments and segments[1],
+            )
+            flow._append_conformer_cache(slab, new1, new2)
+        assert torch.allclose(got, want, atol=1e-5)
+        assert torch.equal(torch.cat(slab.conformer_ring2.segments(), dim=3), history2)
+        assert slab.conformer_ring1.length <= prompt1 + window // 2
+
+
+if __name__ == "__main__":
+    test_ring_keeps_prompt_and_latest_frames()
+    test_ring_without_window_keeps_what_fits()
+    test_decoder_window_matches_truncated_cache()
+    with torch._dynamo.config.patch(disable=True):
+        for window in (8, 1000):
+            test_encoder_window_matches_explicit_history(build_flow(), window)
+    print("测试完成！")
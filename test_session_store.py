@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+测试流式会话存储：按字节计量、空闲过期、内存预算驱逐，以及声码器流式会话的回收
+"""
+import pytest
+import torch
+import torch._dynamo
+
+from stepvocoder.cosyvoice2.cli.cosyvoice import CosyVoice_stream_impl_
+from stepvocoder.cosyvoice2.hifigan.f0_predictor import ConvRNNF0Predictor
+from stepvocoder.cosyvoice2.hifigan.generator import HiFTGenerator
+from stepvocoder.cosyvoice2.utils.session_store import SessionExpiredError, SessionStore, state_nbytes
+from test_token2wav_batch import build_flow
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def tensor_state(n_floats):
+    return {"cache": torch.zeros(n_floats), "tokens": [1, 2, 3]}
+
+
+def test_state_nbytes_counts_each_storage_once():
+    buffer = torch.zeros(100)
+    state = {"a": buffer[:10], "b": [buffer[50:], torch.zeros(4, dtype=torch.float16)], "n": 3}
+    assert state_nbytes(state) == 100 * 4 + 4 * 2
+
+
+def test_idle_sessions_expire():
+    clock, evicted = FakeClock(), []
+    store = SessionStore(ttl=10, clock=clock, on_evict=lambda sid, state: evicted.append(sid))
+    store.put("a", tensor_state(4))
+    clock.now = 6
+    store.put("b", tensor_state(4))
+    clock.now = 12
+    assert store.get("a") is None
+    assert evicted == ["a"] and store.evicted("a")
+    # reading refreshes the idle timer
+    assert store.get("b") is not None
+    clock.now = 21
+    assert store.expire() == []
+    clock.now = 22.5
+    assert store.expire() == ["b"]
+    assert store.get_stats()["expired"] == 2 and len(store) == 0
+
+    # a new stream under an old id starts clean
+    store.put("a", tensor_state(4))
+    assert not store.evicted("a")
+
+
+def test_budget_evicts_least_recently_used():
+    evicted = []
+    store = SessionStore(ttl=None, max_bytes=100, on_evict=lambda sid, state: evicted.append(sid))
+    for sid in ("a", "b"):
+        store.put(sid, tensor_state(10))
+    store.get("a")
+    store.put("c", tensor_state(10))
+    assert evicted == ["b"]
+    assert store.ids() == ["a", "c"]
+    assert store.get_stats() == {"sessions": 2, "bytes": 80, "max_bytes": 100, "ttl": None, "expired": 0, "evicted": 1}
+
+    # one session larger than the budget keeps running alone
+    store.put("d", tensor_state(40))
+    assert store.ids() == ["d"] and evicted == ["b", "a", "c"]
+    assert store.pop("d")["tokens"] == [1, 2, 3]
+    assert store.get_stats()["bytes"] == 0 and evicted == ["b", "a", "c"]
+
+
+def build_hift():
+    torch.manual_seed(0)
+    return HiFTGenerator(
+        base_channels=16, sampling_rate=24000, upsample_rates=[8, 5, 3], upsample_kernel_sizes=[16, 11, 7],
+        istft_params={"n_fft": 16, "hop_len": 4}, resblock_kernel_sizes=[3], resblock_dilation_sizes=[[1]],
+        source_resblock_kernel_sizes=[7, 7, 11], source_resblock_dilation_sizes=[[1], [1], [1]],
+        f0_predictor=ConvRNNF0Predictor(cond_channels=16),
+    ).eval()
+
+
+def mixed_tokens(n_groups, generator):
+    """2 个 vq02 + 3 个 vq06 一组的混合 token 序列"""
+    tokens = []
+    for _ in range(n_groups):
+        tokens += torch.randint(0, 1024, (2,), generator=generator).tolist()
+        tokens += (torch.randint(0, 4096, (3,), generator=generator) + 1024).tolist()
+    return tokens
+
+
+@pytest.fixture
+def stream_impl():
+    # the encoder's torch.compile tracing takes far longer than the tiny model itself
+    with torch._dynamo.config.patch(disable=True):
+        yield CosyVoice_stream_impl_(build_flow(), build_hift(), n_timesteps=2, max_stream_sessions=1).eval()
+
+
+def test_idle_stream_session_returns_its_slab(stream_impl):
+    clock = FakeClock()
+    stream_impl.sessions.clock = clock
+    generator = torch.Generator().manual_seed(0)
+    prompt = (torch.tensor([mixed_tokens(6, generator)]), torch.randn(1, 24, 80), torch.randn(1, 192))
+
+    stream_impl.open_session("a")
+    assert stream_impl.token2wav_stream(mixed_tokens(4, generator), *prompt, "a", False) is None
+    stats = stream_impl.get_session_stats()
+    assert stats["sessions"] == 1 and stats["cache_pool"]["active"] == 1
+    # the session's bytes include its estimator cache slab
+    assert stats["bytes"] >= stats["cache_pool"]["bytes"]
+
+    # "a" stops sending tokens; once idle past the ttl its slab goes to "b"
+    clock.now = stream_impl.sessions.ttl + 1
+    stream_impl.open_session("b", timeout=0)
+    assert stream_impl.sessions.ids() == ["b"]
+    with pytest.raises(SessionExpiredError):
+        stream_impl.token2wav_stream(mixed_tokens(4, generator), *prompt, "a", False)
+
+    for _ in range(8):
+        stream_impl.token2wav_stream(mixed_tokens(1, generator), *prompt, "b", False)
+    speech = stream_impl.token2wav_stream([], *prompt, "b", True)
+    assert speech.shape[0] == 1 and speech.shape[1] > 0
+    stats = stream_impl.get_session_stats()
+    assert stats["sessions"] == 0 and stats["bytes"] == 0
+    assert stats["expired"] == 1 and stats["cache_pool"]["active"] == 0
+
+
+if __name__ == "__main__":
+    test_state_nbytes_counts_each_storage_once()
+    test_idle_sessions_expire()
+    test_budget_evicts_least_recently_used()
+    with torch._dynamo.config.patch(disable=True):
+        impl = CosyVoice_stream_impl_(build_flow(), build_hift(), n_timesteps=2, max_stream_sessions=1).eval()
+        test_idle_stream_session_returns_its_slab(impl)
+    print("测试完成！")
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+测试投机解码（提示词 n-gram 检索草稿 / 草稿模型）
+"""
+import torch
+
+from speculative import ModelDrafter, PromptLookupDrafter, SpeculativeStats, _accept_or_resample, speculative_generate
+from test_generation_scheduler import build_tiny_llm
+
+
+def test_prompt_lookup_greedy_matches_generate():
+    """贪心投机解码结果应与 generate 完全一致，且草稿被接受"""
+    model = build_tiny_llm()
+    prompt = torch.tensor([[1, 5, 6, 7, 8]])
+    expected = model.generate(prompt, max_length=40, do_sample=False, eos_token_id=3, pad_token_id=0)
+
+    # the source contains the reference continuation, as edit prompts contain the input audio
+    drafter = PromptLookupDrafter(expected[0].tolist(), num_draft_tokens=4)
+    stats = SpeculativeStats()
+    output = speculative_generate(
+        model, prompt, drafter, max_length=40, do_sample=False, eos_token_id=3, stats=stats
+    )
+    assert torch.equal(output, expected)
+    assert stats.accepted > 0
+    assert stats.steps < expected.shape[1] - prompt.shape[1]
+
+
+def test_model_drafter_greedy_matches_generate():
+    """草稿模型与目标模型不同时，贪心结果仍与目标模型 generate 一致"""
+    model = build_tiny_llm()
+    prompt = torch.tensor([[1, 5, 6, 7, 8]])
+    expected = model.generate(prompt, max_length=40, do_sample=False, eos_token_id=3, pad_token_id=0)
+    for draft_model, full_acceptance in ((model, True), (build_tiny_llm(seed=1), False)):
+        stats = SpeculativeStats()
+        drafter = ModelDrafter(draft_model, num_draft_tokens=4, do_sample=False)
+        output = speculative_generate(
+            model, prompt, drafter, max_length=40, do_sample=False, eos_token_id=3, stats=stats
+        )
+        assert torch.equal(output, expected)
+        if full_acceptance:
+            assert stats.accepted == stats.drafted
+
+
+def test_rejection_sampling_preserves_distribution():
+    """拒绝采样后的输出分布应等于目标分布"""
+    torch.manual_seed(0)
+    scores = torch.tensor([[1.0, 0.5, -0.5, 0.0, 2.0]])
+    target = torch.softmax(scores[0], dim=-1)
+    draft_probs = torch.softmax(torch.tensor([0.0, 2.0, 1.0, 0.0, -1.0]), dim=-1)
+    for q in (None, draft_probs):
+        counts = torch.zeros(5)
+        for _ in range(20000):
+            token = int(torch.multinomial(draft_probs, 1)) if q is not None else 1
+            _, out = _accept_or_resample(scores, token, q, do_sample=True)
+            counts[out] += 1
+        assert torch.allclose(counts / counts.sum(), target, atol=0.02)
+
+
+if __name__ == "__main__":
+    test_prompt_lookup_greedy_matches_generate()
+    test_model_drafter_greedy_matches_generate()
+    test_rejection_sampling_preserves_distribution()
+    print("测试完成！")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+测试流式声码器的会话缓存池：每个会话独占缓存，交替推理与串行推理结果一致
+"""
+import threading
+import time
+
+import pytest
+import torch
+
+from stepvocoder.cosyvoice2.flow.cache_pool import ChunkCachePool, SessionLimitError
+from stepvocoder.cosyvoice2.flow.decoder_dit import DiT
+from stepvocoder.cosyvoice2.flow.flow_matching import CausalConditionalCFM
+
+N_TIMESTEPS = 4
+
+
+def build_cfm():
+    torch.manual_seed(0)
+    estimator = DiT(in_channels=320, out_channels=80, depth=2, num_heads=2, head_dim=16, hidden_size=32)
+    for param in estimator.parameters():
+        torch.nn.init.normal_(param, std=0.02)
+    return CausalConditionalCFM(estimator).eval()
+
+
+def make_chunks(seed, n_chunks=3, chunk_len=8):
+    generator = torch.Generator().manual_seed(seed)
+    spks = torch.randn(1, 80, generator=generator)
+    return spks, [
+        (torch.randn(1, 80, chunk_len, generator=generator), torch.randn(1, 80, chunk_len, generator=generator))
+        for _ in range(n_chunks)
+    ]
+
+
+def run_chunk(cfm, session, mu, cond, slab=None):
+    """推理一个 chunk 并把新缓存（不拷贝）存回会话；有 slab 时缓存保存在 slab 中"""
+    spks, cnn_cache, att_cache = session
+    if slab is not None:
+        cnn_cache = att_cache = None
+    x, cnn_cache, att_cache = cfm.forward_chunk(
+        mu, spks, cond, n_timesteps=N_TIMESTEPS, cnn_cache=cnn_cache, att_cache=att_cache, cache_slab=slab
+    )
+    return x, (spks, cnn_cache, att_cache)
+
+
+def test_pool_caps_and_reuses_slabs():
+    allocated = []
+
+    def allocate():
+        allocated.append(build_cfm().allocate_chunk_cache(N_TIMESTEPS, max_len=16))
+        return allocated[-1]
+
+    pool = ChunkCachePool(allocate, max_sessions=2)
+    a = pool.acquire("a")
+    assert pool.acquire("a") is a
+    b = pool.acquire("b")
+    with pytest.raises(SessionLimitError):
+        pool.acquire("c")
+    assert pool.stats() == {"active": 2, "idle": 0, "max_sessions": 2, "bytes": a.nbytes + b.nbytes}
+
+    pool.release("a")
+    pool.release("a")
+    assert pool.acquire("c") is a
+    assert len(allocated) == 2
+    assert pool.get("a") is None and pool.get("c") is a
+
+
+def test_pool_wait_for_release():
+    pool = ChunkCachePool(lambda: build_cfm().allocate_chunk_cache(N_TIMESTEPS, max_len=16), max_sessions=1)
+    slab = pool.acquire("a")
+    releaser = threading.Timer(0.05, pool.release, args=("a",))
+    releaser.start()
+    start = time.monotonic()
+    assert pool.acquire("b", timeout=5) is slab
+    assert time.monotonic() - start < 5
+    releaser.join()
+    with pytest.raises(SessionLimitError):
+        pool.acquire("c", timeout=0.01)
+
+
+def test_interleaved_sessions_match_sequential():
+    """两个会话交替推理 chunk，结果与各自单独推理完全一致"""
+    cfm = build_cfm()
+    inputs = {name: make_chunks(seed) for name, seed in (("a", 1), ("b", 2))}
+
+    expected = {}
+    for name, (spks, chunks) in inputs.items():
+        session, outputs = (spks, None, None), []
+        for mu, cond in chunks:
+            x, session = run_chunk(cfm, session, mu, cond)
+            outputs.append(x)
+        expected[name] = outputs
+
+    pool = ChunkCachePool(lambda: cfm.allocate_chunk_cache(N_TIMESTEPS, max_len=64), max_sessions=2)
+    sessions = {name: (spks, None, None) for name, (spks, _) in inputs.items()}
+    outputs = {name: [] for name in inputs}
+    for i in range(3):
+        for name in ("a", "b"):
+            mu, cond = inputs[name][1][i]
+            x, sessions[name] = run_chunk(cfm, sessions[name], mu, cond, pool.acquire(name))
+            outputs[name].append(x)
+
+    for name in inputs:
+        for got, want in zip(outputs[name], expected[name]):
+            assert torch.allclose(got, want, atol=1e-6)
+        # returned caches live in the session's own slab
+        assert sessions[name][2].data_ptr() == pool.get(name).att_cache.data_ptr()
+
+
+def test_prompt_larger_than_slab_is_reported():
+    cfm = build_cfm()
+    slab = cfm.allocate_chunk_cache(N_TIMESTEPS, max_len=12)
+    slab.reset(window=8)
+    spks, chunks = make_chunks(0, n_chunks=1)
+    with pytest.raises(AssertionError):
+        run_chunk(cfm, (spks, None, None), *chunks[0], slab)
+
+
+if __name__ == "__main__":
+    test_pool_caps_and_reuses_slabs()
+    test_pool_wait_for_release()
+    test_interleaved_sessions_match_sequential()
+    test_prompt_larger_than_slab_is_reported()
+    print("测试完成！")
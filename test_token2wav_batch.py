@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+测试批量 flow 推理：右侧补齐不改变每条请求的 mel 输出；
+StepAudioTTS 把等待声码器的非流式请求合并成一次 token2wav_batch 调用
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from stepvocoder.cosyvoice2.embedding.dual_codebook import DualCodebookEmbedding
+from stepvocoder.cosyvoice2.flow.decoder_dit import DiT
+from stepvocoder.cosyvoice2.flow.flow import CausalMaskedDiffWithXvec
+from stepvocoder.cosyvoice2.flow.flow_matching import CausalConditionalCFM
+from stepvocoder.cosyvoice2.transformer.upsample_encoder_v2 import UpsampleConformerEncoderV2
+
+N_TIMESTEPS = 4
+
+
+def build_flow():
+    """随机初始化的小模型，结构与 cosyvoice.yaml 相同"""
+    torch.manual_seed(0)
+    encoder = UpsampleConformerEncoderV2(
+        input_size=64, output_size=64, attention_heads=2, linear_units=64,
+        num_blocks=2, num_up_blocks=2, dropout_rate=0.0, positional_dropout_rate=0.0,
+    )
+    estimator = DiT(in_channels=320, out_channels=80, depth=2, num_heads=2, head_dim=16, hidden_size=32)
+    # DiT 初始化会把输出层置零，这里换成随机权重让输出依赖输入
+    for param in estimator.parameters():
+        torch.nn.init.normal_(param, std=0.05)
+    flow = CausalMaskedDiffWithXvec(
+        input_size=64, output_size=80, spk_embed_dim=192, vocab_size=5121,
+        encoder=encoder, decoder=CausalConditionalCFM(estimator),
+        input_embedding=DualCodebookEmbedding(5121, 64),
+    )
+    return flow.eval()
+
+
+def make_item(token_len, prompt_len):
+    return (
+        torch.randint(0, 1024, (1, token_len, 2)),
+        torch.randint(0, 1024, (1, prompt_len, 2)),
+        torch.randn(1, prompt_len * 2, 80),
+        torch.randn(1, 192),
+    )
+
+
+def pad(seqs):
+    return pad_sequence([ts[0] for ts in seqs], batch_first=True), torch.tensor([ts.shape[1] for ts in seqs])
+
+
+def decode_alone(flow, item):
+    token, prompt_token, prompt_feat, embedding = item
+    length = lambda ts: torch.tensor([ts.shape[1]])
+    return flow.inference(
+        token, length(token), prompt_token, length(prompt_token),
+        prompt_feat, length(prompt_feat), embedding, N_TIMESTEPS,
+    )
+
+
+def decode_batch(flow, items):
+    token, token_len = pad([item[0] for item in items])
+    prompt_token, prompt_token_len = pad([item[1] for item in items])
+    prompt_feat, prompt_feat_len = pad([item[2] for item in items])
+    embedding = torch.cat([item[3] for item in items])
+    return flow.inference_batch(
+        token, token_len, prompt_token, prompt_token_len,
+        prompt_feat, prompt_feat_len, embedding, N_TIMESTEPS,
+    )
+
+
+def test_padding_does_not_change_outputs():
+    """不同长度的 token / prompt 一起解码，与逐条解码结果一致"""
+    flow = build_flow()
+    items = [make_item(7, 5), make_item(12, 3), make_item(4, 9)]
+
+    batched = decode_batch(flow, items)
+
+    assert len(batched) == len(items)
+    for item, mel in zip(items, batched):
+        alone = decode_alone(flow, item)
+        assert mel.shape == alone.shape == (1, 80, item[0].shape[1] * 2)
+        assert torch.allclose(mel, alone, atol=1e-5)
+
+
+def test_single_item_batch():
+    flow = build_flow()
+    item = make_item(6, 4)
+
+    (mel,) = decode_batch(flow, [item])
+
+    assert torch.allclose(mel, decode_alone(flow, item), atol=1e-5)
+
+
+class FakeCosyModel:
+    """记录声码器调用；“语音”就是请求自己的 token，token 越界的请求解码失败"""
+
+    def __init__(self):
+        self.calls = []  # (solver, number of requests)
+
+    @staticmethod
+    def _speech(token):
+        if (token < 0).any():
+            raise RuntimeError("token out of range")
+        return token.float()
+
+    def token2wav_nonstream(self, token, prompt_token, prompt_feat, embedding, n_timesteps=None, solver="euler"):
+        self.calls.append((solver, 1))
+        return self._speech(token)
+
+    def token2wav_batch(self, tokens, prompt_tokens, prompt_feats, embeddings, n_timesteps=None, solver="euler"):
+        self.calls.append((solver, len(tokens)))
+        return [self._speech(token) for token in tokens]
+
+
+def build_engine(vocoder_batch_size=4):
+    """只初始化声码器排队状态的 StepAudioTTS"""
+    # tts imports the tokenizer, whose FunASR model code ships with the downloaded models
+    tts = pytest.importorskip("tts")
+    engine = tts.StepAudioTTS.__new__(tts.StepAudioTTS)
+    engine.cosy_model = FakeCosyModel()
+    engine.vocoder_lock = threading.Lock()
+    engine.vocoder_batch_size = vocoder_batch_size
+    engine._vocode_pending = []
+    engine._vocode_pending_lock = threading.Lock()
+    return engine
+
+
+def vocode_while_busy(engine, requests):
+    """声码器被占用时提交全部请求，释放后返回每条请求的 Future"""
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        with engine.vocoder_lock:
+            futures = [
+                executor.submit(engine._token2wav, output_ids, [65536] * 5, torch.zeros(1, 10, 80), torch.zeros(1, 192), solver)
+                for output_ids, solver in requests
+            ]
+            deadline = time.monotonic() + 10
+            while len(engine._vocode_pending) < len(requests) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        for future in futures:
+            future.exception(timeout=10)
+    return futures
+
+
+def test_waiting_requests_are_vocoded_together():
+    engine = build_engine(vocoder_batch_size=4)
+    requests = [(torch.full((1, 6), 65536 + i), "euler") for i in range(5)] + [(torch.full((1, 6), 65600), "heun")]
+
+    futures = vocode_while_busy(engine, requests)
+
+    for (output_ids, _), future in zip(requests, futures):
+        assert torch.equal(future.result(), (output_ids - 65536).float())
+    sizes = [size for _, size in engine.cosy_model.calls]
+    assert sum(sizes) == len(requests)
+    assert max(sizes) > 1 and max(sizes) <= 4
+    assert len(engine.cosy_model.calls) < len(requests)
+
+
+def test_failing_request_does_not_fail_its_batch():
+    engine = build_engine()
+    requests = [(torch.full((1, 6), 65540), "euler"), (torch.full((1, 6), 100), "euler"), (torch.full((1, 6), 65541), "euler")]
+
+    futures = vocode_while_busy(engine, requests)
+
+    assert engine.cosy_model.calls[0] == ("euler", 3)
+    assert torch.equal(futures[0].result(), torch.full((1, 6), 4.0))
+    assert torch.equal(futures[2].result(), torch.full((1, 6), 5.0))
+    with pytest.raises(RuntimeError, match="out of range"):
+        futures[1].result()
+
+
+if __name__ == "__main__":
+    test_padding_does_not_change_outputs()
+    test_single_item_batch()
+    test_waiting_requests_are_vocoded_together()
+    test_failing_request_does_not_fail_its_batch()
+    print("测试完成！")
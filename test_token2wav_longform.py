@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+测试长音频非流式合成：分窗解码与流式路径一致、超过阈值自动切换、缓存不随输出长度增长
+"""
+import pytest
+import torch
+
+from stepvocoder.cosyvoice2.cli.cosyvoice import CosyVoice_stream_impl_
+from test_session_store import build_hift, mixed_tokens
+from test_token2wav_batch import build_flow
+
+CHUNK_SIZE = 6
+
+
+@pytest.fixture
+def impl():
+    # the encoder's torch.compile tracing takes far longer than the tiny model itself
+    with torch._dynamo.config.patch(disable=True):
+        yield CosyVoice_stream_impl_(
+            build_flow(), build_hift(), chunk_size_list=[CHUNK_SIZE], n_timesteps=2,
+            longform_chunk_size=CHUNK_SIZE, longform_min_tokens=60,
+        ).eval()
+
+
+def make_request(n_groups, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    token = torch.tensor([mixed_tokens(n_groups, generator)])
+    prompt_token = torch.tensor([mixed_tokens(4, generator)])
+    return token, prompt_token, torch.randn(1, 24, 80, generator=generator), torch.randn(1, 192, generator=generator)
+
+
+def record_chunks(impl):
+    """记录每次 inference_chunk 的 token 长度"""
+    lengths = []
+    original = impl.flow.inference_chunk
+
+    def wrapper(token, *args, **kwargs):
+        lengths.append(token.shape[1])
+        return original(token, *args, **kwargs)
+
+    impl.flow.inference_chunk = wrapper
+    return lengths
+
+
+def test_longform_matches_stream(impl):
+    token, prompt_token, prompt_feat, embedding = make_request(20)
+    torch.manual_seed(0)
+    longform = impl.token2wav_longform(token, prompt_token, prompt_feat, embedding)
+
+    torch.manual_seed(0)
+    impl.open_session("s")
+    assert impl.token2wav_stream(token[0].tolist(), prompt_token, prompt_feat, embedding, "s", False) is None
+    speeches = []
+    speech = impl.token2wav_stream([], prompt_token, prompt_feat, embedding, "s", False)
+    while speech is not None:
+        speeches.append(speech)
+        speech = impl.token2wav_stream([], prompt_token, prompt_feat, embedding, "s", False)
+    speeches.append(impl.token2wav_stream([], prompt_token, prompt_feat, embedding, "s", True))
+    assert torch.allclose(longform, torch.cat(speeches, dim=1), atol=1e-6)
+    # 3 tokens per group of 5, 2 mel frames per token, 480 samples per mel frame
+    assert longform.shape[1] == 20 * 3 * 2 * 480
+
+
+def test_nonstream_switches_above_threshold(impl):
+    lengths = record_chunks(impl)
+    full_solves = []
+    inference = impl.flow.inference
+    impl.flow.inference = lambda *args: full_solves.append(1) or inference(*args)
+
+    short = impl.token2wav_nonstream(*make_request(19))
+    assert lengths == [] and len(full_solves) == 1
+    long = impl.token2wav_nonstream(*make_request(20))
+    assert len(full_solves) == 1 and len(lengths) > 1
+    assert long.shape[1] == 20 * 3 * 2 * 480 and short.shape[1] == 19 * 3 * 2 * 480
+
+    # the windowed path only runs euler steps
+    lengths.clear()
+    impl.token2wav_nonstream(*make_request(20), solver="heun")
+    assert lengths == [] and len(full_solves) == 2
+
+
+def test_longform_memory_does_not_grow(impl):
+    lengths = record_chunks(impl)
+    slabs = []
+    allocate = impl.flow.allocate_chunk_cache
+    impl.flow.allocate_chunk_cache = lambda *args, **kwargs: slabs.append(allocate(*args, **kwargs)) or slabs[-1]
+
+    request = make_request(10)
+    impl.token2wav_longform(*request)
+    impl.token2wav_longform(make_request(200)[0], *request[1:])
+    assert slabs[0].nbytes == slabs[1].nbytes
+    # every window carries one chunk and its look ahead tokens
+    assert max(lengths) <= CHUNK_SIZE + impl.token_lookahead
+    ring = slabs[1].att_ring
+    assert ring.length == ring.prompt_len + impl.estimator_left_context
+
+
+if __name__ == "__main__":
+    with torch._dynamo.config.patch(disable=True):
+        for test in (test_longform_matches_stream, test_nonstream_switches_above_threshold, test_longform_memory_does_not_grow):
+            test(CosyVoice_stream_impl_(
+                build_flow(), build_hift(), chunk_size_list=[CHUNK_SIZE], n_timesteps=2,
+                longform_chunk_size=CHUNK_SIZE, longform_min_tokens=60,
+            ).eval())
+    print("测试完成！")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+测试 FunASR token 缓存（sqlite 存储 + 内存 LRU）
+"""
+import json
+
+from stepvocoder.cosyvoice2.utils import vq0206_codec
+from token_cache import TokenCache
+
+
+def make_result(seed, groups=40):
+    vq02 = [(seed * 7 + i) % 1024 for i in range(groups * 2)]
+    vq06 = [(seed * 13 + i) % 4096 for i in range(groups * 3)]
+    return vq0206_codec.interleave(vq02, vq06, offset=65536).tolist(), vq02, vq06
+
+
+def test_round_trip_and_lazy_reload(tmp_path):
+    cache = TokenCache(tmp_path)
+    result = make_result(1)
+    cache.put("a" * 32, result)
+    assert cache.get("a" * 32) == result
+    cache.flush()
+
+    # a new instance loads nothing eagerly and serves the entry from disk
+    reopened = TokenCache(tmp_path)
+    assert reopened.get_stats()["memory_entries"] == 0
+    assert reopened.get("a" * 32) == result
+    assert reopened.get("b" * 32) is None
+
+
+def test_byte_bounded_eviction(tmp_path):
+    entry_bytes = 2 * (40 * 2 + 40 * 3)  # int16 codes
+    cache = TokenCache(tmp_path, max_disk_bytes=entry_bytes * 3, max_memory_bytes=entry_bytes * 2)
+    for i in range(5):
+        cache.put(f"{i:032d}", make_result(i))
+        cache.flush()
+    stats = cache.get_stats()
+    assert stats["entries"] == 3 and stats["disk_bytes"] <= stats["max_disk_bytes"]
+    assert stats["memory_entries"] == 2 and stats["memory_bytes"] <= stats["max_memory_bytes"]
+    # oldest entries were evicted from both levels
+    assert cache.get(f"{0:032d}") is None
+    assert cache.get(f"{4:032d}") == make_result(4)
+
+
+def test_legacy_json_migration(tmp_path):
+    legacy_dir = tmp_path / "legacy"
+    audio_hash = "ab" + "0" * 30
+    result = make_result(3)
+    (legacy_dir / "ab").mkdir(parents=True)
+    legacy_file = legacy_dir / "ab" / f"{audio_hash}.json"
+    legacy_file.write_text(json.dumps({"hash": audio_hash, "tokens": result}))
+
+    cache = TokenCache(tmp_path / "store", legacy_json_dir=legacy_dir)
+    assert cache.get(audio_hash) == result
+    cache.flush()
+    assert not legacy_file.exists()
+    assert TokenCache(tmp_path / "store").get(audio_hash) == result
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    for test in (test_round_trip_and_lazy_reload, test_byte_bounded_eviction, test_legacy_json_migration):
+        with tempfile.TemporaryDirectory() as tmp:
+            test(Path(tmp))
+    print("测试完成！")
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+测试声线注册表的二进制存储与内存映射加载，以及按上传内容缓存的提示音频
+"""
+import numpy as np
+import pytest
+import torch
+
+from voice_registry import AudioArtifactCache, VoiceArtifacts, VoiceRegistry, artifacts_nbytes, load_voice, save_voice
+
+
+def make_voice(seed=0):
+    rng = np.random.default_rng(seed)
+    generator = torch.Generator().manual_seed(seed)
+    return VoiceArtifacts(
+        prompt_text="我总觉得，有人在跟着我。",
+        prompt_speaker="debug_123",
+        vq0206_codes=rng.integers(65536, 65536 + 5120, size=50),
+        vq02_codes=rng.integers(0, 1024, size=20),
+        vq06_codes=rng.integers(0, 4096, size=30),
+        speech_feat=torch.randn(1, 123, 80, generator=generator),
+        speech_embedding=torch.randn(1, 192, generator=generator),
+        metadata={"locale": "zh-CN"},
+    )
+
+
+def test_round_trip(tmp_path):
+    voice = make_voice()
+    path = tmp_path / "fear_female.voice"
+    save_voice(path, voice)
+    loaded = load_voice(path)
+
+    assert loaded.prompt_text == voice.prompt_text
+    assert loaded.prompt_speaker == voice.prompt_speaker
+    assert loaded.metadata == voice.metadata
+    for name in ("vq0206_codes", "vq02_codes", "vq06_codes"):
+        assert np.array_equal(getattr(loaded, name), getattr(voice, name))
+    assert torch.equal(loaded.speech_feat, voice.speech_feat)
+    assert torch.equal(loaded.speech_embedding, voice.speech_embedding)
+    # arrays are views into the memory mapping, not copies
+    assert isinstance(loaded.vq0206_codes, np.memmap)
+
+
+def test_registry_persists_across_instances(tmp_path):
+    registry = VoiceRegistry(tmp_path)
+    registry.register("custom-1", make_voice(1))
+    assert "custom-1" in registry
+
+    reopened = VoiceRegistry(tmp_path)
+    assert reopened.list_ids() == ["custom-1"]
+    assert torch.equal(reopened.get("custom-1").speech_feat, make_voice(1).speech_feat)
+
+    with pytest.raises(ValueError):
+        registry.register("../escape", make_voice())
+
+
+def test_audio_artifact_cache_lru_by_bytes():
+    """按字节上限淘汰最久未使用的条目"""
+    voices = [make_voice(seed) for seed in range(3)]
+    entry_bytes = artifacts_nbytes(voices[0]) + 8
+    cache = AudioArtifactCache(max_bytes=2 * entry_bytes)
+    cache.put("a", voices[0], b"\x00" * 8)
+    cache.put("b", voices[1], b"\x01" * 8)
+    assert cache.get("a")[0] is voices[0]  # "b" is now least recently used
+    cache.put("c", voices[2], b"\x02" * 8)
+
+    assert cache.get("b") is None
+    assert cache.get("c")[1] == b"\x02" * 8
+    stats = cache.get_stats()
+    assert stats["entries"] == 2 and stats["bytes"] == 2 * entry_bytes
+    assert stats["hits"] == 2 and stats["misses"] == 1
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    with tempfile.TemporaryDirectory() as tmp:
+        test_round_trip(Path(tmp))
+    with tempfile.TemporaryDirectory() as tmp:
+        test_registry_persists_across_instances(Path(tmp))
+    test_audio_artifact_cache_lru_by_bytes()
+    print("测试完成！")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+测试 vq02/vq06 交织编解码：与原先的列表实现逐项一致、交织/解交织互逆、不修改输入、不完整分组的补齐策略
+"""
+import random
+from functools import reduce
+
+import numpy as np
+import pytest
+import torch
+
+from stepvocoder.cosyvoice2.cli.cosyvoice import CosyVoice_stream_impl_
+from stepvocoder.cosyvoice2.utils import vq0206_codec
+
+N_CASES = 200
+
+
+def legacy_store_tokens(vq02_ori, vq06_ori):
+    """StepAudioTokenizer.store_tokens 原先的逐组拼接"""
+    vq02 = [int(x) + 65536 for x in vq02_ori]
+    vq06 = [int(x) + 65536 + 1024 for x in vq06_ori]
+    chunk_nums = min(len(vq06) // 3, len(vq02) // 2)
+    speech_tokens = []
+    for idx in range(chunk_nums):
+        speech_tokens += vq02[idx * 2 : (idx + 1) * 2]
+        speech_tokens += vq06[idx * 3 : (idx + 1) * 3]
+    return speech_tokens
+
+
+def legacy_merge(vq02, vq06):
+    """StepAudioTokenizer.merge_vq0206_to_token_str 原先的 while 循环"""
+    _vq06 = [1024 + x for x in vq06]
+    result = []
+    i = j = 0
+    while i < len(vq02) - 1 and j < len(_vq06) - 2:
+        result.extend(vq02[i : i + 2] + _vq06[j : j + 3])
+        i += 2
+        j += 3
+    return "".join([f"<audio_{x}>" for x in result])
+
+
+def legacy_reshape(mix_seq):
+    """CosyVoice_stream_impl_._reshape 原先的 reduce 实现（会就地补齐输入）"""
+    if len(mix_seq) % 5 > 0:
+        pad_len = 5 - (len(mix_seq) % 5)
+        mix_seq += [0, 0, 0, 1024, 1024, 1024][-pad_len:]
+    num_groups = len(mix_seq) // 5
+    vq02 = reduce(lambda x, y: x + y, [mix_seq[i * 5 : i * 5 + 2] + [1024] for i in range(num_groups)])
+    vq06 = reduce(lambda x, y: x + y, [mix_seq[i * 5 + 2 : i * 5 + 5] for i in range(num_groups)])
+    return torch.stack([
+        torch.tensor(vq02, dtype=torch.long),
+        torch.tensor(vq06, dtype=torch.long) - 1024 + 1025,
+    ], dim=1)
+
+
+def random_codes(rng):
+    """长度随机、彼此不一定匹配的 vq02 / vq06 码流"""
+    n02, n06 = rng.randrange(0, 60), rng.randrange(0, 90)
+    return [rng.randrange(1024) for _ in range(n02)], [rng.randrange(4096) for _ in range(n06)]
+
+
+def random_mixed(rng):
+    """交织序列，末尾可能带一个不完整分组"""
+    vq02, vq06 = random_codes(rng)
+    mix = vq0206_codec.interleave(vq02, vq06).tolist()
+    tail = [rng.randrange(1024), rng.randrange(1024)] + [1024 + rng.randrange(4096) for _ in range(3)]
+    return mix + tail[: rng.randrange(5)]
+
+
+def test_interleave_matches_legacy():
+    rng = random.Random(0)
+    for _ in range(N_CASES):
+        vq02, vq06 = random_codes(rng)
+        assert vq0206_codec.interleave(vq02, vq06, offset=65536).tolist() == legacy_store_tokens(vq02, vq06)
+        merged = "".join(f"<audio_{x}>" for x in vq0206_codec.interleave(vq02, vq06).tolist())
+        assert merged == legacy_merge(vq02, vq06)
+
+
+def test_deinterleave_to_vq0206_matches_legacy():
+    rng = random.Random(1)
+    for _ in range(N_CASES):
+        mix = random_mixed(rng)
+        if not mix:
+            continue
+        before = list(mix)
+        assert torch.equal(CosyVoice_stream_impl_._reshape(mix), legacy_reshape(list(mix)))
+        assert mix == before
+        assert torch.equal(vq0206_codec.deinterleave_to_vq0206(torch.tensor(mix)), legacy_reshape(list(mix)))
+
+
+def test_round_trip():
+    rng = random.Random(2)
+    for _ in range(N_CASES):
+        vq02, vq06 = random_codes(rng)
+        groups = min(len(vq02) // 2, len(vq06) // 3)
+        offset = rng.choice([0, 65536])
+        got02, got06 = vq0206_codec.deinterleave(vq0206_codec.interleave(vq02, vq06, offset=offset), offset=offset)
+        assert got02.tolist() == vq02[: groups * 2]
+        assert got06.tolist() == vq06[: groups * 3]
+
+        rows = vq0206_codec.deinterleave_to_vq0206(vq0206_codec.interleave(vq02, vq06))
+        assert rows.shape == (groups * 3, 2) and rows.dtype == torch.long
+        assert rows[:, 0].reshape(-1, 3)[:, :2].reshape(-1).tolist() == vq02[: groups * 2]
+        assert (rows[:, 0].reshape(-1, 3)[:, 2] == vq0206_codec.VQ02_PAD).all()
+        assert (rows[:, 1] - vq0206_codec.VQ06_BASE).tolist() == vq06[: groups * 3]
+
+
+def test_inputs_not_modified():
+    mix = [1, 2, 1030, 1031, 1032, 3, 4]
+    tensor = torch.tensor(mix)
+    array = np.array(mix)
+    for seq in (mix, tensor, array):
+        vq0206_codec.deinterleave_to_vq0206(seq)
+    assert mix == [1, 2, 1030, 1031, 1032, 3, 4]
+    assert tensor.tolist() == mix and array.tolist() == mix
+
+
+@pytest.mark.parametrize("remainder", [1, 2, 3, 4])
+def test_partial_group_policy(remainder):
+    mix = [5, 6, 1030, 1031, 1032] + [7, 8, 1040, 1041][:remainder]
+    padded = vq0206_codec.deinterleave_to_vq0206(mix)
+    assert padded.shape == (6, 2)
+    # missing vq02 slots take code 0, missing vq06 slots code 0 (1025 in the vocoder's table)
+    vq02 = [7, 8][:remainder]
+    assert padded[3:, 0].tolist() == vq02 + [0] * (2 - len(vq02)) + [1024]
+    vq06 = [1040, 1041][: max(remainder - 2, 0)]
+    assert padded[3:, 1].tolist() == [x + 1 for x in vq06] + [1025] * (3 - len(vq06))
+
+    dropped = vq0206_codec.deinterleave_to_vq0206(mix, partial=vq0206_codec.PARTIAL_DROP)
+    assert torch.equal(dropped, padded[:3])
+    with pytest.raises(ValueError):
+        vq0206_codec.deinterleave_to_vq0206(mix, partial="truncate")
+
+
+def test_empty_input():
+    assert vq0206_codec.interleave([], [1, 2, 3]).tolist() == []
+    assert vq0206_codec.deinterleave_to_vq0206([]).shape == (0, 2)
+    vq02, vq06 = vq0206_codec.deinterleave([])
+    assert len(vq02) == len(vq06) == 0
+
+
+if __name__ == "__main__":
+    test_interleave_matches_legacy()
+    test_deinterleave_to_vq0206_matches_legacy()
+    test_round_trip()
+    test_inputs_not_modified()
+    for remainder in (1, 2, 3, 4):
+        test_partial_group_policy(remainder)
+    test_empty_input()
+    print("测试完成！")
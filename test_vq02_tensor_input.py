@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+测试 vq02 编码器直接输入 16 kHz 张量：与原先 BytesIO WAV 输入得到相同的 enc_out 与 vq02 码
+"""
+import io
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torchaudio
+
+from vq_quantizer import NearestCentroidQuantizer
+
+# the vendored FunASR package needs its model code, which ships with the downloaded models
+pytest.importorskip("funasr_detach")
+from funasr_detach.auto.auto_model import AutoModel
+from funasr_detach.frontends.wav_frontend import WavFrontend
+from funasr_detach.utils.load_utils import extract_fbank, load_audio_text_image_video
+
+
+class FakeEncoderModel(torch.nn.Module):
+    """
+    模拟 Paraformer 的 infer_encoder 数据路径：解码输入 -> fbank -> 编码器
+
+    编码器换成固定的线性层；frontend 关闭 dither，使相同的采样点得到相同的特征。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.frontend = WavFrontend(fs=16000, n_mels=80, lfr_m=7, lfr_n=6, dither=0.0)
+        self.encoder = torch.nn.Linear(80 * 7, 64)
+        self.samples = []
+
+    def cuda(self, device=None):
+        # AutoModel.infer_encoder always moves the model to the GPU, the test runs on CPU
+        return self
+
+    def infer_encoder(self, data_in, key, **kwargs):
+        audio_sample_list = load_audio_text_image_video(
+            data_in, fs=self.frontend.fs, audio_fs=kwargs.get("fs", 16000)
+        )
+        self.samples.append(audio_sample_list[0])
+        speech, _ = extract_fbank(audio_sample_list, data_type=kwargs.get("data_type", "sound"), frontend=self.frontend)
+        enc_out = self.encoder(speech)
+        return [{"key": key[0], "enc_out": enc_out}], {}, kwargs.get("cache", {})
+
+
+def run_encoder(model, data):
+    auto_model = SimpleNamespace(kwargs={}, model=model)
+    res, _ = AutoModel.infer_encoder(auto_model, input=[data], chunk_size=[0, 4, 5], is_final=True, cache={})
+    return res[0]["enc_out"]
+
+
+def test_tensor_input_matches_wav_bytes():
+    generator = torch.Generator().manual_seed(0)
+    audio = (torch.rand(1, 3 * 16000, generator=generator) - 0.5) * 0.6  # preprocessed (1, N) tokenizer input
+    model = FakeEncoderModel().eval()
+    quantizer = NearestCentroidQuantizer(torch.randn(1024, 64, generator=generator))
+
+    # old get_vq02_code: WAV round trip through an in-memory file
+    wav = io.BytesIO()
+    torchaudio.save(wav, audio, 16000, format="wav")
+    wav.seek(0)
+    want = run_encoder(model, wav)
+
+    # new get_vq02_code: the mono float32 samples themselves
+    got = run_encoder(model, audio[0].to("cpu", torch.float32))
+
+    assert torch.equal(model.samples[0], model.samples[1])
+    assert torch.equal(got, want)
+    assert quantizer.quantize_batch([got])[0].tolist() == quantizer.quantize_batch([want])[0].tolist()
+
+
+if __name__ == "__main__":
+    test_tensor_input_matches_wav_bytes()
+    print("测试完成！")
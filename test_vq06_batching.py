@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+测试 vq06 批量编码：批量 ONNX 推理与原先逐窗口循环得到相同的 token，
+wav2token_batch 对不同长度（含尾部短窗口）的音频与 wav2token 结果一致（vq02 一次离线编码整桶）
+"""
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import whisper
+
+# the tokenizer imports the vendored FunASR package, whose model code ships with the downloaded models
+tokenizer_module = pytest.importorskip("tokenizer")
+from funasr_detach.auto.auto_model import AutoModel
+from token_cache import TokenCache
+from vq_quantizer import NearestCentroidQuantizer
+
+StepAudioTokenizer = tokenizer_module.StepAudioTokenizer
+SAMPLE_RATE = 16000
+
+
+class FakeOrtSession:
+    """
+    代替 speech_tokenizer_v1.onnx：每 4 帧 log-mel 一个 token
+
+    每个 token 还依赖整段输入（包括补齐的帧）的均值，像不看 feat_len 的注意力层，
+    所以任何补齐都会改变 token。
+    """
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="feats"), SimpleNamespace(name="feats_length")]
+
+    def get_outputs(self):
+        return [SimpleNamespace(name="indices")]
+
+    def run(self, output_names, inputs):
+        feat = inputs["feats"]  # (B, 128, T)
+        batch, _, frames = feat.shape
+        assert inputs["feats_length"].tolist() == [frames] * batch
+        self.batch_sizes.append(batch)
+        n_tokens = (frames + 3) // 4
+        pooled = np.pad(feat.mean(axis=1), ((0, 0), (0, n_tokens * 4 - frames)))
+        local = pooled.reshape(batch, n_tokens, 4).sum(axis=2)
+        context = feat.mean(axis=(1, 2))[:, None]
+        return [(np.floor((local + context) * 1000) % 4096).astype(np.int64)]
+
+
+class FakeParaformer(torch.nn.Module):
+    """
+    代替流式 Paraformer 编码器：每 960 个采样点一帧（约 16.7 Hz）
+
+    编码结果加上 cache 中已编码的帧数，且 is_final 时不清空 cache，
+    所以不同 clip 之间泄漏的编码器状态会改变 vq02 码。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def cuda(self, device=None):
+        # AutoModel.infer_encoder always moves the model to the GPU, the test runs on CPU
+        return self
+
+    def infer_encoder(self, data_in, key, cache, is_final, **kwargs):
+        self.calls += 1
+        speech = data_in[0]
+        frames = speech[: speech.shape[0] // 960 * 960].reshape(-1, 960)[:, :8]
+        offset = cache.get("frames", 0)
+        cache["frames"] = offset + frames.shape[0]
+        return [{"key": key[0], "enc_out": (frames * 1e3 + offset)[None]}], {}, cache
+
+
+class FakeAutoModel:
+    """AutoModel.infer_encoder 跑在 FakeParaformer 上，记录每次调用传入的 clip 数"""
+
+    def __init__(self):
+        self.kwargs = {}
+        self.model = FakeParaformer()
+        self.input_sizes = []
+
+    def infer_encoder(self, input, **kwargs):
+        self.input_sizes.append(len(input))
+        return AutoModel.infer_encoder(self, input, **kwargs)
+
+
+def build_tokenizer(vq06_batch_size=8, token_cache=None):
+    """只初始化 vq02/vq06 相关状态的 tokenizer，ONNX 与 Paraformer 换成确定性的占位实现"""
+    tokenizer = StepAudioTokenizer.__new__(StepAudioTokenizer)
+    tokenizer.ort_session = FakeOrtSession()
+    tokenizer.vq06_feat_name, tokenizer.vq06_feat_len_name = [x.name for x in tokenizer.ort_session.get_inputs()[:2]]
+    tokenizer.vq06_output_name = tokenizer.ort_session.get_outputs()[0].name
+    tokenizer.vq06_batch_size = vq06_batch_size
+    tokenizer.vq06_lock = threading.Lock()
+    tokenizer.enable_cache = token_cache is not None
+    tokenizer.token_cache = token_cache
+    tokenizer.cache_hits = tokenizer.cache_misses = 0
+    tokenizer.funasr_model = FakeAutoModel()
+    tokenizer.vq02_quantizer = NearestCentroidQuantizer(torch.randn(1024, 8, generator=torch.Generator().manual_seed(0)))
+    tokenizer.vq02_lock = threading.Lock()
+    tokenizer.chunk_size = [0, 4, 5]
+    tokenizer.encoder_chunk_look_back = 4
+    tokenizer.decoder_chunk_look_back = 1
+    return tokenizer
+
+
+def legacy_get_vq06_code(tokenizer, audio):
+    """原先的逐窗口实现，每个 30 s 窗口单独跑一次 ONNX"""
+    speech_tokens = []
+    for chunk in tokenizer_module.split_audio(audio.squeeze(0), chunk_duration=30 * 16000):
+        duration = round(chunk.shape[0] / 16000, 2)
+        feat = whisper.log_mel_spectrogram(chunk, n_mels=128).unsqueeze(0)
+        feat_len = np.array([feat.shape[2]], dtype=np.int32)
+        ort_session = tokenizer.ort_session
+        chunk_token = ort_session.run(
+            None,
+            {
+                ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
+                ort_session.get_inputs()[1].name: feat_len,
+            },
+        )[0].flatten().tolist()
+        assert abs(len(chunk_token) - duration * 25) <= 2
+        speech_tokens += chunk_token
+    return speech_tokens
+
+
+def make_clip(seconds, seed):
+    generator = torch.Generator().manual_seed(seed)
+    return (torch.rand(1, int(seconds * SAMPLE_RATE), generator=generator) - 0.5) * 0.5
+
+
+def test_get_vq06_code_matches_per_window_loop():
+    tokenizer = build_tokenizer(vq06_batch_size=2)
+    audio = make_clip(3 * 30 + 4.3, seed=0)  # three full windows and a short tail
+    want = legacy_get_vq06_code(tokenizer, audio)
+
+    tokenizer.ort_session.batch_sizes.clear()
+    assert tokenizer.get_vq06_code(audio) == want
+    # full windows ran batched, the tail on its own
+    assert tokenizer.ort_session.batch_sizes == [2, 1, 1]
+    # the same windows from precomputed log-mels (shared with Whisper ASR)
+    assert tokenizer.get_vq06_code(audio, log_mels=tokenizer.vq06_log_mels(audio)) == want
+
+
+def test_wav2token_batch_matches_wav2token(tmp_path):
+    # full windows, distinct tails, two clips with equal tails and a clip shorter than a window
+    seconds = [67.3, 12.0, 31.0, 12.0, 45.0, 0.5]
+    clips = [(make_clip(s, seed=i), SAMPLE_RATE) for i, s in enumerate(seconds)]
+    direct = build_tokenizer()
+    want = [direct.wav2token(audio, sr, enable_trim=False) for audio, sr in clips]
+
+    cache = TokenCache(tmp_path, legacy_json_dir=None)
+    tokenizer = build_tokenizer(vq06_batch_size=4, token_cache=cache)
+    got = dict(tokenizer.wav2token_batch(clips, enable_trim=False, batch_size=8))
+    assert [got[i] for i in range(len(clips))] == want
+    # one run for the four full windows, one per tail length (the two 12 s clips share theirs)
+    assert sorted(tokenizer.ort_session.batch_sizes) == [1, 1, 1, 1, 2, 4]
+    # vq02 of the whole bucket came from one offline encoder call, each clip from a fresh state
+    assert tokenizer.funasr_model.input_sizes == [len(clips)]
+    assert tokenizer.funasr_model.model.calls == len(clips)
+
+    # later single-clip lookups read what the batch cached
+    cache.flush()
+    for (audio, sr), result in zip(clips, want):
+        assert tokenizer.wav2token(audio, sr, enable_trim=False) == result
+    assert tokenizer.cache_hits == len(clips)
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+
+    test_get_vq06_code_matches_per_window_loop()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        test_wav2token_batch_matches_wav2token(Path(tmp_dir))
+    print("测试完成！")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+测试最近质心量化器与 torch.cdist 结果一致
+"""
+import numpy as np
+import torch
+
+from vq_quantizer import NearestCentroidQuantizer
+
+
+def reference_indices(frames, codebook):
+    """原 StepAudioTokenizer.kmean_cluster 实现"""
+    return torch.cdist(frames, codebook).argmin(dim=1).numpy()
+
+
+def test_matches_cdist_across_chunks():
+    generator = torch.Generator().manual_seed(0)
+    codebook = torch.randn(1024, 512, generator=generator)
+    # encoder-like frames: noisy copies of centroids plus random frames
+    picks = torch.randint(0, 1024, (700,), generator=generator)
+    frames = torch.cat([
+        codebook[picks] + 0.3 * torch.randn(700, 512, generator=generator),
+        torch.randn(300, 512, generator=generator),
+    ])
+    quantizer = NearestCentroidQuantizer(codebook, chunk_size=128)
+
+    indices = quantizer.quantize(frames.unsqueeze(0))
+    assert indices.dtype == np.int64
+    assert np.array_equal(indices, reference_indices(frames, codebook))
+    assert np.array_equal(indices[:700], picks.numpy())
+
+
+def test_batch_of_variable_length_utterances():
+    """多段不等长输入一次量化，切分结果与逐段量化一致"""
+    generator = torch.Generator().manual_seed(1)
+    codebook = torch.randn(64, 16, generator=generator)
+    samples = [torch.randn(1, n, 16, generator=generator) for n in (5, 1, 17, 0, 9)]
+    quantizer = NearestCentroidQuantizer(codebook, chunk_size=8)
+
+    batch = quantizer.quantize_batch(samples)
+    assert [len(x) for x in batch] == [5, 1, 17, 0, 9]
+    for sample, indices in zip(samples, batch):
+        assert np.array_equal(indices, reference_indices(sample[0], codebook))
+
+
+if __name__ == "__main__":
+    test_matches_cdist_across_chunks()
+    test_batch_of_variable_length_utterances()
+    print("测试完成！")
@@ -0,0 +1,246 @@
+"""
+Persistent cache of FunASR audio tokens.
+
+Entries map an audio hash to its vq02 / vq06 codes. They live in a single
+sqlite file (codes stored as little-endian int16 blobs) and are only read on
+demand, so startup cost does not grow with the cache. A byte-bounded
+`OrderedDict` keeps hot entries in memory with O(1) LRU updates. Inserts,
+access-time updates and disk eviction run on a background writer thread, off
+the request path.
+"""
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from stepvocoder.cosyvoice2.utils import vq0206_codec
+
+logger = logging.getLogger(__name__)
+
+CODE_DTYPE = np.dtype("<i2")  # vq02 < 1024, vq06 < 4096
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    hash TEXT PRIMARY KEY,
+    vq02 BLOB NOT NULL,
+    vq06 BLOB NOT NULL,
+    nbytes INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta VALUES ('bytes', 0), ('count', 0);
+"""
+
+
+class TokenCache:
+    """
+    Two-level (memory + sqlite) LRU cache of `(speech_tokens, vq02, vq06)`
+
+    Both levels are bounded by bytes of stored codes. `speech_tokens` is not
+    stored, it is rebuilt from the codes on load.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_disk_bytes: int = 512 * 1024 ** 2,
+        max_memory_bytes: int = 64 * 1024 ** 2,
+        legacy_json_dir: Optional[str] = None,
+    ):
+        """
+        Initialize TokenCache
+
+        Args:
+            cache_dir: Directory holding `tokens.sqlite`
+            max_disk_bytes: Upper bound on code bytes kept on disk
+            max_memory_bytes: Upper bound on code bytes kept in memory
+            legacy_json_dir: Directory of the old per-entry JSON cache; entries
+                are migrated lazily when looked up
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.cache_dir / "tokens.sqlite"
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.legacy_json_dir = Path(legacy_json_dir) if legacy_json_dir else None
+
+        self._memory = OrderedDict()  # {hash: (result, nbytes)}
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._db_lock = threading.Lock()
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+
+        self._pending = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True, name="TokenCache-writer")
+        self._writer.start()
+
+    @staticmethod
+    def _encode(codes) -> bytes:
+        return np.asarray(codes, dtype=CODE_DTYPE).tobytes()
+
+    @staticmethod
+    def _decode(blob: bytes) -> List[int]:
+        return np.frombuffer(blob, dtype=CODE_DTYPE).astype(np.int64).tolist()
+
+    def _remember(self, audio_hash: str, result, nbytes: int):
+        with self._lock:
+            if audio_hash in self._memory:
+                self._memory.move_to_end(audio_hash)
+                return
+            if nbytes > self.max_memory_bytes:
+                return
+            self._memory[audio_hash] = (result, nbytes)
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.max_memory_bytes:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted
+
+    def get(self, audio_hash: str) -> Optional[Tuple[List[int], List[int], List[int]]]:
+        """Return `(speech_tokens, vq02, vq06)` or None"""
+        with self._lock:
+            entry = self._memory.get(audio_hash)
+            if entry is not None:
+                self._memory.move_to_end(audio_hash)
+        if entry is not None:
+            self._pending.put(("touch", audio_hash))
+            return entry[0]
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT vq02, vq06, nbytes FROM entries WHERE hash = ?", (audio_hash,)
+            ).fetchone()
+        if row is None:
+            return self._get_legacy(audio_hash)
+        vq02, vq06 = self._decode(row[0]), self._decode(row[1])
+        result = (vq0206_codec.interleave(vq02, vq06, offset=65536).tolist(), vq02, vq06)
+        self._remember(audio_hash, result, row[2])
+        self._pending.put(("touch", audio_hash))
+        return result
+
+    def _get_legacy(self, audio_hash: str):
+        if self.legacy_json_dir is None:
+            return None
+        path = self.legacy_json_dir / audio_hash[:2] / f"{audio_hash}.json"
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                _, vq02, vq06 = json.load(f)["tokens"]
+        except Exception as e:
+            logger.debug(f"Failed to read legacy cache file {path}: {e}")
+            return None
+        result = (vq0206_codec.interleave(vq02, vq06, offset=65536).tolist(), list(vq02), list(vq06))
+        self.put(audio_hash, result)
+        self._pending.put(("unlink", path))
+        return result
+
+    def put(self, audio_hash: str, result: Tuple[List[int], List[int], List[int]]):
+        """Cache `(speech_tokens, vq02, vq06)`; the disk write happens in the background"""
+        _, vq02, vq06 = result
+        vq02_blob, vq06_blob = self._encode(vq02), self._encode(vq06)
+        nbytes = len(vq02_blob) + len(vq06_blob)
+        self._remember(audio_hash, result, nbytes)
+        if nbytes <= self.max_disk_bytes:
+            self._pending.put(("insert", (audio_hash, vq02_blob, vq06_blob, nbytes)))
+
+    def _write_loop(self):
+        while True:
+            ops = [self._pending.get()]
+            while not self._pending.empty():
+                ops.append(self._pending.get_nowait())
+            try:
+                self._apply(ops)
+            except Exception as e:
+                logger.warning(f"Failed to write token cache: {e}")
+            finally:
+                for _ in ops:
+                    self._pending.task_done()
+
+    def _apply(self, ops):
+        now = time.time()
+        with self._db_lock:
+            self._db.execute("BEGIN")
+            try:
+                for op, arg in ops:
+                    if op == "insert":
+                        audio_hash, vq02_blob, vq06_blob, nbytes = arg
+                        cursor = self._db.execute(
+                            "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)",
+                            (audio_hash, vq02_blob, vq06_blob, nbytes, now),
+                        )
+                        if cursor.rowcount:
+                            self._add_totals(nbytes, 1)
+                    elif op == "touch":
+                        self._db.execute("UPDATE entries SET last_access = ? WHERE hash = ?", (now, arg))
+                    elif op == "clear":
+                        self._db.execute("DELETE FROM entries")
+                        self._db.execute("UPDATE meta SET value = 0")
+                self._evict()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        for op, arg in ops:
+            if op == "unlink":
+                arg.unlink(missing_ok=True)
+
+    def _add_totals(self, nbytes: int, count: int):
+        self._db.execute("UPDATE meta SET value = value + ? WHERE key = 'bytes'", (nbytes,))
+        self._db.execute("UPDATE meta SET value = value + ? WHERE key = 'count'", (count,))
+
+    def _evict(self):
+        total = self._totals()[0]
+        while total > self.max_disk_bytes:
+            rows = self._db.execute(
+                "SELECT hash, nbytes FROM entries ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for audio_hash, nbytes in rows:
+                if total <= self.max_disk_bytes:
+                    break
+                self._db.execute("DELETE FROM entries WHERE hash = ?", (audio_hash,))
+                self._add_totals(-nbytes, -1)
+                total -= nbytes
+
+    def _totals(self) -> Tuple[int, int]:
+        values = dict(self._db.execute("SELECT key, value FROM meta").fetchall())
+        return values["bytes"], values["count"]
+
+    def flush(self):
+        """Block until queued writes are on disk"""
+        self._pending.join()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        self._pending.put(("clear", None))
+        self.flush()
+
+    def get_stats(self):
+        with self._db_lock:
+            disk_bytes, entries = self._totals()
+        with self._lock:
+            memory_entries, memory_bytes = len(self._memory), self._memory_bytes
+        return {
+            "entries": entries,
+            "disk_bytes": disk_bytes,
+            "max_disk_bytes": self.max_disk_bytes,
+            "memory_entries": memory_entries,
+            "memory_bytes": memory_bytes,
+            "max_memory_bytes": self.max_memory_bytes,
+        }
@@ -1,24 +1,42 @@
-import io
 import threading
 import time
 import os
 import hashlib
-import json
-from pathlib import Path
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby, islice
 
 import numpy as np
 import torch
-import torchaudio
 import onnxruntime
 import whisper
 
 from funasr_detach import AutoModel
 from utils import resample_audio, energy_norm_fn, trim_silence
 from model_loader import model_loader, ModelSource
+from token_cache import TokenCache
+from vq_quantizer import NearestCentroidQuantizer
+from stepvocoder.cosyvoice2.utils import vq0206_codec
+from stepvocoder.cosyvoice2.utils.session_store import SessionStore
 
 logger = logging.getLogger(__name__)
 
+VQ06_WINDOW = 30 * 16000  # speech tokenizer input limit, in samples
+
+
+def split_audio(audio, chunk_duration=480000):
+    start = 0
+    chunks = []
+    while start < len(audio):
+        end = min(start + chunk_duration, len(audio))
+        chunk = audio[start:end]
+        if len(chunk) < 480:
+            pass
+        else:
+            chunks.append(chunk)
+        start = end
+    return chunks
+
 
 class StepAudioTokenizer:
     def __init__(
@@ -27,7 +45,11 @@ class StepAudioTokenizer:
         model_source=ModelSource.AUTO,
         funasr_model_id="dengcunqin/speech_paraformer-large_asr_nat-zh-cantonese-en-16k-vocab8501-online",
         enable_cache=True,
-        cache_max_size=1000
+        cache_max_bytes=512 * 1024 ** 2,
+        cache_memory_bytes=64 * 1024 ** 2,
+        vq06_batch_size=8,
+        vq02_session_ttl=300.0,
+        vq02_session_max_bytes=256 * 1024 ** 2
     ):
         """
         Initialize StepAudioTokenizer
@@ -36,6 +58,13 @@ class StepAudioTokenizer:
             encoder_path: Encoder path
             model_source: Model source (auto/local/modelscope/huggingface)
             funasr_model_id: FunASR model ID or path
+            enable_cache: Cache audio tokens by audio hash
+            cache_max_bytes: Byte budget of the on-disk token cache
+            cache_memory_bytes: Byte budget of the in-memory token cache
+            vq06_batch_size: Number of 30 s windows tokenized per ONNX run
+            vq02_session_ttl: Seconds before an idle streaming vq02 session is dropped
+            vq02_session_max_bytes: Budget of encoder cache tensors over all streaming
+                vq02 sessions, least recently used sessions are evicted beyond it
         """
         funasr_model_path = os.path.join(encoder_path, funasr_model_id)
         # Load FunASR model - use unified loader to handle all modes
@@ -61,6 +90,7 @@ class StepAudioTokenizer:
             raise FileNotFoundError(f"Cosy tokenizer file not found: {cosy_tokenizer_path}")
 
         self.kms = torch.tensor(np.load(kms_path))
+        self.vq02_quantizer = NearestCentroidQuantizer(self.kms)
 
         providers = ["CUDAExecutionProvider"]
         session_option = onnxruntime.SessionOptions()
@@ -71,29 +101,34 @@ class StepAudioTokenizer:
         self.ort_session = onnxruntime.InferenceSession(
             cosy_tokenizer_path, sess_options=session_option, providers=providers
         )
+        self.vq06_feat_name, self.vq06_feat_len_name = [x.name for x in self.ort_session.get_inputs()[:2]]
+        self.vq06_output_name = self.ort_session.get_outputs()[0].name
+        self.vq06_batch_size = vq06_batch_size
         self.chunk_size = [0, 4, 5]
         self.encoder_chunk_look_back = 4
         self.decoder_chunk_look_back = 1
 
-        self.vq02_sessions = {}
+        # streaming encoder caches of unfinished get_vq02_code sessions
+        self.vq02_sessions = SessionStore(ttl=vq02_session_ttl, max_bytes=vq02_session_max_bytes)
         self.vq02_lock = threading.Lock()
         self.vq06_lock = threading.Lock()
         
-        # 缓存功能
+        # 缓存功能（sqlite 持久化 + 内存 LRU，按需加载，后台写入）
         self.enable_cache = enable_cache
-        self.cache_max_size = cache_max_size
-        self.cache_dir = Path("/app/cache/funasr")
-        self._cache = {}  # {audio_hash: (speech_tokens, vq02_ori, vq06_ori)}
-        self._cache_order = []  # LRU tracking
+        self.cache_dir = "/app/cache/funasr"
+        self.token_cache = None
         self.cache_hits = 0
         self.cache_misses = 0
         
         if self.enable_cache:
-            self.cache_dir.mkdir(parents=True, exist_ok=True)
-            self._load_cache_from_disk()
+            self.token_cache = TokenCache(
+                self.cache_dir,
+                max_disk_bytes=cache_max_bytes,
+                max_memory_bytes=cache_memory_bytes,
+                legacy_json_dir=self.cache_dir,
+            )
             logger.info(f"🚀 FunASR persistent cache enabled at {self.cache_dir}")
-            logger.info(f"   - Max size: {cache_max_size}")
-            logger.info(f"   - Loaded: {len(self._cache)} cached items from disk")
+            logger.info(f"   - Max size: {cache_max_bytes / 1024**2:.0f} MB on disk, {cache_memory_bytes / 1024**2:.0f} MB in memory")
 
     def __call__(self, audio, sr):
         _, vq02, vq06 = self.wav2token(audio, sr, False)
@@ -113,61 +148,112 @@ class StepAudioTokenizer:
         return audio
 
     def wav2token(self, audio, sample_rate, enable_trim=True, energy_norm=True):
-        audio = self.preprocess_wav(
+        audio, audio_hash, cached_result = self.lookup_tokens(
             audio, sample_rate, enable_trim=enable_trim, energy_norm=energy_norm
         )
-
-        # 🔥 启用缓存逻辑
-        if self.enable_cache:
-            # 音频已经通过 preprocess_wav 重采样为 16000 Hz
-            audio_hash = self._compute_audio_hash(audio, 16000)
-            
-            # 检查缓存
-            cached_result = self._cache_get(audio_hash)
-            if cached_result is not None:
-                speech_tokens, vq02_ori, vq06_ori = cached_result
-                print(f"✅ [FunASR Cache HIT] hash={audio_hash[:8]}... (saved ~1.65s)", flush=True)
-                self.cache_hits += 1
-                return speech_tokens, vq02_ori, vq06_ori
-            
-            print(f"❌ [FunASR Cache MISS] hash={audio_hash[:8]}... encoding audio...", flush=True)
-            self.cache_misses += 1
-            import time
-            start_time = time.time()
+        if cached_result is not None:
+            return cached_result
 
         # 实际编码
+        start_time = time.time()
         vq02_ori = self.get_vq02_code(audio)
-        vq02 = [int(x) + 65536 for x in vq02_ori]
         vq06_ori = self.get_vq06_code(audio)
-        vq06 = [int(x) + 65536 + 1024 for x in vq06_ori]
-
-        chunk = 1
-        chunk_nums = min(len(vq06) // (3 * chunk), len(vq02) // (2 * chunk))
-        speech_tokens = []
-        for idx in range(chunk_nums):
-            speech_tokens += vq02[idx * chunk * 2 : (idx + 1) * chunk * 2]
-            speech_tokens += vq06[idx * chunk * 3 : (idx + 1) * chunk * 3]
-        
+        return self.store_tokens(audio_hash, vq02_ori, vq06_ori, time.time() - start_time)
+
+    def lookup_tokens(self, audio, sample_rate, enable_trim=True, energy_norm=True):
+        """
+        Preprocess audio and look up its tokens in the cache
+
+        Returns:
+            tuple: (16 kHz audio, audio hash or None, cached (speech_tokens, vq02, vq06) or None)
+        """
+        audio = self.preprocess_wav(
+            audio, sample_rate, enable_trim=enable_trim, energy_norm=energy_norm
+        )
+        return (audio, *self.cache_lookup(audio))
+
+    def cache_lookup(self, audio):
+        """
+        Look up tokens of already preprocessed 16 kHz audio
+
+        Returns:
+            tuple: (audio hash or None, cached (speech_tokens, vq02, vq06) or None)
+        """
+        if not self.enable_cache:
+            return None, None
+
+        # 🔥 启用缓存逻辑
+        # 音频已经通过 preprocess_wav 重采样为 16000 Hz
+        audio_hash = self._compute_audio_hash(audio, 16000)
+
+        # 检查缓存
+        cached_result = self._cache_get(audio_hash)
+        if cached_result is not None:
+            print(f"✅ [FunASR Cache HIT] hash={audio_hash[:8]}... (saved ~1.65s)", flush=True)
+            self.cache_hits += 1
+            return audio_hash, cached_result
+
+        print(f"❌ [FunASR Cache MISS] hash={audio_hash[:8]}... encoding audio...", flush=True)
+        self.cache_misses += 1
+        return audio_hash, None
+
+    def context_audio(self, context):
+        """Preprocessed 16 kHz tokenizer input of an AudioContext, memoized on the context"""
+        return context.derive("tokenizer_audio", lambda: self.preprocess_wav(context.resampled(16000), 16000))
+
+    def context_log_mels(self, context):
+        """
+        Per-window 128-bin log-mels of the tokenizer input, memoized on the context
+
+        The same windows feed the vq06 tokenizer and, on auto-transcribed edits,
+        Whisper ASR (`WhisperWrapper.transcribe_log_mels`), so the STFT runs once.
+        """
+        return context.derive("vq06_log_mels", lambda: self.vq06_log_mels(self.context_audio(context)))
+
+    @staticmethod
+    def vq06_log_mels(audio):
+        """Whisper log-mel (128, frames) of each <= 30 s window of 16 kHz `audio`"""
+        # log-mel is clamped against the per-window maximum, compute it window by window
+        return [
+            whisper.log_mel_spectrogram(chunk, n_mels=128)
+            for chunk in split_audio(audio.squeeze(0), chunk_duration=VQ06_WINDOW)
+        ]
+
+    def store_tokens(self, audio_hash, vq02_ori, vq06_ori, encoding_time=None):
+        """
+        Interleave vq02 / vq06 codes and cache them under `audio_hash`
+
+        Returns:
+            tuple: (speech_tokens, vq02_ori, vq06_ori)
+        """
+        speech_tokens = vq0206_codec.interleave(vq02_ori, vq06_ori, offset=65536).tolist()
+
         # 缓存结果
-        if self.enable_cache:
-            encoding_time = time.time() - start_time
-            print(f"⏱️  [FunASR Encoding] time={encoding_time:.2f}s, caching result...", flush=True)
+        if self.enable_cache and audio_hash is not None:
+            if encoding_time is not None:
+                print(f"⏱️  [FunASR Encoding] time={encoding_time:.2f}s, caching result...", flush=True)
             self._cache_set(audio_hash, (speech_tokens, vq02_ori, vq06_ori))
-        
+
         return speech_tokens, vq02_ori, vq06_ori
 
+    @staticmethod
+    def _vq02_speech(audio):
+        # hand the 16 kHz samples to the encoder directly instead of a WAV round trip;
+        # same (N,) tensor the loader would decode, the frontend computes fbank once
+        speech = audio[0] if audio.shape[0] == 1 else audio.mean(0)
+        return speech.to("cpu", torch.float32)
+
     def get_vq02_code(self, audio, session_id=None, is_final=True):
-        _tmp_wav = io.BytesIO()
-        torchaudio.save(_tmp_wav, audio, 16000, format="wav")
-        _tmp_wav.seek(0)
+        speech = self._vq02_speech(audio)
 
         with self.vq02_lock:
             cache = {}
-            if session_id in self.vq02_sessions:
-                cache = self.vq02_sessions[session_id].get("cache", {})
+            state = self.vq02_sessions.get(session_id) if session_id else None
+            if state is not None:
+                cache = state["cache"]
 
             res, new_cache = self.funasr_model.infer_encoder(
-                input=[_tmp_wav],
+                input=[speech],
                 chunk_size=self.chunk_size,
                 encoder_chunk_look_back=self.encoder_chunk_look_back,
                 decoder_chunk_look_back=self.decoder_chunk_look_back,
@@ -179,98 +265,187 @@ class StepAudioTokenizer:
             for j, res_ in enumerate(res):
                 feat = res_["enc_out"]
                 if len(feat) > 0:
-                    c_list = self.dump_label([feat], self.kms)[0]
+                    c_list = self.dump_label([feat])[0].tolist()
 
             if is_final:
-                if session_id in self.vq02_sessions:
+                if session_id:
                     self.vq02_sessions.pop(session_id)
             else:
                 if isinstance(session_id, str) and len(session_id) > 0:
-                    self.vq02_sessions[session_id] = {
-                        "cache": new_cache,
-                        "update_time": time.time(),
-                    }
+                    self.vq02_sessions.put(session_id, {"cache": new_cache})
 
             return c_list
 
-    def get_vq06_code(self, audio):
-
-        def split_audio(audio, chunk_duration=480000):
-            start = 0
-            chunks = []
-            while start < len(audio):
-                end = min(start + chunk_duration, len(audio))
-                chunk = audio[start:end]
-                if len(chunk) < 480:
-                    pass
-                else:
-                    chunks.append(chunk)
-                start = end
-            return chunks
+    def get_vq02_code_batch(self, audios):
+        """
+        vq02 codes of several whole clips, the offline counterpart of `get_vq02_code`
+
+        All clips go through one `infer_encoder` call with `is_final=True` and no
+        session state, and their encoder outputs through one quantizer pass. The
+        streaming Paraformer still runs one utterance per forward pass, each from
+        a fresh encoder cache, so every clip gets the same codes as `get_vq02_code`.
 
+        Args:
+            audios: (1, N_i) 16 kHz waveforms
+
+        Returns:
+            list[list[int]]: Per-clip codes
+        """
+        with self.vq02_lock:
+            res, _ = self.funasr_model.infer_encoder(
+                input=[self._vq02_speech(audio) for audio in audios],
+                chunk_size=self.chunk_size,
+                encoder_chunk_look_back=self.encoder_chunk_look_back,
+                decoder_chunk_look_back=self.decoder_chunk_look_back,
+                device=0,
+                is_final=True,
+            )
+        feats = [res_["enc_out"] for res_ in res]
+        labels = iter(self.dump_label([feat for feat in feats if len(feat) > 0]))
+        return [next(labels).tolist() if len(feat) > 0 else [] for feat in feats]
+
+    def get_vq06_code(self, audio, log_mels=None):
+        """
+        vq06 codes of 16 kHz `audio`
+
+        Args:
+            audio: (1, N) preprocessed waveform
+            log_mels: Optional precomputed `vq06_log_mels(audio)`
+        """
         with self.vq06_lock:
             audio = audio.squeeze(0)
-            chunk_audios = split_audio(audio, chunk_duration=30 * 16000)  # Maximum support 30s
+            chunk_audios = split_audio(audio, chunk_duration=VQ06_WINDOW)  # Maximum support 30s
+            if log_mels is None:
+                log_mels = [None] * len(chunk_audios)
+            windows = list(zip(chunk_audios, log_mels))
+            # full 30 s windows share one shape and run batched; a shorter tail window
+            # runs on its own so no window is ever padded and tokens stay identical
+            full = [w for w in windows if w[0].shape[0] == VQ06_WINDOW]
+            batches = [full[i : i + self.vq06_batch_size] for i in range(0, len(full), self.vq06_batch_size)]
+            batches += [[w] for w in windows[len(full):]]
             speech_tokens = []
-            for chunk in chunk_audios:
-                duration = round(chunk.shape[0] / 16000, 2)
-                feat = whisper.log_mel_spectrogram(chunk, n_mels=128)
-                feat = feat.unsqueeze(0)
-                feat_len = np.array([feat.shape[2]], dtype=np.int32)
-                chunk_token = (
-                    self.ort_session.run(
-                        None,
-                        {
-                            self.ort_session.get_inputs()[0]
-                            .name: feat.detach()
-                            .cpu()
-                            .numpy(),
-                            self.ort_session.get_inputs()[1].name: feat_len,
-                        },
-                    )[0]
-                    .flatten()
-                    .tolist()
-                )
-                assert abs(len(chunk_token) - duration * 25) <= 2
-                speech_tokens += chunk_token
+            for batch in batches:
+                chunks, feats = zip(*batch)
+                for chunk_token in self._run_vq06_windows(chunks, feats):
+                    speech_tokens += chunk_token
 
             return speech_tokens
 
-    def kmean_cluster(self, samples, means):
-        dists = torch.cdist(samples, means)
-        indices = dists.argmin(dim=1).cpu().numpy()
-        return indices.tolist()
-
-    def dump_label(self, samples, mean):
-        dims = samples[0].shape[-1]
-        x_lens = [x.shape[1] for x in samples]
-        total_len = sum(x_lens)
-        x_sel = torch.FloatTensor(1, total_len, dims)
-        start_len = 0
-        for sample in samples:
-            sample_len = sample.shape[1]
-            end_len = start_len + sample_len
-            x_sel[:, start_len:end_len] = sample
-            start_len = end_len
-        dense_x = x_sel.squeeze(0)
-        indices = self.kmean_cluster(dense_x, mean)
-        indices_list = []
-        start_len = 0
-        for x_len in x_lens:
-            end_len = start_len + end_len
-            indices_list.append(indices[start_len:end_len])
-        return indices_list
+    def get_vq06_code_batch(self, audios):
+        """
+        vq06 codes of several clips, equal-length windows of all clips tokenized together
+
+        Windows are grouped by their exact length and never padded: the tokenizer
+        ONNX exposes no token lengths and cannot be shown to mask padded frames by
+        `feats_length`, and padding could change a window's codes, so every clip
+        gets the same codes as `get_vq06_code`. Full 30 s windows share one length
+        and fill the micro-batches; shorter tail windows only batch with tails of
+        the same length. Clips under 30 s therefore almost always run one per
+        ONNX call and get no speedup over `get_vq06_code`.
+
+        Args:
+            audios: (1, N_i) 16 kHz waveforms
+
+        Returns:
+            list[list[int]]: Per-clip codes
+        """
+        windows = []  # (clip index, window position, samples)
+        for clip_idx, audio in enumerate(audios):
+            for pos, chunk in enumerate(split_audio(audio.squeeze(0), chunk_duration=VQ06_WINDOW)):
+                windows.append((clip_idx, pos, chunk))
+        windows.sort(key=lambda item: item[2].shape[0])
+        batches = []
+        for _, group in groupby(windows, key=lambda item: item[2].shape[0]):
+            group = list(group)
+            batches += [group[i : i + self.vq06_batch_size] for i in range(0, len(group), self.vq06_batch_size)]
+
+        window_tokens = {}
+        with self.vq06_lock:
+            for batch in batches:
+                tokens = self._run_vq06_windows([chunk for _, _, chunk in batch])
+                for (clip_idx, pos, _), chunk_token in zip(batch, tokens):
+                    window_tokens[clip_idx, pos] = chunk_token
+
+        codes = [[] for _ in audios]
+        for clip_idx, pos in sorted(window_tokens):
+            codes[clip_idx] += window_tokens[clip_idx, pos]
+        return codes
+
+    def _run_vq06_windows(self, chunks, feats=None):
+        """Tokenize equal-length windows in one ONNX run"""
+        # log-mel is clamped against the per-window maximum, compute it window by window
+        feats = [
+            whisper.log_mel_spectrogram(chunk, n_mels=128) if feat is None else feat
+            for chunk, feat in zip(chunks, feats or [None] * len(chunks))
+        ]
+        feat = torch.stack(feats).detach().cpu().numpy()
+        feat_len = np.full(len(chunks), feat.shape[2], dtype=np.int32)
+        tokens = self.ort_session.run(
+            [self.vq06_output_name],
+            {self.vq06_feat_name: feat, self.vq06_feat_len_name: feat_len},
+        )[0].reshape(len(chunks), -1)
+
+        results = []
+        for chunk, chunk_token in zip(chunks, tokens.tolist()):
+            duration = round(chunk.shape[0] / 16000, 2)
+            assert abs(len(chunk_token) - duration * 25) <= 2
+            results.append(chunk_token)
+        return results
+
+    def wav2token_batch(self, audios, enable_trim=True, energy_norm=True, batch_size=16, window=256):
+        """
+        Tokenize many clips, yielding `(index, (speech_tokens, vq02, vq06))` as buckets finish
+
+        Clips are read `window` at a time; cache hits are yielded right away, misses
+        are sorted by length into buckets of `batch_size` whose vq06 windows are
+        tokenized together (only full 30 s windows actually batch, see
+        `get_vq06_code_batch`). The vq02 codes of a bucket come from one offline
+        `get_vq02_code_batch` call on a worker thread, overlapping the vq06 run of
+        the same bucket. Results are cached.
+
+        Args:
+            audios: Iterable of `(waveform, sample_rate)` pairs
+            enable_trim: Trim leading / trailing silence
+            energy_norm: Normalize energy
+            batch_size: Clips per bucket
+            window: Clips read ahead and sorted by length before bucketing
+
+        Yields:
+            tuple: (input index, (speech_tokens, vq02_ori, vq06_ori))
+        """
+        audios = iter(enumerate(audios))
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="vq02") as executor:
+            while True:
+                items = list(islice(audios, window))
+                if not items:
+                    return
+                pending = []
+                for index, (audio, sample_rate) in items:
+                    audio, audio_hash, cached_result = self.lookup_tokens(
+                        audio, sample_rate, enable_trim=enable_trim, energy_norm=energy_norm
+                    )
+                    if cached_result is not None:
+                        yield index, cached_result
+                    else:
+                        pending.append((index, audio, audio_hash))
+
+                pending.sort(key=lambda item: item[1].shape[-1])
+                for start in range(0, len(pending), batch_size):
+                    bucket = pending[start : start + batch_size]
+                    start_time = time.time()
+                    vq02_future = executor.submit(self.get_vq02_code_batch, [audio for _, audio, _ in bucket])
+                    vq06_codes = self.get_vq06_code_batch([audio for _, audio, _ in bucket])
+                    vq02_codes = vq02_future.result()
+                    encoding_time = (time.time() - start_time) / len(bucket)
+                    for (index, _, audio_hash), vq02_ori, vq06_ori in zip(bucket, vq02_codes, vq06_codes):
+                        yield index, self.store_tokens(audio_hash, vq02_ori, vq06_ori, encoding_time)
+
+    def dump_label(self, samples):
+        """Nearest linguistic centroid per frame for each (1, T_i, D) encoder output"""
+        return self.vq02_quantizer.quantize_batch(samples)
 
     def merge_vq0206_to_token_str(self, vq02, vq06):
-        _vq06 = [1024 + x for x in vq06]
-        result = []
-        i = 0
-        j = 0
-        while i < len(vq02) - 1 and j < len(_vq06) - 2:
-            sublist = vq02[i : i + 2] + _vq06[j : j + 3]
-            result.extend(sublist)
-            i += 2
-            j += 3
+        result = vq0206_codec.interleave(vq02, vq06).tolist()
         return "".join([f"<audio_{x}>" for x in result])
     
     def _compute_audio_hash(self, audio, sr):
@@ -279,77 +454,19 @@ class StepAudioTokenizer:
         hash_str = hashlib.md5(audio_bytes + str(sr).encode()).hexdigest()
         return hash_str
     
-    def _get_cache_file_path(self, audio_hash):
-        """获取缓存文件路径（两级目录结构）"""
-        subdir = self.cache_dir / audio_hash[:2]
-        subdir.mkdir(parents=True, exist_ok=True)
-        return subdir / f"{audio_hash}.json"
-    
-    def _load_cache_from_disk(self):
-        """从磁盘加载缓存"""
-        if not self.cache_dir.exists():
-            return
-        
-        count = 0
-        for cache_file in self.cache_dir.glob("*/*.json"):
-            try:
-                with open(cache_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                audio_hash = data['hash']
-                tokens = tuple(data['tokens']) if isinstance(data['tokens'], list) else data['tokens']
-                self._cache[audio_hash] = tokens
-                self._cache_order.append(audio_hash)
-                count += 1
-                if count >= self.cache_max_size:
-                    break
-            except Exception as e:
-                logger.debug(f"Failed to load cache file {cache_file}: {e}")
-        
-        logger.info(f"✅ Loaded {count} cached items from disk")
-    
     def _cache_get(self, audio_hash):
         """从缓存获取"""
-        if audio_hash in self._cache:
-            # LRU: 移到末尾
-            self._cache_order.remove(audio_hash)
-            self._cache_order.append(audio_hash)
-            return self._cache[audio_hash]
-        return None
+        return self.token_cache.get(audio_hash)
     
     def _cache_set(self, audio_hash, result):
-        """存入缓存"""
-        # LRU eviction
-        if len(self._cache) >= self.cache_max_size:
-            oldest = self._cache_order.pop(0)
-            del self._cache[oldest]
-            # 删除磁盘文件
-            try:
-                oldest_file = self._get_cache_file_path(oldest)
-                if oldest_file.exists():
-                    oldest_file.unlink()
-            except Exception as e:
-                logger.debug(f"Failed to delete old cache file: {e}")
-        
-        self._cache[audio_hash] = result
-        self._cache_order.append(audio_hash)
-        
-        # 持久化到磁盘
-        try:
-            cache_file = self._get_cache_file_path(audio_hash)
-            data = {
-                "hash": audio_hash,
-                "tokens": result,
-                "cached_at": time.time()
-            }
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
-        except Exception as e:
-            logger.warning(f"Failed to save cache to disk: {e}")
+        """存入缓存（磁盘写入在后台线程完成）"""
+        self.token_cache.put(audio_hash, result)
     
     def get_cache_stats(self):
         """获取缓存统计信息"""
         total = self.cache_hits + self.cache_misses
         hit_rate = self.cache_hits / total if total > 0 else 0
+        store = self.token_cache.get_stats() if self.token_cache is not None else {}
         
         return {
             "enabled": self.enable_cache,
@@ -357,24 +474,21 @@ class StepAudioTokenizer:
             "misses": self.cache_misses,
             "total_requests": total,
             "hit_rate": f"{hit_rate:.1%}",
-            "cache_size": len(self._cache),
-            "max_size": self.cache_max_size,
+            "cache_size": store.get("entries", 0),
+            "cache_bytes": store.get("disk_bytes", 0),
+            "max_bytes": store.get("max_disk_bytes", 0),
+            "memory_entries": store.get("memory_entries", 0),
             "time_saved_estimate": f"{self.cache_hits * 1.65:.1f}s"
         }
     
+    def get_session_stats(self):
+        """Count and tensor bytes of unfinished streaming vq02 sessions"""
+        return self.vq02_sessions.get_stats()
+
     def clear_cache(self):
         """清空缓存（内存 + 磁盘）"""
-        self._cache.clear()
-        self._cache_order.clear()
         self.cache_hits = 0
         self.cache_misses = 0
-        
-        # 删除磁盘缓存
-        try:
-            if self.cache_dir.exists():
-                import shutil
-                shutil.rmtree(self.cache_dir)
-                self.cache_dir.mkdir(parents=True, exist_ok=True)
-                logger.info("🗑️ FunASR cache cleared (memory + disk)")
-        except Exception as e:
-            logger.warning(f"Failed to clear disk cache: {e}")
+        if self.token_cache is not None:
+            self.token_cache.clear()
+            logger.info("🗑️ FunASR cache cleared (memory + disk)")
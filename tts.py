@@ -2,20 +2,35 @@ import hashlib
 import io
 import os
 import re
+import queue
+import uuid
 import logging
+import threading
 import numpy as np
 import torch
 import librosa
 import soundfile as sf
-from typing import Tuple, Optional
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Iterator, List, Tuple, Optional, Union
 from http import HTTPStatus
 
-import torchaudio
+from dataclasses import replace
 
 from model_loader import model_loader, ModelSource
 from config.prompts import AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL, AUDIO_EDIT_SYSTEM_PROMPT
 from stepvocoder.cosyvoice2.cli.cosyvoice import CosyVoice
+from generation_scheduler import GenerationScheduler
+from prefix_cache import PrefixKVCache, system_prefix_len
+from prompt_analysis import PromptAnalyzer
+from audio_context import AudioContext
+from prompt_encoder import AudioPromptEncoder
+from voice_registry import AudioArtifactCache, VoiceArtifacts
+from audio_grammar import AudioGrammar, AudioGrammarLogitsProcessor
+from speculative import ModelDrafter, PromptLookupDrafter, SpeculativeStats, speculative_generate
 from transformers.generation.logits_process import LogitsProcessor
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 from transformers.generation.utils import LogitsProcessorList
 
 # Configure logging
@@ -50,6 +65,34 @@ class RepetitionAwareLogitsProcessor(LogitsProcessor):
         scores[mask, last_tokens[mask].squeeze(-1)] = float("-inf")
         return scores
 
+class _TokenCallbackStreamer(BaseStreamer):
+    """Forward tokens produced by `generate` to a callback, skipping the prompt"""
+    def __init__(self, on_token):
+        self.on_token = on_token
+        self.prompt_seen = False
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for token in value.flatten().tolist():
+            self.on_token(token)
+
+    def end(self):
+        pass
+
+
+class _EventStoppingCriteria(StoppingCriteria):
+    """Stop generation once an event is set (e.g. the streaming client went away)"""
+    def __init__(self, stop_event: threading.Event):
+        self.stop_event = stop_event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],), self.stop_event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
 class StepAudioTTS:
     """
     Step Audio TTS wrapper for voice cloning and audio editing tasks
@@ -63,7 +106,16 @@ class StepAudioTTS:
         tts_model_id=None,
         quantization_config=None,
         torch_dtype=torch.bfloat16,
-        device_map="cuda"
+        device_map="cuda",
+        max_batch_size=None,
+        prefix_cache_bytes=None,
+        prefix_cache=None,
+        constrained_decoding=False,
+        audio_cache_bytes=256 * 1024 ** 2,
+        cfg_interval=None,
+        max_stream_sessions=4,
+        stream_session_timeout=30.0,
+        vocoder_batch_size=4
     ):
         """
         Initialize StepAudioTTS
@@ -76,6 +128,26 @@ class StepAudioTTS:
             quantization_config: Quantization configuration ('int4', 'int8', or None)
             torch_dtype: PyTorch data type for model weights (default: torch.bfloat16)
             device_map: Device mapping for model (default: "cuda")
+            max_batch_size: If set, generate through a continuous-batching scheduler
+                with this many concurrent sequences (default: None, plain `generate`)
+            prefix_cache_bytes: If set, reuse prefilled system-turn KV states up to this
+                many bytes (default: None, no prefix caching)
+            prefix_cache: Existing `PrefixKVCache` to use instead, e.g. one cache and
+                byte budget shared by all model variants of a server (default: None)
+            constrained_decoding: Restrict generation to the 2 vq02 + 3 vq06 audio token
+                grammar; with the scheduler the lm_head is only evaluated on the valid
+                codebook rows (default: False)
+            audio_cache_bytes: Memory budget of prompt audio artifacts cached by upload
+                content key, see `compute_voice_artifacts` (default: 256 MB, 0 disables)
+            cfg_interval: (t_min, t_max) range of flow-matching steps that use
+                classifier-free guidance; steps outside it run at half the DiT
+                batch (default: None, guide every step)
+            max_stream_sessions: Streaming requests that may hold vocoder cache
+                buffers at once, further requests wait for a free slot (default: 4)
+            stream_session_timeout: Seconds a streaming request waits for a free slot
+                before `SessionLimitError` is raised (default: 30)
+            vocoder_batch_size: Non-stream requests waiting for the vocoder that are
+                decoded together in one `token2wav_batch` call (default: 4, 1 disables)
         """
         # Determine model ID or path to load
         if tts_model_id is None:
@@ -102,23 +174,78 @@ class StepAudioTTS:
             logger.error(f"❌ Failed to load model: {e}")
             raise
 
+        self.prefix_cache = prefix_cache
+        if prefix_cache is None and prefix_cache_bytes:
+            self.prefix_cache = PrefixKVCache(max_bytes=prefix_cache_bytes)
+        if self.prefix_cache is not None:
+            logger.info(f"🚀 Prefix KV cache enabled (max {self.prefix_cache.max_bytes / 1024**2:.0f} MB)")
+
+        self.grammar = None
+        if constrained_decoding:
+            eos_token_id = self.llm.generation_config.eos_token_id
+            self.eos_token_ids = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+            self.grammar = AudioGrammar(self.llm, self.eos_token_ids)
+            logger.info("🚀 Audio-grammar-constrained decoding enabled")
+
+        self.scheduler = None
+        if max_batch_size:
+            self.scheduler = GenerationScheduler(
+                self.llm,
+                max_batch_size=max_batch_size,
+                prefix_cache=self.prefix_cache,
+                grammar=self.grammar,
+            )
+            logger.info(f"🚀 Continuous batching enabled (max_batch_size={max_batch_size})")
+
+        # serializes `generate` / `speculative_generate` calls that bypass the scheduler
+        self.generate_lock = threading.Lock()
+        self.speculative_stats = SpeculativeStats()
+        self.audio_cache = AudioArtifactCache(audio_cache_bytes) if audio_cache_bytes else None
+
         # Load CosyVoice model (usually local path)
         self.cosy_model = CosyVoice(
-            os.path.join(model_path, "CosyVoice-300M-25Hz")
+            os.path.join(model_path, "CosyVoice-300M-25Hz"),
+            cfg_interval=cfg_interval,
+            max_stream_sessions=max_stream_sessions,
         )
 
         # Print final GPU memory usage after all models are loaded
         logger.info("🎤 CosyVoice model loaded successfully")
+        # stream caches are per session, but CUDA graphs share static buffers, serialize vocoder calls
+        self.vocoder_lock = threading.Lock()
+        self.stream_session_timeout = stream_session_timeout
+        # non-stream vocoder requests queued behind vocoder_lock, see `_token2wav`
+        self.vocoder_batch_size = max(1, vocoder_batch_size)
+        self._vocode_pending = []
+        self._vocode_pending_lock = threading.Lock()
+        self.prompt_analyzer = PromptAnalyzer(self.audio_tokenizer, self.cosy_model.frontend)
 
         # Use system prompts from config module
         self.edit_clone_sys_prompt_tpl = AUDIO_EDIT_CLONE_SYSTEM_PROMPT_TPL
         self.edit_sys_prompt = AUDIO_EDIT_SYSTEM_PROMPT
 
+        # Map audio codes straight to token ids instead of tokenizing `<audio_N>` strings;
+        # static prompt pieces are tokenized once here
+        self.prompt_encoder = AudioPromptEncoder(
+            self.tokenizer, self.edit_clone_sys_prompt_tpl, self.edit_sys_prompt
+        )
+        self.prompt_encoder.verify(
+            self._encode_audio_edit_clone_prompt,
+            lambda instruct_prefix, audio_token_str: self._encode_audio_edit_prompt(
+                self.edit_sys_prompt, instruct_prefix, audio_token_str
+            ),
+        )
+        logger.info(f"Direct prompt encoding: {'enabled' if self.prompt_encoder.enabled else 'disabled'}")
+
     def clone(
         self,
         prompt_wav_path: str,
         prompt_text: str,
-        target_text: str
+        target_text: str,
+        draft_model: Optional["StepAudioTTS"] = None,
+        content_key: Optional[str] = None,
+        flow_solver: str = "euler",
+        flow_steps: Optional[int] = None
     ) -> Tuple[torch.Tensor, int]:
         """
         Clone voice from reference audio
@@ -127,112 +254,593 @@ class StepAudioTTS:
             prompt_wav_path: Path to reference audio file
             prompt_text: Text content of reference audio
             target_text: Text to synthesize with cloned voice
+            draft_model: Optional cheaper variant (e.g. 4-bit) drafting tokens that
+                this model verifies with speculative rejection sampling
+            content_key: Digest of the uploaded file bytes, see `compute_voice_artifacts`
+            flow_solver: ODE solver of the flow decoder (euler, midpoint, heun, multistep, adaptive)
+            flow_steps: Solver steps, None for the vocoder default (10)
 
         Returns:
             Tuple[torch.Tensor, int]: Generated audio tensor and sample rate
         """
         try:
             logger.debug(f"Starting voice cloning: {prompt_wav_path}")
-            prompt_wav, _ = torchaudio.load(prompt_wav_path)
-            vq0206_codes, vq02_codes_ori, vq06_codes_ori, speech_feat, _, speech_embedding = (
-                self.preprocess_prompt_wav(prompt_wav_path)
-            )
-            prompt_speaker = self.generate_clone_voice_id(prompt_text, prompt_wav)
-            prompt_wav_tokens = self.audio_tokenizer.merge_vq0206_to_token_str(
-                vq02_codes_ori, vq06_codes_ori
-            )
-            token_ids = self._encode_audio_edit_clone_prompt(
-                target_text,
-                prompt_text,
-                prompt_speaker,
-                prompt_wav_tokens,
-            )
+            voice = self.compute_voice_artifacts(prompt_wav_path, prompt_text, content_key)
+            return self._clone(voice, target_text, draft_model, flow_solver, flow_steps)
+        except Exception as e:
+            logger.error(f"Clone failed: {e}")
+            raise
 
-            output_ids = self.llm.generate(
-                torch.tensor([token_ids]).to(torch.long).to("cuda"),
-                max_length=8192,
-                temperature=0.7,
-                do_sample=True,
-                logits_processor=LogitsProcessorList([RepetitionAwareLogitsProcessor()]),
-            )
-            output_ids = output_ids[:, len(token_ids) : -1]  # skip eos token
-            logger.debug("Voice cloning generation completed")
-            vq0206_codes_vocoder = torch.tensor([vq0206_codes], dtype=torch.long) - 65536
-            return (
-                self.cosy_model.token2wav_nonstream(
-                    output_ids - 65536,
-                    vq0206_codes_vocoder,
-                    speech_feat.to(torch.bfloat16),
-                    speech_embedding.to(torch.bfloat16),
-                ),
-                24000,
-            )
+    def clone_with_voice(
+        self,
+        voice: VoiceArtifacts,
+        target_text: str,
+        draft_model: Optional["StepAudioTTS"] = None,
+        flow_solver: str = "euler",
+        flow_steps: Optional[int] = None
+    ) -> Tuple[torch.Tensor, int]:
+        """
+        Clone a voice whose prompt artifacts were precomputed (e.g. from the voice registry)
+
+        Args:
+            voice: Precomputed prompt artifacts, see `compute_voice_artifacts`
+            target_text: Text to synthesize with cloned voice
+            draft_model: Optional cheaper variant drafting tokens, see `clone`
+            flow_solver: ODE solver of the flow decoder, see `clone`
+            flow_steps: Solver steps, see `clone`
+
+        Returns:
+            Tuple[torch.Tensor, int]: Generated audio tensor and sample rate
+        """
+        try:
+            logger.debug(f"Starting voice cloning: {voice.prompt_speaker}")
+            return self._clone(voice, target_text, draft_model, flow_solver, flow_steps)
         except Exception as e:
             logger.error(f"Clone failed: {e}")
             raise
 
+    def _clone(
+        self, voice: VoiceArtifacts, target_text: str, draft_model, flow_solver: str = "euler", flow_steps: Optional[int] = None
+    ) -> Tuple[torch.Tensor, int]:
+        token_ids, vq0206_codes, speech_feat, speech_embedding = self._prepare_clone(voice, target_text)
+        drafter = self._model_drafter(draft_model, token_ids) if draft_model is not None else None
+        output_ids = self._generate(token_ids, drafter=drafter)
+        output_ids = output_ids[:, len(token_ids) : -1]  # skip eos token
+        logger.debug("Voice cloning generation completed")
+        return self._token2wav(output_ids, vq0206_codes, speech_feat, speech_embedding, flow_solver, flow_steps), 24000
+
+    def clone_stream(
+        self,
+        prompt_wav_path: str,
+        prompt_text: str,
+        target_text: str,
+        draft_model: Optional["StepAudioTTS"] = None,
+        content_key: Optional[str] = None
+    ) -> Iterator[torch.Tensor]:
+        """
+        Clone voice from reference audio, yielding 24 kHz audio chunks as tokens are decoded
+
+        Prompt preprocessing and the vocoder session reservation run when this is
+        called, so their errors (including `SessionLimitError` once no streaming
+        slot frees up within `stream_session_timeout`) are raised here rather
+        than from the first chunk of the returned iterator.
+
+        Args:
+            prompt_wav_path: Path to reference audio file
+            prompt_text: Text content of reference audio
+            target_text: Text to synthesize with cloned voice
+            draft_model: Optional cheaper variant (e.g. 4-bit) drafting tokens that
+                this model verifies with speculative rejection sampling
+            content_key: Digest of the uploaded file bytes, see `compute_voice_artifacts`
+
+        Returns:
+            Iterator[torch.Tensor]: (1, T) float32 audio chunks
+        """
+        logger.debug(f"Starting streaming voice cloning: {prompt_wav_path}")
+        voice = self.compute_voice_artifacts(prompt_wav_path, prompt_text, content_key)
+        return self.clone_with_voice_stream(voice, target_text, draft_model)
+
+    def clone_with_voice_stream(
+        self,
+        voice: VoiceArtifacts,
+        target_text: str,
+        draft_model: Optional["StepAudioTTS"] = None
+    ) -> Iterator[torch.Tensor]:
+        """
+        Streaming variant of `clone_with_voice`
+
+        The prompt is encoded and the vocoder session reserved when this is
+        called, see `clone_stream`.
+
+        Args:
+            voice: Precomputed prompt artifacts, see `compute_voice_artifacts`
+            target_text: Text to synthesize with cloned voice
+            draft_model: Optional cheaper variant drafting tokens, see `clone`
+
+        Returns:
+            Iterator[torch.Tensor]: (1, T) float32 audio chunks
+        """
+        token_ids, vq0206_codes, speech_feat, speech_embedding = self._prepare_clone(voice, target_text)
+        drafter = self._model_drafter(draft_model, token_ids) if draft_model is not None else None
+        session_id = self._open_stream_session()
+        return self._stream(session_id, token_ids, vq0206_codes, speech_feat, speech_embedding, drafter)
+
+    def compute_voice_artifacts(
+        self, prompt_wav_path: str, prompt_text: str, content_key: Optional[str] = None
+    ) -> VoiceArtifacts:
+        """
+        Run prompt preprocessing once for a reference clip
+
+        Args:
+            prompt_wav_path: Path to reference audio file
+            prompt_text: Text content of reference audio
+            content_key: Digest of the raw file bytes (e.g. `api.utils.content_key`);
+                when given, a clip uploaded before is served from memory without
+                decoding or resampling it
+
+        Returns:
+            VoiceArtifacts: Codes, mel features, speaker embedding and speaker id
+        """
+        audio, speaker_sample = self._load_prompt_audio(prompt_wav_path, content_key)
+        return replace(
+            audio,
+            prompt_text=prompt_text,
+            prompt_speaker=self._clone_voice_id(prompt_text, speaker_sample),
+        )
+
+    def _load_prompt_audio(
+        self, wav_path: Union[str, AudioContext], content_key: Optional[str] = None
+    ) -> Tuple[VoiceArtifacts, bytes]:
+        """Text-independent prompt artifacts and speaker-id sample of a clip (path or AudioContext)"""
+        if content_key is not None and self.audio_cache is not None:
+            cached = self.audio_cache.get(content_key)
+            if cached is not None:
+                logger.debug(f"Prompt audio cache hit: {content_key}")
+                return cached
+
+        audio_context = AudioContext.wrap(wav_path)
+        vq0206_codes, vq02_codes_ori, vq06_codes_ori, speech_feat, _, speech_embedding = (
+            self.preprocess_prompt_wav(audio_context)
+        )
+        audio = VoiceArtifacts(
+            prompt_text="",
+            prompt_speaker="",
+            vq0206_codes=np.asarray(vq0206_codes, dtype=np.int64),
+            vq02_codes=np.asarray(vq02_codes_ori, dtype=np.int64),
+            vq06_codes=np.asarray(vq06_codes_ori, dtype=np.int64),
+            speech_feat=speech_feat,
+            speech_embedding=speech_embedding,
+        )
+        speaker_sample = self._speaker_audio_sample(audio_context.raw)
+        if content_key is not None and self.audio_cache is not None:
+            self.audio_cache.put(content_key, audio, speaker_sample)
+        return audio, speaker_sample
+
+    def _prepare_clone(self, voice: VoiceArtifacts, target_text: str):
+        """Encode the clone prompt from precomputed prompt artifacts"""
+        vq0206_codes = voice.vq0206_codes.tolist()
+        if self.prompt_encoder.enabled and vq0206_codes:
+            token_ids = self.prompt_encoder.encode_clone(
+                target_text, voice.prompt_text, voice.prompt_speaker, vq0206_codes
+            )
+            return token_ids, vq0206_codes, voice.speech_feat, voice.speech_embedding
+        prompt_wav_tokens = self.audio_tokenizer.merge_vq0206_to_token_str(
+            voice.vq02_codes.tolist(), voice.vq06_codes.tolist()
+        )
+        token_ids = self._encode_audio_edit_clone_prompt(
+            target_text,
+            voice.prompt_text,
+            voice.prompt_speaker,
+            prompt_wav_tokens,
+        )
+        return token_ids, vq0206_codes, voice.speech_feat, voice.speech_embedding
+
     def edit(
         self,
-        input_audio_path: str,
+        input_audio_path: Union[str, AudioContext],
         audio_text: str,
         edit_type: str,
         edit_info: Optional[str] = None,
-        text: Optional[str] = None
+        text: Optional[str] = None,
+        speculative: bool = False,
+        draft_model: Optional["StepAudioTTS"] = None,
+        content_key: Optional[str] = None,
+        flow_solver: str = "euler",
+        flow_steps: Optional[int] = None
     ) -> Tuple[torch.Tensor, int]:
         """
         Edit audio based on specified edit type
 
         Args:
-            input_audio_path: Path to input audio file
+            input_audio_path: Path to input audio file, or an AudioContext shared with ASR
             audio_text: Text content of input audio
             edit_type: Type of edit (emotion, style, speed, etc.)
             edit_info: Specific edit information (happy, sad, etc.)
             text: Target text for para-linguistic editing
+            speculative: Draft tokens by n-gram lookup in the input audio tokens
+                and verify them in one forward pass (prompt-lookup decoding)
+            draft_model: Optional cheaper variant (e.g. 4-bit) drafting tokens that
+                this model verifies; ignored when `speculative` is set
+            content_key: Digest of the uploaded file bytes, see `compute_voice_artifacts`
+            flow_solver: ODE solver of the flow decoder, see `clone`
+            flow_steps: Solver steps, see `clone`
 
         Returns:
             Tuple[torch.Tensor, int]: Edited audio tensor and sample rate
         """
         try:
-            logger.debug(f"Starting audio editing: {edit_type} - {edit_info}")            
-            vq0206_codes, vq02_codes_ori, vq06_codes_ori, speech_feat, _, speech_embedding = (
-                self.preprocess_prompt_wav(input_audio_path)
+            logger.debug(f"Starting audio editing: {edit_type} - {edit_info}")
+            prompt_tokens, vq0206_codes, speech_feat, speech_embedding = self._prepare_edit(
+                input_audio_path, audio_text, edit_type, edit_info, text, content_key
             )
+            drafter = self._edit_drafter(prompt_tokens, speculative, draft_model)
+            output_ids = self._generate(prompt_tokens, drafter=drafter)
+            output_ids = output_ids[:, len(prompt_tokens) : -1]  # skip eos token
+            logger.debug("Audio editing generation completed")
+            return self._token2wav(output_ids, vq0206_codes, speech_feat, speech_embedding, flow_solver, flow_steps), 24000
+        except Exception as e:
+            logger.error(f"Edit failed: {e}")
+            raise
+
+    def edit_stream(
+        self,
+        input_audio_path: Union[str, AudioContext],
+        audio_text: str,
+        edit_type: str,
+        edit_info: Optional[str] = None,
+        text: Optional[str] = None,
+        speculative: bool = False,
+        draft_model: Optional["StepAudioTTS"] = None,
+        content_key: Optional[str] = None
+    ) -> Iterator[torch.Tensor]:
+        """
+        Edit audio, yielding 24 kHz audio chunks as tokens are decoded
+
+        The input audio is preprocessed, the prompt encoded and the vocoder
+        session reserved when this is called, see `clone_stream`.
+
+        Args:
+            input_audio_path: Path to input audio file, or an AudioContext shared with ASR
+            audio_text: Text content of input audio
+            edit_type: Type of edit (emotion, style, speed, etc.)
+            edit_info: Specific edit information (happy, sad, etc.)
+            text: Target text for para-linguistic editing
+            speculative: Draft tokens by n-gram lookup in the input audio tokens
+                and verify them in one forward pass (prompt-lookup decoding)
+            draft_model: Optional cheaper variant (e.g. 4-bit) drafting tokens that
+                this model verifies; ignored when `speculative` is set
+            content_key: Digest of the uploaded file bytes, see `compute_voice_artifacts`
+
+        Returns:
+            Iterator[torch.Tensor]: (1, T) float32 audio chunks
+        """
+        logger.debug(f"Starting streaming audio editing: {edit_type} - {edit_info}")
+        prompt_tokens, vq0206_codes, speech_feat, speech_embedding = self._prepare_edit(
+            input_audio_path, audio_text, edit_type, edit_info, text, content_key
+        )
+        drafter = self._edit_drafter(prompt_tokens, speculative, draft_model)
+        session_id = self._open_stream_session()
+        return self._stream(session_id, prompt_tokens, vq0206_codes, speech_feat, speech_embedding, drafter)
+
+    def _edit_drafter(self, prompt_tokens: list[int], speculative: bool, draft_model):
+        """Select the speculative drafter for an edit request"""
+        if speculative:
+            # copy n-grams from the audio tokens of the edit prompt
+            return PromptLookupDrafter([t for t in prompt_tokens if t >= 65536], device=self.llm.device)
+        if draft_model is not None:
+            return self._model_drafter(draft_model, prompt_tokens)
+        return None
+
+    def _model_drafter(self, draft_model: "StepAudioTTS", token_ids: list[int]) -> ModelDrafter:
+        """Drafter sampling from another loaded variant of this model"""
+        past_key_values = None
+        prefix_len = system_prefix_len(token_ids) if draft_model.prefix_cache is not None else 0
+        if prefix_len:
+            prefix_ids = torch.tensor([token_ids[:prefix_len]], dtype=torch.long, device=draft_model.llm.device)
+            past_key_values = draft_model.prefix_cache.get_or_build(draft_model.llm, prefix_ids)
+        return ModelDrafter(
+            draft_model.llm,
+            temperature=0.7,
+            do_sample=True,
+            logits_processor_factory=self._logits_processor_factory(len(token_ids)),
+            past_key_values=past_key_values,
+        )
+
+    def _logits_processor_factory(self, prompt_len: int):
+        """Build the custom logits processors used for a prompt of `prompt_len` tokens"""
+        def factory():
+            processors = [RepetitionAwareLogitsProcessor()]
+            if self.grammar is not None:
+                # outside the scheduler the full lm_head runs, only mask invalid tokens
+                processors.insert(0, AudioGrammarLogitsProcessor(prompt_len, self.eos_token_ids))
+            return processors
+        return factory
+
+    def get_speculative_stats(self):
+        """Acceptance statistics of speculative decoding"""
+        return self.speculative_stats.get_stats()
+
+    def get_prompt_analysis_stats(self):
+        """Mean wall time per prompt preprocessing branch"""
+        return self.prompt_analyzer.get_stats()
+
+    def get_session_stats(self):
+        """Open streaming sessions and their tensor bytes in the vocoder and the vq02 encoder"""
+        return {
+            "vocoder": self.cosy_model.get_session_stats(),
+            "vq02": self.audio_tokenizer.get_session_stats(),
+        }
+
+    def _prepare_edit(
+        self,
+        input_audio_path: Union[str, AudioContext],
+        audio_text: str,
+        edit_type: str,
+        edit_info: Optional[str] = None,
+        text: Optional[str] = None,
+        content_key: Optional[str] = None
+    ):
+        """Preprocess the input audio and encode the edit prompt"""
+        audio, _ = self._load_prompt_audio(input_audio_path, content_key)
+        vq0206_codes = audio.vq0206_codes.tolist()
+        speech_feat, speech_embedding = audio.speech_feat, audio.speech_embedding
+        # Build instruction prefix based on edit type
+        instruct_prefix = self._build_audio_edit_instruction(audio_text, edit_type, edit_info, text)
+
+        # Encode the complete prompt to token sequence
+        if self.prompt_encoder.enabled and vq0206_codes:
+            prompt_tokens = self.prompt_encoder.encode_edit(instruct_prefix, vq0206_codes)
+        else:
             audio_tokens = self.audio_tokenizer.merge_vq0206_to_token_str(
-                vq02_codes_ori, vq06_codes_ori
+                audio.vq02_codes.tolist(), audio.vq06_codes.tolist()
             )
-            # Build instruction prefix based on edit type
-            instruct_prefix = self._build_audio_edit_instruction(audio_text, edit_type, edit_info, text)
-
-            # Encode the complete prompt to token sequence
             prompt_tokens = self._encode_audio_edit_prompt(
                 self.edit_sys_prompt, instruct_prefix, audio_tokens
             )
 
-            logger.debug(f"Edit instruction: {instruct_prefix}")
-            logger.debug(f"Encoded prompt length: {len(prompt_tokens)}")
+        logger.debug(f"Edit instruction: {instruct_prefix}")
+        logger.debug(f"Encoded prompt length: {len(prompt_tokens)}")
+        return prompt_tokens, vq0206_codes, speech_feat, speech_embedding
+
+    def _token2wav(
+        self, output_ids, vq0206_codes, speech_feat, speech_embedding,
+        flow_solver: str = "euler", flow_steps: Optional[int] = None
+    ) -> torch.Tensor:
+        """
+        Vocode generated audio token ids in one pass
+
+        Requests that queue up while the vocoder is busy are collected: whichever
+        thread gets `vocoder_lock` next decodes up to `vocoder_batch_size` pending
+        requests in one `token2wav_batch` call, the others find their result ready.
+        """
+        future = Future()
+        request = (
+            output_ids - 65536,
+            torch.tensor([vq0206_codes], dtype=torch.long) - 65536,
+            speech_feat.to(torch.bfloat16),
+            speech_embedding.to(torch.bfloat16),
+            flow_solver,
+            flow_steps,
+        )
+        with self._vocode_pending_lock:
+            self._vocode_pending.append((request, future))
+        with self.vocoder_lock:
+            while not future.done():
+                with self._vocode_pending_lock:
+                    batch = self._vocode_pending[: self.vocoder_batch_size]
+                    del self._vocode_pending[: self.vocoder_batch_size]
+                self._vocode_batch(batch)
+        return future.result()
+
+    def _vocode_batch(self, batch):
+        """Decode collected `_token2wav` requests, one call per solver setting; caller holds vocoder_lock"""
+        groups = defaultdict(list)
+        for request, future in batch:
+            groups[request[4:]].append((request, future))
+        for (flow_solver, flow_steps), group in groups.items():
+            if len(group) > 1:
+                tokens, prompt_tokens, prompt_feats, embeddings = zip(*(request[:4] for request, _ in group))
+                try:
+                    speeches = self.cosy_model.token2wav_batch(
+                        list(tokens), list(prompt_tokens), list(prompt_feats), list(embeddings),
+                        n_timesteps=flow_steps, solver=flow_solver,
+                    )
+                except Exception as exc:
+                    # e.g. out of memory for the padded batch, a bad request only fails itself below
+                    logger.warning(f"Batched vocoding of {len(group)} requests failed, decoding one by one: {exc}")
+                else:
+                    logger.debug(f"Vocoded {len(group)} requests in one batch")
+                    for (_, future), speech in zip(group, speeches):
+                        future.set_result(speech)
+                    continue
+            for request, future in group:
+                try:
+                    future.set_result(self.cosy_model.token2wav_nonstream(
+                        *request[:4], n_timesteps=flow_steps, solver=flow_solver
+                    ))
+                except Exception as exc:
+                    future.set_exception(exc)
+
+    def _open_stream_session(self) -> str:
+        """
+        Reserve vocoder cache buffers for a new streaming session
+
+        Waits at most `stream_session_timeout` seconds for an active session to
+        finish, outside the vocoder lock since sessions release theirs in `clean_up`.
+
+        Returns:
+            str: Session id to hand to `_stream`
+        """
+        session_id = uuid.uuid4().hex
+        self.cosy_model.open_session(session_id, timeout=self.stream_session_timeout)
+        return session_id
 
-            output_ids = self.llm.generate(
-                torch.tensor([prompt_tokens]).to(torch.long).to("cuda"),
+    def _stream(
+        self, session_id: str, token_ids: list[int], vq0206_codes, speech_feat, speech_embedding, drafter=None
+    ) -> Iterator[torch.Tensor]:
+        """
+        Feed tokens into `token2wav_stream` while they are being generated
+
+        Args:
+            session_id: Vocoder session from `_open_stream_session`, cleaned up once
+                the iterator finishes or is closed
+            token_ids: Encoded prompt token sequence
+            vq0206_codes: Prompt audio tokens (absolute ids)
+            speech_feat: Prompt mel features
+            speech_embedding: Prompt speaker embedding
+            drafter: Optional speculative drafter, see `_generate`
+
+        Returns:
+            Iterator[torch.Tensor]: (1, T) float32 audio chunks at 24 kHz
+        """
+        stop_event = threading.Event()
+        prompt_token = torch.tensor([vq0206_codes], dtype=torch.long) - 65536
+        prompt_feat = speech_feat.to(torch.bfloat16)
+        embedding = speech_embedding.to(torch.bfloat16)
+
+        def vocode(tokens: List[int], last_chunk: bool):
+            with self.vocoder_lock:
+                return self.cosy_model.token2wav_stream(
+                    tokens, prompt_token, prompt_feat, embedding, session_id, last_chunk
+                )
+
+        try:
+            for tokens in self._generate_stream(token_ids, stop_event, drafter):
+                # only audio tokens go to the vocoder, this drops the trailing eos
+                speech = vocode([t - 65536 for t in tokens if t >= 65536], False)
+                # one call synthesizes at most one chunk, drain what is ready
+                while speech is not None:
+                    yield speech
+                    speech = vocode([], False)
+            speech = vocode([], True)
+            if speech is None:
+                # the cache was only set up by this call (very short output)
+                speech = vocode([], True)
+            if speech is not None:
+                yield speech
+            logger.debug(f"Streaming session {session_id} completed")
+        finally:
+            stop_event.set()
+            with self.vocoder_lock:
+                self.cosy_model.clean_up(session_id)
+
+    def _generate_stream(
+        self, token_ids: list[int], stop_event: threading.Event, drafter=None
+    ) -> Iterator[List[int]]:
+        """
+        Run generation in a background thread, yielding new token ids as they arrive
+
+        Args:
+            token_ids: Encoded prompt token sequence
+            stop_event: Set by the consumer to stop generation early
+            drafter: Optional speculative drafter, see `_generate`
+
+        Returns:
+            Iterator[List[int]]: Batches of newly generated token ids
+        """
+        tokens = queue.Queue()
+
+        def on_token(token: int) -> bool:
+            tokens.put(token)
+            return not stop_event.is_set()
+
+        def run():
+            try:
+                self._generate(token_ids, on_token=on_token, stop_event=stop_event, drafter=drafter)
+            except Exception as e:
+                tokens.put(e)
+            finally:
+                tokens.put(None)
+
+        threading.Thread(target=run, daemon=True, name="StepAudioTTS-stream").start()
+        finished = False
+        while not finished:
+            items = [tokens.get()]
+            while not tokens.empty():
+                items.append(tokens.get_nowait())
+            batch = []
+            for item in items:
+                if item is None:
+                    finished = True
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    batch.append(item)
+            if batch:
+                yield batch
+
+    def _generate(
+        self,
+        token_ids: list[int],
+        on_token=None,
+        stop_event: Optional[threading.Event] = None,
+        drafter=None
+    ) -> torch.Tensor:
+        """
+        Generate audio tokens for an encoded prompt
+
+        Args:
+            token_ids: Encoded prompt token sequence
+            on_token: Optional callback receiving every new token id
+            stop_event: Optional event that stops generation once set
+            drafter: Optional speculative drafter; when set, generation bypasses the
+                scheduler and verifies drafted tokens with `speculative_generate`
+
+        Returns:
+            torch.Tensor: (1, L) prompt + generated token ids, as returned by `generate`
+        """
+        # the system turn (speaker prompt / edit instructions) is shared across requests
+        prefix_len = system_prefix_len(token_ids) if self.prefix_cache is not None else 0
+        if self.scheduler is not None and drafter is None:
+            return self.scheduler.generate(
+                token_ids,
                 max_length=8192,
                 temperature=0.7,
                 do_sample=True,
-                logits_processor=LogitsProcessorList([RepetitionAwareLogitsProcessor()]),
+                logits_processor_factory=lambda: [RepetitionAwareLogitsProcessor()],
+                prefix_len=prefix_len,
+                on_token=on_token,
             )
-            output_ids = output_ids[:, len(prompt_tokens) : -1]  # skip eos token
-            vq0206_codes_vocoder = torch.tensor([vq0206_codes], dtype=torch.long) - 65536
-            logger.debug("Audio editing generation completed")
-            return (
-                self.cosy_model.token2wav_nonstream(
-                    output_ids - 65536,
-                    vq0206_codes_vocoder,
-                    speech_feat.to(torch.bfloat16),
-                    speech_embedding.to(torch.bfloat16),
+        # without the scheduler every request runs its own forward passes on the shared model,
+        # one at a time per engine
+        with self.generate_lock:
+            input_ids = torch.tensor([token_ids]).to(torch.long).to("cuda")
+            logits_processor = LogitsProcessorList(self._logits_processor_factory(len(token_ids))())
+            past_key_values = None
+            if prefix_len:
+                past_key_values = self.prefix_cache.get_or_build(self.llm, input_ids[:, :prefix_len])
+            if drafter is not None:
+                stats = SpeculativeStats()
+                output_ids = speculative_generate(
+                    self.llm,
+                    input_ids,
+                    drafter,
+                    max_length=8192,
+                    temperature=0.7,
+                    do_sample=True,
+                    logits_processor=logits_processor,
+                    past_key_values=past_key_values,
+                    on_token=on_token,
+                    stats=stats,
+                )
+                self.speculative_stats.merge(stats)
+                logger.debug(
+                    f"Speculative decoding: {stats.accepted}/{stats.drafted} drafts accepted "
+                    f"({stats.acceptance_rate:.1%}), {stats.generated / max(stats.steps, 1):.2f} tokens/step"
+                )
+                return output_ids
+            return self.llm.generate(
+                input_ids,
+                past_key_values=past_key_values,
+                max_length=8192,
+                temperature=0.7,
+                do_sample=True,
+                logits_processor=logits_processor,
+                streamer=_TokenCallbackStreamer(on_token) if on_token is not None else None,
+                stopping_criteria=(
+                    StoppingCriteriaList([_EventStoppingCriteria(stop_event)]) if stop_event is not None else None
                 ),
-                24000,
             )
-        except Exception as e:
-            logger.error(f"Edit failed: {e}")
-            raise
 
     def _build_audio_edit_instruction(
         self,
@@ -363,41 +971,40 @@ class StepAudioTTS:
             logger.error(f"Failed to process audio file: {e}")
             raise
 
-    def preprocess_prompt_wav(self, prompt_wav_path : str):
-        prompt_wav, prompt_wav_sr = torchaudio.load(prompt_wav_path)
-        if prompt_wav.shape[0] > 1:
-            prompt_wav = prompt_wav.mean(dim=0, keepdim=True)  # 将多通道音频转换为单通道
+    def preprocess_prompt_wav(self, prompt_wav_path):
+        # decode once; mono (将多通道音频转换为单通道), peak-normalized to 0.6 to avoid
+        # clipping, resampled views are shared by all branches
+        audio_context = AudioContext.wrap(prompt_wav_path)
 
-        # volume-normalize avoid clipping
-        norm = torch.max(torch.abs(prompt_wav), dim=1, keepdim=True)[0]
-        if norm > 0.6: # hard code;  max absolute value is 0.6
-            prompt_wav = prompt_wav / norm * 0.6 
-
-        speech_feat, speech_feat_len = self.cosy_model.frontend.extract_speech_feat(
-            prompt_wav, prompt_wav_sr
-        )
-        speech_embedding = self.cosy_model.frontend.extract_spk_embedding(
-            prompt_wav, prompt_wav_sr
-        )
-        vq0206_codes, vq02_codes_ori, vq06_codes_ori = self.audio_tokenizer.wav2token(prompt_wav, prompt_wav_sr)
+        # vq02 / vq06 / mel / speaker embedding are extracted concurrently
+        analysis = self.prompt_analyzer.analyze(audio_context)
         return (
-            vq0206_codes,
-            vq02_codes_ori,
-            vq06_codes_ori,
-            speech_feat,
-            speech_feat_len,
-            speech_embedding,
+            analysis.vq0206_codes,
+            analysis.vq02_codes,
+            analysis.vq06_codes,
+            analysis.speech_feat,
+            analysis.speech_feat_len,
+            analysis.speech_embedding,
         )
         
     def generate_clone_voice_id(self, prompt_text, prompt_wav):
-        hasher = hashlib.sha256()
-        hasher.update(prompt_text.encode('utf-8'))
+        return self._clone_voice_id(prompt_text, self._speaker_audio_sample(prompt_wav))
+
+    @staticmethod
+    def _speaker_audio_sample(prompt_wav) -> bytes:
+        """First and last 1000 samples of the decoded clip, hashed into the clone speaker id"""
         wav_data = prompt_wav.cpu().numpy()
         if wav_data.size > 2000:
             audio_sample = np.concatenate([wav_data.flatten()[:1000], wav_data.flatten()[-1000:]])
         else:
             audio_sample = wav_data.flatten()
-        hasher.update(audio_sample.tobytes())
+        return audio_sample.tobytes()
+
+    @staticmethod
+    def _clone_voice_id(prompt_text: str, speaker_sample: bytes) -> str:
+        hasher = hashlib.sha256()
+        hasher.update(prompt_text.encode('utf-8'))
+        hasher.update(speaker_sample)
         voice_hash = hasher.hexdigest()[:16]
         return f"clone_{voice_hash}"
     
\ No newline at end of file
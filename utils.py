@@ -11,6 +11,8 @@ import torchaudio
 import sox
 import tempfile
 
+from audio_context import resample
+
 
 def encode_wav(wav, sr, rep_format="wav"):
     with io.BytesIO() as wavio:
@@ -124,9 +126,7 @@ def resample_audio(wav, original_sample_rate, target_sample_rate):
         ), "wav sample rate {} must be greater than {}".format(
             original_sample_rate, target_sample_rate
         )
-        wav = torchaudio.transforms.Resample(
-            orig_freq=original_sample_rate, new_freq=target_sample_rate
-        )(wav)
+        wav = resample(wav, original_sample_rate, target_sample_rate)
     return wav
 
 
@@ -0,0 +1,275 @@
+"""
+Persistent registry of precomputed voice prompt artifacts.
+
+Cloning from a reference clip needs its vq02/vq06 codes, mel features and
+campplus speaker embedding. The registry computes them once per voice, stores
+them in a small binary file per voice and memory-maps that file when loading,
+so clone requests for a registered voice skip prompt preprocessing entirely.
+`AudioArtifactCache` does the same in memory for uploaded clips, keyed by a
+digest of the uploaded bytes.
+
+File layout (`<voice_id>.voice`)::
+
+    b"STEPVOX1" | uint32 header length | JSON header | arrays (64-byte aligned)
+
+The JSON header holds the voice metadata and, per array, its dtype, shape and
+byte offset from the start of the file.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"STEPVOX1"
+ALIGNMENT = 64
+_VOICE_ID_RE = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+@dataclass
+class VoiceArtifacts:
+    """Everything `StepAudioTTS` derives from a reference clip for cloning"""
+
+    prompt_text: str
+    prompt_speaker: str
+    vq0206_codes: np.ndarray  # interleaved absolute audio ids
+    vq02_codes: np.ndarray
+    vq06_codes: np.ndarray
+    speech_feat: torch.Tensor  # (1, T, num_mels)
+    speech_embedding: torch.Tensor  # (1, D)
+    metadata: Dict[str, str] = field(default_factory=dict)
+
+    _ARRAYS = ("vq0206_codes", "vq02_codes", "vq06_codes", "speech_feat", "speech_embedding")
+
+
+def file_digest(path: str) -> str:
+    """blake2b digest of a file, used to detect changed preset audio"""
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def save_voice(path: Path, voice: VoiceArtifacts):
+    """Write artifacts atomically in the registry binary format"""
+    arrays = {}
+    for name in VoiceArtifacts._ARRAYS:
+        value = getattr(voice, name)
+        if isinstance(value, torch.Tensor):
+            value = value.detach().to("cpu", torch.float32).numpy()
+        arrays[name] = np.ascontiguousarray(value)
+
+    header = {
+        "prompt_text": voice.prompt_text,
+        "prompt_speaker": voice.prompt_speaker,
+        "metadata": voice.metadata,
+        "arrays": {},
+    }
+    # offsets depend on the header size, grow the reserved header until it fits
+    reserved = 1024
+    while True:
+        offset = _align(len(MAGIC) + 4 + reserved)
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset = _align(offset + array.nbytes)
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        if len(header_bytes) <= reserved:
+            break
+        reserved = len(header_bytes)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.seek(header["arrays"][name]["offset"])
+                f.write(array.tobytes())
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_voice(path: Path) -> VoiceArtifacts:
+    """Memory-map a voice file; arrays are copy-on-write views of the mapping"""
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    if bytes(buffer[: len(MAGIC)]) != MAGIC:
+        raise ValueError(f"Not a voice artifact file: {path}")
+    (header_len,) = struct.unpack("<I", bytes(buffer[len(MAGIC) : len(MAGIC) + 4]))
+    start = len(MAGIC) + 4
+    header = json.loads(bytes(buffer[start : start + header_len]).decode("utf-8"))
+
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"], dtype=np.int64))
+        offset = spec["offset"]
+        arrays[name] = buffer[offset : offset + count * dtype.itemsize].view(dtype).reshape(spec["shape"])
+
+    return VoiceArtifacts(
+        prompt_text=header["prompt_text"],
+        prompt_speaker=header["prompt_speaker"],
+        vq0206_codes=arrays["vq0206_codes"],
+        vq02_codes=arrays["vq02_codes"],
+        vq06_codes=arrays["vq06_codes"],
+        speech_feat=torch.from_numpy(arrays["speech_feat"]),
+        speech_embedding=torch.from_numpy(arrays["speech_embedding"]),
+        metadata=header.get("metadata", {}),
+    )
+
+
+def artifacts_nbytes(voice: VoiceArtifacts) -> int:
+    """Bytes held by the arrays of `voice`"""
+    total = 0
+    for name in VoiceArtifacts._ARRAYS:
+        value = getattr(voice, name)
+        total += value.numel() * value.element_size() if isinstance(value, torch.Tensor) else value.nbytes
+    return total
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class VoiceRegistry:
+    """
+    Directory-backed registry of voice artifacts keyed by voice id
+
+    Loaded voices are kept in memory (as memory-mapped views); registering a
+    voice writes its file atomically and replaces any previous entry.
+    """
+
+    def __init__(self, root_dir: str):
+        """
+        Initialize VoiceRegistry
+
+        Args:
+            root_dir: Directory holding `<voice_id>.voice` files
+        """
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self._voices: Dict[str, VoiceArtifacts] = {}
+        self._lock = threading.Lock()
+        self._load_all()
+
+    @staticmethod
+    def validate_id(voice_id: str):
+        if not _VOICE_ID_RE.match(voice_id):
+            raise ValueError(f"Invalid voice id '{voice_id}': use 1-64 letters, digits, '_' or '-'")
+
+    def _path(self, voice_id: str) -> Path:
+        return self.root_dir / f"{voice_id}.voice"
+
+    def _load_all(self):
+        for path in sorted(self.root_dir.glob("*.voice")):
+            try:
+                self._voices[path.stem] = load_voice(path)
+            except Exception as e:
+                logger.warning(f"Skipping unreadable voice file {path}: {e}")
+        if self._voices:
+            logger.info(f"Loaded {len(self._voices)} voices from {self.root_dir}")
+
+    def register(self, voice_id: str, voice: VoiceArtifacts) -> VoiceArtifacts:
+        """Persist a voice and return its memory-mapped artifacts"""
+        self.validate_id(voice_id)
+        path = self._path(voice_id)
+        save_voice(path, voice)
+        loaded = load_voice(path)
+        with self._lock:
+            self._voices[voice_id] = loaded
+        return loaded
+
+    def get(self, voice_id: str) -> Optional[VoiceArtifacts]:
+        with self._lock:
+            return self._voices.get(voice_id)
+
+    def __contains__(self, voice_id: str) -> bool:
+        with self._lock:
+            return voice_id in self._voices
+
+    def list_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._voices)
+
+    def items(self):
+        with self._lock:
+            return list(self._voices.items())
+
+
+class AudioArtifactCache:
+    """
+    Byte-bounded LRU of prompt audio artifacts keyed by a content digest
+
+    Entries are `(artifacts, speaker_sample)`: the text-independent part of
+    `VoiceArtifacts` plus the raw samples the clone speaker id is hashed from,
+    so a repeated upload can be served without decoding or resampling it.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        """
+        Initialize AudioArtifactCache
+
+        Args:
+            max_bytes: Upper bound on array bytes kept in memory
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # {key: (entry, nbytes)}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[VoiceArtifacts, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: str, voice: VoiceArtifacts, speaker_sample: bytes):
+        nbytes = artifacts_nbytes(voice) + len(speaker_sample)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = ((voice, speaker_sample), nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
@@ -0,0 +1,91 @@
+"""
+Nearest-centroid quantizer for linguistic (vq02) codes.
+
+The FunASR encoder output is mapped to the closest of 1024 k-means centroids.
+`torch.cdist` materializes the full distance matrix, including the per-frame
+`||x||^2` term that does not affect the argmin. Here the codebook and its
+squared norms are kept per device, and
+
+    argmin_k ||x - c_k||^2 = argmin_k (||c_k||^2 - 2 x . c_k)
+
+is evaluated with one matmul per fixed-size chunk of frames, so memory stays
+bounded for long inputs and no host copy is made before the argmin.
+"""
+import threading
+from typing import Dict, List, Sequence
+
+import numpy as np
+import torch
+
+
+class NearestCentroidQuantizer:
+    """
+    Map feature frames to the index of their nearest codebook centroid
+
+    Args:
+        codebook: (K, D) centroids
+        chunk_size: Frames scored per matmul
+    """
+
+    def __init__(self, codebook, chunk_size: int = 4096):
+        codebook = torch.as_tensor(codebook, dtype=torch.float32).contiguous()
+        self.num_codes, self.dim = codebook.shape
+        self.chunk_size = chunk_size
+        self._codebooks: Dict[torch.device, tuple] = {}
+        self._lock = threading.Lock()
+        self._add_device(codebook)
+
+    def _add_device(self, codebook: torch.Tensor):
+        self._codebooks[codebook.device] = (codebook.t().contiguous(), codebook.pow(2).sum(dim=1))
+
+    def _codebook_on(self, device: torch.device):
+        entry = self._codebooks.get(device)
+        if entry is None:
+            with self._lock:
+                entry = self._codebooks.get(device)
+                if entry is None:
+                    codebook_t, _ = next(iter(self._codebooks.values()))
+                    self._add_device(codebook_t.t().to(device))
+                    entry = self._codebooks[device]
+        return entry
+
+    @torch.inference_mode()
+    def quantize(self, frames: torch.Tensor) -> np.ndarray:
+        """
+        Quantize frames on their own device
+
+        Args:
+            frames: (T, D) or (1, T, D) features
+
+        Returns:
+            np.ndarray: (T,) int64 centroid indices
+        """
+        frames = frames.reshape(-1, self.dim)
+        if frames.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        codebook_t, codebook_sq = self._codebook_on(frames.device)
+        frames = frames.to(torch.float32)
+        indices = torch.empty(frames.shape[0], dtype=torch.long, device=frames.device)
+        for start in range(0, frames.shape[0], self.chunk_size):
+            chunk = frames[start : start + self.chunk_size]
+            scores = torch.addmm(codebook_sq, chunk, codebook_t, beta=1, alpha=-2)
+            indices[start : start + chunk.shape[0]] = scores.argmin(dim=1)
+        return indices.cpu().numpy()
+
+    def quantize_batch(self, samples: Sequence[torch.Tensor]) -> List[np.ndarray]:
+        """
+        Quantize several variable-length utterances in one pass
+
+        Args:
+            samples: Tensors of shape (T_i, D) or (1, T_i, D)
+
+        Returns:
+            list[np.ndarray]: Per-utterance int64 indices
+        """
+        if not samples:
+            return []
+        frames = [sample.reshape(-1, self.dim) for sample in samples]
+        lengths = [x.shape[0] for x in frames]
+        device = frames[0].device
+        indices = self.quantize(torch.cat([x.to(device) for x in frames]))
+        return np.split(indices, np.cumsum(lengths)[:-1])
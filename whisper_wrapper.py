@@ -1,8 +1,9 @@
 import logging
 import torch
-import torchaudio
 from transformers import pipeline
 
+from audio_context import AudioContext
+
 
 class WhisperWrapper:
     """Simplified Whisper ASR wrapper"""
@@ -31,7 +32,7 @@ class WhisperWrapper:
         Audio to text transcription
 
         Args:
-            audio_input: Audio file path or audio tensor
+            audio_input: Audio file path, AudioContext, or 16 kHz audio tensor
 
         Returns:
             Transcribed text
@@ -41,19 +42,15 @@ class WhisperWrapper:
 
         try:
             # Load audio
-            if isinstance(audio_input, str):
-                # Audio file path
-                audio, audio_sr = torchaudio.load(audio_input)
-                audio = torchaudio.functional.resample(audio, audio_sr, 16000)
-                # Handle stereo to mono conversion (pipeline may not handle this)
-                if audio.shape[0] > 1:
-                    audio = audio.mean(dim=0, keepdim=True)  # Convert stereo to mono by averaging
+            if isinstance(audio_input, (str, AudioContext)):
+                # Audio file path or a context shared with the tokenizer;
+                # mono 16 kHz view (pipeline may not handle stereo)
+                audio = AudioContext.wrap(audio_input).resampled(16000, normalized=False)
                 # Convert to numpy and squeeze
                 audio = audio.squeeze(0).numpy()
             elif isinstance(audio_input, torch.Tensor):
-                # Tensor input
+                # Tensor input, already at 16 kHz
                 audio = audio_input.cpu()
-                audio = torchaudio.functional.resample(audio, audio_sr, 16000)
                 # Handle stereo to mono conversion
                 if audio.ndim > 1 and audio.shape[0] > 1:
                     audio = audio.mean(dim=0, keepdim=True)
@@ -72,6 +69,43 @@ class WhisperWrapper:
             self.logger.error(f"Audio transcription failed: {e}")
             return ""
 
+    def transcribe_log_mels(self, log_mels):
+        """
+        Transcribe from precomputed Whisper log-mel windows, bypassing the pipeline's feature extractor
+
+        Args:
+            log_mels: (128, frames) log-mel spectrograms of consecutive <= 30 s windows,
+                as computed by `whisper.log_mel_spectrogram` (e.g. the vq06 tokenizer's)
+
+        Returns:
+            Transcribed text
+        """
+        if self.model is None:
+            raise RuntimeError("Whisper model not loaded")
+        if not log_mels:
+            return ""
+
+        try:
+            model = self.model.model
+            num_frames = self.model.feature_extractor.nb_max_frames  # 3000, 30 s
+            # the pipeline pads audio with zeros to 30 s; zero samples land on the
+            # clamp floor, 2.0 below the window maximum after normalization
+            features = torch.stack([
+                torch.nn.functional.pad(mel, (0, num_frames - mel.shape[1]), value=float(mel.max()) - 2.0)
+                for mel in log_mels
+            ]).to(model.device, model.dtype)
+            with torch.inference_mode():
+                ids = model.generate(input_features=features)
+            texts = self.model.tokenizer.batch_decode(ids, skip_special_tokens=True)
+            text = "".join(texts).strip()
+
+            self.logger.debug(f"Transcription result: {text}")
+            return text
+
+        except Exception as e:
+            self.logger.error(f"Audio transcription failed: {e}")
+            return ""
+
     def is_available(self):
         """Check if whisper model is available"""
         return self.model is not None
\ No newline at end of file